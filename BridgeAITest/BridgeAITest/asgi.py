@@ -8,16 +8,21 @@ https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 """
 
 import os
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 from channels.security.websocket import AllowedHostsOriginValidator
 from LLMChat.routing import websocket_urlpatterns
+from LLMChat.local_llm import LOCAL_MODELS
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'BridgeAITest.settings')
 
 django_asgi_app = get_asgi_application()
 
+# Local models listed for preloading start loading now instead of on the first chat
+LOCAL_MODELS.preload(getattr(settings, 'LLMCHAT_LOCAL_PRELOAD', {}))
+
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
     "websocket": AllowedHostsOriginValidator(
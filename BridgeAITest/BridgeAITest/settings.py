@@ -64,6 +64,8 @@ SWAGGER_SETTINGS = {
 }
 
 MIDDLEWARE = [
+    'LLMChat.middleware.MetricsMiddleware',
+    'LLMChat.middleware.TracingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -161,6 +163,138 @@ STATIC_URL = 'static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Caches
+# The "llmchat" cache is shared by all worker processes on the host and carries
+# the configuration generation used to invalidate in-process LLMChat caches.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'llmchat': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / '.cache' / 'llmchat',
+    },
+}
+
+# LLMChat database pool (threads used for ORM calls made from async chat code)
+LLMCHAT_DB_THREADS = 8
+
+# LLMChat conversation history cache (total messages kept in memory per process)
+LLMCHAT_HISTORY_CACHE_MESSAGES = 20000
+
+# LLMChat rolling summaries (disabled unless a keep count is set here or in a
+# provider's extra_settings as summary_keep_turns / summary_batch_turns)
+LLMCHAT_SUMMARY_KEEP_TURNS = None
+LLMCHAT_SUMMARY_BATCH_TURNS = 10
+
+# LLMChat write-behind ChatLog persistence (set SYNC_WRITES for tests)
+LLMCHAT_CHATLOG_BATCH_SIZE = 50
+LLMCHAT_CHATLOG_FLUSH_INTERVAL = 1.0  # seconds
+LLMCHAT_CHATLOG_SYNC_WRITES = False
+
+# LLMChat exact-match response cache, used for temperature 0 providers
+# (or extra_settings['response_cache']); backend is "local", "django" or a dotted path
+LLMCHAT_RESPONSE_CACHE_BACKEND = 'local'
+LLMCHAT_RESPONSE_CACHE_ALIAS = 'default'  # Django cache used by the "django" backend
+LLMCHAT_RESPONSE_CACHE_TTL = 3600  # seconds
+LLMCHAT_RESPONSE_CACHE_MAX_ENTRIES = 1000
+
+# LLMChat semantic response cache (enabled per provider with
+# extra_settings['semantic_cache_threshold'] or globally with the threshold here)
+LLMCHAT_SEMANTIC_CACHE_THRESHOLD = None  # cosine similarity, e.g. 0.9
+LLMCHAT_SEMANTIC_CACHE_EMBEDDER = None  # dotted path to a LangChain Embeddings class; hashing embedder by default
+LLMCHAT_SEMANTIC_CACHE_CAPACITY = 10000
+LLMCHAT_SEMANTIC_CACHE_PATH = BASE_DIR / '.cache' / 'semantic'  # one shard per worker process below this
+
+# LLMChat failover: providers are tried in priority order, skipping those whose
+# circuit breaker is open (each can override these in extra_settings as breaker_*)
+LLMCHAT_FAILOVER = True
+LLMCHAT_BREAKER_WINDOW = 20  # recent calls considered
+LLMCHAT_BREAKER_MIN_CALLS = 5
+LLMCHAT_BREAKER_ERROR_RATE = 0.5  # share of failed or slow calls that opens the circuit
+LLMCHAT_BREAKER_LATENCY = None  # seconds; slower calls (time to first chunk when streaming) count as failures
+LLMCHAT_BREAKER_OPEN_SECONDS = 30.0  # before a half-open probe is allowed
+
+# LLMChat request hedging (streaming only; per provider: extra_settings 'hedge' / 'hedge_delay')
+LLMCHAT_HEDGING = False
+LLMCHAT_HEDGE_DELAY = 1.0  # seconds, until enough first-chunk timings give a p95
+
+# LLMChat single-flight: identical requests in flight at the same time share one
+# provider call. When on, only temperature 0 providers coalesce, since others would
+# hand every caller the same sample (per provider: extra_settings['single_flight'])
+LLMCHAT_SINGLE_FLIGHT = False
+
+# LLMChat provider limits (per provider in extra_settings: max_concurrency,
+# requests_per_minute, tokens_per_minute); calls over a limit queue up to this long
+LLMCHAT_QUEUE_TIMEOUT = 30.0  # seconds
+
+# LLMChat native streaming: openai (and compatible, via extra_settings['api_base']) and
+# anthropic providers stream straight from the HTTP API instead of through LangChain
+# while no tools are enabled (per provider: extra_settings['native_stream'])
+LLMCHAT_NATIVE_STREAMING = False
+
+# LLMChat HTTP connection pools shared by all provider clients: per-host connection
+# limits and keep-alive; HTTP/2 is used when enabled and the h2 package is installed
+LLMCHAT_HTTP_MAX_CONNECTIONS = 100
+LLMCHAT_HTTP_MAX_KEEPALIVE = 20
+LLMCHAT_HTTP_KEEPALIVE_EXPIRY = 60.0
+LLMCHAT_HTTP2 = True
+
+# LLMChat deadlines: each WebSocket message or HTTP chat request has LLMCHAT_REQUEST_DEADLINE
+# seconds (None: unlimited) for all its provider calls. Failed calls are retried with
+# jittered exponential backoff while time is left; connects, first tokens, gaps between
+# tokens and non-streamed calls have their own timeouts. Per provider in extra_settings:
+# retries, retry_backoff, retry_backoff_max, first_token_timeout, inter_token_timeout, call_timeout
+LLMCHAT_REQUEST_DEADLINE = 120.0
+LLMCHAT_RETRIES = 2
+LLMCHAT_RETRY_BACKOFF = 0.5
+LLMCHAT_RETRY_BACKOFF_MAX = 8.0
+LLMCHAT_CONNECT_TIMEOUT = 10.0
+LLMCHAT_FIRST_TOKEN_TIMEOUT = 30.0
+LLMCHAT_INTER_TOKEN_TIMEOUT = 15.0
+LLMCHAT_CALL_TIMEOUT = 60.0
+
+# LLMChat local models (llama_cpp providers): concurrent requests decoded together
+# in shared batches; per provider as max_batch in extra_settings. Off (1) unless
+# enabled: the batched decoder has not been run on every model family yet
+LLMCHAT_LOCAL_MAX_BATCH = 1
+
+# LLMChat local models loaded when an ASGI worker starts rather than on first use:
+# model path -> load parameters (n_ctx, n_gpu_layers, n_threads, chat_format), which
+# must match the provider's extra_settings for the provider to get the preloaded model
+LLMCHAT_LOCAL_PRELOAD = {}
+
+# LLMChat batched local models: the evaluated prompt (KV cache) of each conversation is kept
+# between turns, least recently used ones spilled to disk (per provider: prompt_cache)
+LLMCHAT_PROMPT_STATE_CACHE = True
+LLMCHAT_PROMPT_STATE_MEMORY_BYTES = 512 * 2 ** 20
+LLMCHAT_PROMPT_STATE_PATH = BASE_DIR / '.cache' / 'prompt_states'
+LLMCHAT_PROMPT_STATE_DISK_BYTES = 4 * 2 ** 30
+
+# LLMChat metrics (/metrics): each worker process writes its snapshot to this
+# directory every flush interval, and the endpoint sums them up; snapshots of
+# exited processes or not rewritten for the TTL are deleted
+LLMCHAT_METRICS_DIR = BASE_DIR / '.cache' / 'metrics'
+LLMCHAT_METRICS_FLUSH_INTERVAL = 5.0  # seconds
+LLMCHAT_METRICS_SNAPSHOT_TTL = 300.0  # seconds
+# Who may scrape /metrics: these client addresses or networks, plus requests with
+# "Authorization: Bearer <LLMCHAT_METRICS_TOKEN>" when a token is set
+LLMCHAT_METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+LLMCHAT_METRICS_TOKEN = None
+
+# LLMChat tracing: spans of HTTP requests, WebSocket messages, provider calls and
+# TTS go to this exporter ('jsonl', 'log', 'none' or a dotted path to a class).
+# 'jsonl' appends to LLMCHAT_TRACE_PATH, rotating it to .1 ... .N once it reaches
+# LLMCHAT_TRACE_MAX_BYTES and keeping LLMCHAT_TRACE_BACKUPS old files
+LLMCHAT_TRACE_EXPORTER = 'none'
+LLMCHAT_TRACE_PATH = BASE_DIR / '.cache' / 'traces.jsonl'
+LLMCHAT_TRACE_MAX_BYTES = 64 * 2 ** 20
+LLMCHAT_TRACE_BACKUPS = 3
+
+# LLMChat provider registry
+LLMCHAT_REGISTRY_CACHE = 'llmchat'
+LLMCHAT_REGISTRY_CHECK_INTERVAL = 1.0  # seconds between checks for changes made by other workers
+
 # Add Channels configuration
 ASGI_APPLICATION = 'BridgeAITest.asgi.application'
 
@@ -17,8 +17,10 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 from .swagger import schema_view
+from LLMChat.views import metrics_view
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('metrics', metrics_view, name='metrics'),
     path('api/',  include('todo.urls')),
     path('api/langchain/',  include('chat.urls')),
     path('api/llm/',  include('LLMChat.urls')),
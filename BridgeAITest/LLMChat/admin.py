@@ -12,6 +12,7 @@ class ToolAdmin(admin.ModelAdmin):
 
 @admin.register(ChatLog)
 class ChatLogAdmin(admin.ModelAdmin):
-    list_display = ("id", "provider", "input_tokens", "output_tokens", "total_tokens", "created_at")
+    list_display = ("id", "provider", "input_tokens", "output_tokens", "total_tokens", "cached", "ttft_ms", "latency_ms", "created_at")
     readonly_fields = ("provider", "system_prompt", "user_message", "ai_response",
-                       "input_tokens", "output_tokens", "total_tokens", "created_at")
+                       "input_tokens", "output_tokens", "total_tokens", "usage_estimated", "cached",
+                       "ttft_ms", "latency_ms", "tokens_per_second", "created_at")
@@ -2,13 +2,14 @@ import json
 import asyncio
 import websockets
 from channels.generic.websocket import AsyncWebsocketConsumer
+from .monitoring import ConsumerMetricsMixin
 from django.conf import settings
 import logging
 import threading
 
 logger = logging.getLogger(__name__)
 
-class AudioTranscriptionConsumer(AsyncWebsocketConsumer):
+class AudioTranscriptionConsumer(ConsumerMetricsMixin, AsyncWebsocketConsumer):
     """Consumer for converting audio to text using Deepgram."""
     
     def __init__(self, *args, **kwargs):
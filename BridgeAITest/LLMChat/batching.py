@@ -0,0 +1,439 @@
+"""Continuous batching of concurrent generations on one local model."""
+import asyncio
+import codecs
+import ctypes
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from .prompt_state import PromptState, PromptStateCache, common_prefix
+
+logger = logging.getLogger(__name__)
+
+
+class Generation:
+    """One request in a BatchScheduler; iterate it for the generated text pieces.
+
+    ``input_tokens`` and ``output_tokens`` are exact once the iteration is over.
+    Leaving the iteration early cancels the request at the next decode step.
+    """
+
+    def __init__(self, scheduler: 'BatchScheduler', messages: List[Dict[str, str]], max_tokens: int,
+                 temperature: float, top_p: float, state_key: Optional[Tuple[str, int]] = None,
+                 keep_state: bool = True):
+        self.scheduler = scheduler
+        self.messages = messages
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.state_key = state_key
+        self.keep_state = keep_state
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.cancelled = threading.Event()
+        # Owned by the scheduler thread
+        self.slot: Optional[int] = None
+        self.pending: List[int] = []  # tokens to feed at the next step (the prompt, then the last token)
+        self.position = 0
+        self.evaluated: List[int] = []  # tokens in the sequence's KV cache
+        self.reused_tokens = 0  # prompt tokens restored from the conversation's previous turn
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.submitted_at = time.monotonic()
+
+    def _put(self, item) -> None:
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+
+    async def __aiter__(self) -> AsyncIterator[str]:
+        try:
+            while True:
+                item = await self.queue.get()
+                if item is None:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            self.cancelled.set()
+            self.scheduler._wake()
+
+
+class BatchScheduler:
+    """Runs the generations of one model in shared decode steps.
+
+    A single worker thread owns the backend. Each step feeds every active
+    sequence one token (a newly admitted sequence feeds its whole prompt) and
+    samples the next token of each; waiting requests are admitted between
+    steps, first come, first served, while fewer than ``max_batch`` are
+    active. Text pieces are handed to each request's event loop as they come.
+
+    The backend is created on the worker thread by ``backend_factory`` and
+    must provide ``n_ctx`` (the context size of each sequence), ``encode(messages)
+    -> tokens``, ``step(generations) -> next tokens``, ``text(generation,
+    token) -> str``, ``is_eog(token)`` and ``release(slot)``. A request whose
+    prompt and ``max_tokens`` exceed ``n_ctx`` gets fewer tokens, and one
+    whose prompt alone does fails.
+
+    With a PromptStateCache as ``states``, requests submitted with a
+    ``state_key`` keep their sequence's KV cache after finishing (unless
+    submitted with ``keep_state=False``), and the next request with that key
+    only evaluates the part of its prompt that differs; the backend then also provides ``save(slot) -> bytes`` and
+    ``restore(slot, state, tokens) -> bool`` (load ``state`` and keep its
+    first ``tokens``).
+    """
+
+    def __init__(self, backend_factory: Callable[[], Any], max_batch: int, name: str = 'local',
+                 states: Optional[PromptStateCache] = None):
+        self.backend_factory = backend_factory
+        self.max_batch = max_batch
+        self.name = name
+        self.states = states
+        self.backend = None
+        self._waiting: deque = deque()
+        self._active: Dict[int, Generation] = {}
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        # Stats
+        self.steps = 0
+        self.batched_sequences = 0  # sum of the batch sizes of all steps
+        self.generated_tokens = 0
+        self.prompt_tokens = 0
+        self.reused_tokens = 0
+        self.max_active = 0
+
+    def submit(self, messages: List[Dict[str, str]], max_tokens: int, temperature: float = 0.7,
+               top_p: float = 1.0, state_key: Optional[Tuple[str, int]] = None,
+               keep_state: bool = True) -> Generation:
+        generation = Generation(self, messages, max_tokens, temperature, top_p, state_key, keep_state)
+        with self._condition:
+            self._waiting.append(generation)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f"batch-{self.name}", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return generation
+
+    def _wake(self) -> None:
+        with self._condition:
+            self._condition.notify()
+
+    def _admit(self) -> None:
+        """Move waiting requests into free slots (condition held)."""
+        free = [slot for slot in range(self.max_batch) if slot not in self._active]
+        while self._waiting and free:
+            generation = self._waiting.popleft()
+            if generation.cancelled.is_set():
+                continue
+            generation.slot = free.pop(0)
+            self._active[generation.slot] = generation
+        self.max_active = max(self.max_active, len(self._active))
+
+    def _finish(self, generation: Generation, error: Optional[BaseException] = None) -> None:
+        with self._condition:
+            self._active.pop(generation.slot, None)
+        try:
+            if error is None and generation.evaluated and generation.keep_state \
+                    and generation.state_key is not None and self.states is not None:
+                self._save(generation)
+            self.backend.release(generation.slot)
+        finally:
+            generation._put(error)
+
+    def _run(self) -> None:
+        try:
+            self.backend = self.backend_factory()
+        except Exception as e:
+            logger.error(f"Starting local model {self.name} failed: {str(e)}")
+            with self._condition:
+                failed, self._waiting = list(self._waiting), deque()
+                self._thread = None
+            for generation in failed:
+                generation._put(e)
+            return
+
+        while True:
+            with self._condition:
+                while not self._active and not any(not g.cancelled.is_set() for g in self._waiting):
+                    self._waiting.clear()
+                    self._condition.wait()
+                self._admit()
+                batch = list(self._active.values())
+
+            ready = []
+            for generation in batch:
+                if generation.cancelled.is_set():
+                    self._finish(generation)
+                elif not generation.pending and not generation.position:
+                    # Newly admitted: its prompt goes into this step
+                    try:
+                        generation.pending = self.backend.encode(generation.messages)
+                        generation.input_tokens = len(generation.pending)
+                        self._fit(generation)
+                        if generation.state_key is not None and self.states is not None:
+                            self._restore(generation)
+                        self.prompt_tokens += generation.input_tokens
+                        self.reused_tokens += generation.reused_tokens
+                        ready.append(generation)
+                    except Exception as e:
+                        self._finish(generation, e)
+                else:
+                    ready.append(generation)
+            if not ready:
+                continue
+
+            try:
+                tokens = self.backend.step(ready)
+            except Exception as e:
+                logger.error(f"Decode step on local model {self.name} failed: {str(e)}")
+                for generation in ready:
+                    self._finish(generation, e)
+                continue
+            self.steps += 1
+            self.batched_sequences += len(ready)
+            self.generated_tokens += len(ready)
+
+            for generation, token in zip(ready, tokens):
+                try:
+                    self._advance(generation, token)
+                except Exception as e:
+                    self._finish(generation, e)
+
+    def _fit(self, generation: Generation) -> None:
+        """Keep the prompt and reply of a new request within its sequence's share of the context."""
+        room = self.backend.n_ctx - len(generation.pending)
+        if room <= 0:
+            raise ValueError(f"Prompt of {len(generation.pending)} tokens does not fit the context "
+                             f"of {self.backend.n_ctx} tokens of local model {self.name}")
+        if generation.max_tokens > room:
+            logger.warning(f"Reply on local model {self.name} limited to {room} tokens by its context size")
+            generation.max_tokens = room
+
+    def _restore(self, generation: Generation) -> None:
+        """Start from the KV cache of the conversation's previous turn where the prompts agree."""
+        state = self.states.get(generation.state_key)
+        if state is None:
+            return
+        # The last prompt token is fed again in any case: its logits give the first reply token
+        reused = min(common_prefix(state.tokens, generation.pending), len(generation.pending) - 1)
+        if reused <= 0 or not self.backend.restore(generation.slot, state, reused):
+            return
+        generation.evaluated = generation.pending[:reused]
+        generation.pending = generation.pending[reused:]
+        generation.position = generation.reused_tokens = reused
+
+    def _save(self, generation: Generation) -> None:
+        try:
+            self.states.put(generation.state_key,
+                            PromptState(tuple(generation.evaluated), self.backend.save(generation.slot)))
+        except Exception as e:
+            logger.warning(f"Saving the prompt state on local model {self.name} failed: {str(e)}")
+
+    def _advance(self, generation: Generation, token: int) -> None:
+        generation.evaluated.extend(generation.pending)
+        generation.position += len(generation.pending)
+        if self.backend.is_eog(token):
+            self._finish(generation)
+            return
+        generation.output_tokens += 1
+        generation.pending = [token]
+        text = self.backend.text(generation, token)
+        if text:
+            generation._put(text)
+        if generation.output_tokens >= generation.max_tokens:
+            self._finish(generation)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._condition:
+            return {
+                'active': len(self._active),
+                'waiting': len(self._waiting),
+                'max_active': self.max_active,
+                'steps': self.steps,
+                'avg_batch': self.batched_sequences / self.steps if self.steps else 0.0,
+                'generated_tokens': self.generated_tokens,
+                'prompt_tokens': self.prompt_tokens,
+                'reused_prompt_tokens': self.reused_tokens,
+            }
+
+
+def _token_text(llm, token: int) -> str:
+    try:
+        return llm.detokenize([token], special=True).decode('utf-8', errors='ignore')
+    except TypeError:  # older llama-cpp-python without ``special``
+        return llm.detokenize([token]).decode('utf-8', errors='ignore')
+
+
+class LlamaBatchBackend:
+    """Multi-sequence decoding on a llama.cpp model.
+
+    Uses its own llama.cpp context with one KV-cache sequence per batch slot
+    (``n_ctx`` tokens each), next to the ``Llama`` object that provides the
+    weights, tokenizer and chat template. Sampling (temperature, top-k 40,
+    top-p) runs on the logits of each sequence's last token. A sequence's
+    KV cache can be saved and restored into any slot, which is how
+    conversations skip re-evaluating their history.
+    """
+
+    TOP_K = 40
+
+    def __init__(self, llm, max_batch: int, n_ctx: int, n_threads: Optional[int] = None, seed: Optional[int] = None):
+        import llama_cpp
+        import numpy
+
+        self.lib = llama_cpp
+        self.numpy = numpy
+        self.llm = llm
+        self.n_ctx = n_ctx
+        params = llama_cpp.llama_context_default_params()
+        params.n_ctx = n_ctx * max_batch
+        params.n_batch = params.n_ctx  # prompts and decode tokens of one step go in one batch
+        params.n_seq_max = max_batch
+        if n_threads:
+            params.n_threads = params.n_threads_batch = n_threads
+        self.ctx = llama_cpp.llama_new_context_with_model(llm.model, params)
+        if not self.ctx:
+            raise RuntimeError("llama.cpp could not create a batched context")
+        self.n_batch = params.n_batch
+        self.batch = llama_cpp.llama_batch_init(params.n_batch, 0, 1)
+        self.n_vocab = llm.n_vocab()
+        self.rng = numpy.random.default_rng(seed)
+        self.eog = {llm.token_eos()}
+        for key in ('tokenizer.ggml.eos_token_id', 'tokenizer.ggml.eot_token_id'):
+            if key in llm.metadata:
+                self.eog.add(int(llm.metadata[key]))
+        self._decoders: Dict[int, Any] = {}
+        self._seq_rm = getattr(llama_cpp, 'llama_kv_self_seq_rm', None) or llama_cpp.llama_kv_cache_seq_rm
+        self._formatter = None
+        template = llm.metadata.get('tokenizer.chat_template')
+        if template:
+            from llama_cpp.llama_chat_format import Jinja2ChatFormatter
+            self._formatter = Jinja2ChatFormatter(
+                template=template,
+                eos_token=_token_text(llm, llm.token_eos()),
+                bos_token=_token_text(llm, llm.token_bos()),
+            )
+
+    def encode(self, messages: List[Dict[str, str]]) -> List[int]:
+        if self._formatter is not None:
+            prompt = self._formatter(messages=messages).prompt
+        else:
+            # ChatML, the most common template, for models that ship none
+            prompt = "".join(f"<|im_start|>{m['role']}\n{m['content']}<|im_end|>\n" for m in messages)
+            prompt += "<|im_start|>assistant\n"
+        bos = _token_text(self.llm, self.llm.token_bos())
+        return self.llm.tokenize(prompt.encode('utf-8'), add_bos=not (bos and prompt.startswith(bos)), special=True)
+
+    def step(self, generations: List[Generation]) -> List[int]:
+        batch = self.batch
+        count = 0
+        rows = []
+        for generation in generations:
+            for offset, token in enumerate(generation.pending):
+                # The scheduler keeps each sequence within n_ctx, so a step never exceeds the batch
+                assert count < self.n_batch, f"decode step exceeds the batch of {self.n_batch} tokens"
+                batch.token[count] = token
+                batch.pos[count] = generation.position + offset
+                batch.n_seq_id[count] = 1
+                batch.seq_id[count][0] = generation.slot
+                batch.logits[count] = offset == len(generation.pending) - 1
+                count += 1
+            rows.append(count - 1)
+        batch.n_tokens = count
+        status = self.lib.llama_decode(self.ctx, batch)
+        if status != 0:
+            raise RuntimeError(f"llama_decode returned {status}")
+        return [self._sample(self.lib.llama_get_logits_ith(self.ctx, row), generation)
+                for row, generation in zip(rows, generations)]
+
+    def _sample(self, logits_pointer, generation: Generation) -> int:
+        np = self.numpy
+        logits = np.ctypeslib.as_array(logits_pointer, shape=(self.n_vocab,))
+        if generation.temperature <= 0:
+            return int(logits.argmax())
+        top = np.argpartition(logits, -self.TOP_K)[-self.TOP_K:]
+        top = top[np.argsort(logits[top])[::-1]]
+        probs = np.exp((logits[top] - logits[top[0]]) / generation.temperature)
+        probs /= probs.sum()
+        if generation.top_p < 1.0:
+            keep = int(np.searchsorted(np.cumsum(probs), generation.top_p)) + 1
+            top, probs = top[:keep], probs[:keep] / probs[:keep].sum()
+        return int(self.rng.choice(top, p=probs))
+
+    def text(self, generation: Generation, token: int) -> str:
+        decoder = self._decoders.get(generation.slot)
+        if decoder is None:
+            decoder = self._decoders[generation.slot] = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        return decoder.decode(self.llm.detokenize([token]))
+
+    def is_eog(self, token: int) -> bool:
+        return token in self.eog
+
+    def save(self, slot: int) -> bytes:
+        size = self.lib.llama_state_seq_get_size(self.ctx, slot)
+        buffer = (ctypes.c_uint8 * size)()
+        written = self.lib.llama_state_seq_get_data(self.ctx, buffer, size, slot)
+        return ctypes.string_at(buffer, written)
+
+    def restore(self, slot: int, state: PromptState, tokens: int) -> bool:
+        self._seq_rm(self.ctx, slot, -1, -1)
+        buffer = (ctypes.c_uint8 * len(state.data)).from_buffer_copy(state.data)
+        if not self.lib.llama_state_seq_set_data(self.ctx, buffer, len(state.data), slot):
+            # E.g. no contiguous room for it in the KV cache right now
+            self._seq_rm(self.ctx, slot, -1, -1)
+            return False
+        # Drop what follows the common prefix (usually the previous reply as it was sampled)
+        self._seq_rm(self.ctx, slot, tokens, -1)
+        return True
+
+    def release(self, slot: Optional[int]) -> None:
+        if slot is None:
+            return
+        self._decoders.pop(slot, None)
+        self._seq_rm(self.ctx, slot, -1, -1)
+
+
+class FakeBatchBackend:
+    """Stand-in for a local model with the cost profile of CPU decoding.
+
+    A decode step reads all weights once whatever the batch size, so it costs
+    ``step_seconds`` plus a little per sequence and per prompt token; tokens
+    are deterministic words. Used to benchmark the scheduler without a model.
+    Saved states hold one byte per evaluated token.
+    """
+
+    def __init__(self, step_seconds: float = 0.02, sequence_seconds: float = 0.0005,
+                 prompt_token_seconds: float = 0.0001, n_ctx: int = 4096):
+        self.n_ctx = n_ctx
+        self.step_seconds = step_seconds
+        self.sequence_seconds = sequence_seconds
+        self.prompt_token_seconds = prompt_token_seconds
+        self._lengths: Dict[int, int] = {}
+
+    def encode(self, messages: List[Dict[str, str]]) -> List[int]:
+        return [len(word) for message in messages for word in message['content'].split()] or [0]
+
+    def step(self, generations: List[Generation]) -> List[int]:
+        prompt_tokens = sum(len(g.pending) for g in generations if len(g.pending) > 1)
+        time.sleep(self.step_seconds + self.sequence_seconds * len(generations)
+                   + self.prompt_token_seconds * prompt_tokens)
+        for g in generations:
+            self._lengths[g.slot] = g.position + len(g.pending)
+        return [(g.position + len(g.pending)) % 7 + 1 for g in generations]
+
+    def text(self, generation: Generation, token: int) -> str:
+        return ' ' + 'word'[:token % 4 + 1]
+
+    def is_eog(self, token: int) -> bool:
+        return False
+
+    def save(self, slot: int) -> bytes:
+        return bytes(self._lengths.get(slot, 0))
+
+    def restore(self, slot: int, state: PromptState, tokens: int) -> bool:
+        self._lengths[slot] = tokens
+        return True
+
+    def release(self, slot: Optional[int]) -> None:
+        self._lengths.pop(slot, None)
@@ -1,16 +1,34 @@
 import json
+import re
+import secrets
+from typing import Optional
 from channels.generic.websocket import AsyncWebsocketConsumer
+from .monitoring import ConsumerMetricsMixin
+from .tracing import TRACER
+from .deadlines import deadline_scope
 from .services import ChatService, get_active_provider
-from .models import ModelProvider
-from asgiref.sync import sync_to_async
+from .registry import PROVIDER_REGISTRY
 from django.core.exceptions import ValidationError
 from channels.layers import get_channel_layer
 import logging
 
 logger = logging.getLogger(__name__)
 
+TTS_SESSION_RE = re.compile(r'^[0-9a-f]{32}$')
 
-class ChatConsumer(AsyncWebsocketConsumer):
+
+def new_tts_session() -> str:
+    return secrets.token_hex(16)
+
+
+def tts_group(session) -> Optional[str]:
+    """Channel group of the TTS socket that handed out ``session``, or ``None`` if it is not one."""
+    if isinstance(session, str) and TTS_SESSION_RE.match(session):
+        return f"tts_{session}"
+    return None
+
+
+class ChatConsumer(ConsumerMetricsMixin, AsyncWebsocketConsumer):
     async def connect(self):
         """Handle WebSocket connection."""
         await self.accept()
@@ -25,26 +43,87 @@ class ChatConsumer(AsyncWebsocketConsumer):
     async def get_provider(self, provider_id=None):
         """Get the LLM provider."""
         if provider_id:
-            try:
-                return await sync_to_async(ModelProvider.objects.get)(id=provider_id, is_active=True)
-            except ModelProvider.DoesNotExist:
+            provider = await PROVIDER_REGISTRY.aget(provider_id)
+            if not provider:
                 raise ValidationError("Invalid or inactive provider_id")
+            return provider
         
         provider = await get_active_provider()
         if not provider:
             raise ValidationError("No active LLM provider configured")
         return provider
 
-    async def receive(self, text_data):
+    async def send_to_tts(self, group: str, text: str, span) -> None:
+        """Hand text to the client's TTS socket, carrying the trace so it can continue it."""
+        logger.debug(f"Sending to TTS: {text}")
+        await get_channel_layer().group_send(
+            group,
+            {
+                "type": "tts.text",
+                "text": text,
+                **span.context()
+            }
+        )
+
+    async def stream_reply(self, chunks, tts: Optional[str]) -> None:
+        """Forward streamed chunks to the client and complete sentences to the TTS group ``tts``."""
+        enable_tts = tts is not None
+        accumulated_text = ""  # Accumulate text for TTS
+        sentence_span = None  # Times how long a sentence waits for its end
+        async for chunk in chunks:
+            if chunk:
+                accumulated_text += chunk
+                await self.send(json.dumps({
+                    'type': 'chat.message',
+                    'chunk': chunk
+                }))
+                if enable_tts and sentence_span is None:
+                    sentence_span = TRACER.span('tts.sentence_buffer')
+                
+                # Send to TTS if enabled and we have a complete sentence
+                if enable_tts and any(char in accumulated_text for char in '!.?'):
+                    # Send accumulated text to audio group
+                    sentence_span.set(chars=len(accumulated_text))
+                    sentence_span.end()
+                    await self.send_to_tts(tts, accumulated_text, sentence_span)
+                    accumulated_text = ""  # Reset accumulator
+                    sentence_span = None
+        
+        # Send any remaining text to TTS
+        if enable_tts and accumulated_text:
+            sentence_span.set(chars=len(accumulated_text))
+            sentence_span.end()
+            await self.send_to_tts(tts, accumulated_text, sentence_span)
+
+    async def receive(self, text_data=None, bytes_data=None):
         """Handle incoming WebSocket messages."""
         try:
             data = json.loads(text_data)
+        except (TypeError, ValueError):
+            data = None
+        # Binary frames (text_data is None) and non-object payloads are rejected too
+        if not isinstance(data, dict):
+            await self.send(json.dumps({
+                'error': 'Invalid JSON format'
+            }))
+            return
+        # A client supplied trace_id ties this message to the client's own trace;
+        # the request deadline starts now and covers every provider call it makes
+        with TRACER.span('ws.receive', trace_id=data.get('trace_id'), consumer=type(self).__name__) as span, \
+                deadline_scope():
+            await self.handle_message(data, span)
+
+    async def handle_message(self, data, span):
+        try:
             message = data.get('message')
             provider_id = data.get('provider_id')
             system_prompt = data.get('system_prompt')
             conversation_id = data.get('conversation_id')
             stream = data.get('stream', True)  # Default to streaming for WebSocket
-            enable_tts = data.get('enable_tts', True)  # New parameter for TTS
+            # Replies are spoken by the TTS socket whose session the client passes along
+            tts = tts_group(data.get('tts_session')) if data.get('enable_tts', True) else None
+            hedge = data.get('hedge')  # None keeps the provider's hedging setting
+            span.set(stream=stream, enable_tts=tts is not None)
 
             if not message:
                 await self.send(json.dumps({
@@ -54,7 +133,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
             # Get provider and initialize chat service
             provider = await self.get_provider(provider_id)
-            chat_service = ChatService(provider)
+            chat_service = ChatService(provider, hedge=hedge)
 
             chat_params = {
                 'message': message,
@@ -63,83 +142,50 @@ class ChatConsumer(AsyncWebsocketConsumer):
             }
 
             if stream:
-                # Stream the response
-                accumulated_text = ""  # Accumulate text for TTS
-                async for chunk in chat_service.chat_stream(**chat_params):
-                    if chunk:
-                        accumulated_text += chunk
-                        await self.send(json.dumps({
-                            'type': 'chat.message',
-                            'chunk': chunk
-                        }))
-                        
-                        # Send to TTS if enabled and we have a complete sentence
-                        if enable_tts and any(char in accumulated_text for char in '!.?'):
-                            # Send accumulated text to audio group
-                            channel_layer = get_channel_layer()
-                            print(f"SENDIG to TTS: {accumulated_text}")
-                            await channel_layer.group_send(
-                                "audio_group",
-                                {
-                                    "type": "tts.text",
-                                    "text": accumulated_text
-                                }
-                            )
-                            accumulated_text = ""  # Reset accumulator
-                
-                # Send any remaining text to TTS
-                if enable_tts and accumulated_text:
-                    channel_layer = get_channel_layer()
-                    
-                    await channel_layer.group_send(
-                        "audio_group",
-                        {
-                            "type": "tts.text",
-                            "text": accumulated_text
-                        }
-                    )
+                await self.stream_reply(chat_service.chat_stream(**chat_params), tts)
                 
                 # Send completion messages
                 await self.send(json.dumps({
-                    'type': 'chat.complete'
+                    'type': 'chat.complete',
+                    'dropped_turns': chat_service.dropped_turns,
+                    'trace_id': span.trace_id
                 }))
-                if enable_tts:
-                    await channel_layer.group_send(
-                        "audio_group",
+                if tts:
+                    await get_channel_layer().group_send(
+                        tts,
                         {
-                            "type": "tts.complete"
+                            "type": "tts.complete",
+                            **span.context()
                         }
                     )
             else:
                 # Send complete response at once
                 response = await chat_service.chat(**chat_params)
+                served = response['provider']
                 response_data = {
                     'type': 'chat.message',
                     'provider': {
-                        'id': provider.id,
-                        'name': provider.name,
-                        'model': provider.model_name
+                        'id': served.id,
+                        'name': served.name,
+                        'model': served.model_name
                     },
                     'conversation_id': response['conversation_id'],
                     'reply': response['reply'],
-                    'usage': response['usage']
+                    'usage': response['usage'],
+                    'dropped_turns': response['dropped_turns'],
+                    'cached': response['cached'],
+                    'trace_id': span.trace_id
                 }
                 await self.send(json.dumps(response_data))
                 
                 # Send to TTS if enabled
-                if enable_tts:
-                    channel_layer = get_channel_layer()
-                    await channel_layer.group_send(
-                        "audio_group",
-                        {
-                            "type": "tts.text",
-                            "text": response['reply']
-                        }
-                    )
-                    await channel_layer.group_send(
-                        "audio_group",
+                if tts:
+                    await self.send_to_tts(tts, response['reply'], span)
+                    await get_channel_layer().group_send(
+                        tts,
                         {
-                            "type": "tts.complete"
+                            "type": "tts.complete",
+                            **span.context()
                         }
                     )
 
@@ -148,6 +194,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 'error': str(e)
             }))
         except Exception as e:
+            span.end(e)
             await self.send(json.dumps({
                 'error': f'An unexpected error occurred: {str(e)}'
-            })) 
\ No newline at end of file
+            }))
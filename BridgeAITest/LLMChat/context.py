@@ -0,0 +1,84 @@
+"""Token-budgeted context window for conversation history."""
+import logging
+from typing import List, NamedTuple, Sequence
+
+from langchain_core.messages import BaseMessage
+
+logger = logging.getLogger(__name__)
+
+# Used when neither extra_settings['context_window'] nor the table below applies
+DEFAULT_CONTEXT_WINDOW = 4096
+
+# Context sizes of common models, matched by model name prefix (longest wins)
+MODEL_CONTEXT_WINDOWS = {
+    'gpt-4o': 128000,
+    'gpt-4-turbo': 128000,
+    'gpt-4.1': 1047576,
+    'gpt-4': 8192,
+    'gpt-3.5-turbo': 16385,
+    'o1': 200000,
+    'o3': 200000,
+    'claude': 200000,
+    'command-r': 128000,
+    'command': 4096,
+    'gemini-1.5': 1048576,
+    'gemini-2': 1048576,
+    'gemini': 32768,
+}
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap, provider-independent token estimate (about four characters per token)."""
+    return (len(text) + 3) // 4 if text else 0
+
+
+def turn_tokens(user_message: str, ai_response: str) -> int:
+    """Token count stored on each ChatLog row for context trimming."""
+    return estimate_tokens(user_message) + estimate_tokens(ai_response)
+
+
+def context_window_size(provider) -> int:
+    """Return the context size of the provider's model."""
+    configured = (provider.extra_settings or {}).get('context_window')
+    if configured:
+        return int(configured)
+    model_name = (provider.model_name or '').lower()
+    matches = [prefix for prefix in MODEL_CONTEXT_WINDOWS if model_name.startswith(prefix)]
+    if matches:
+        return MODEL_CONTEXT_WINDOWS[max(matches, key=len)]
+    return DEFAULT_CONTEXT_WINDOW
+
+
+def history_budget(provider, system_prompt: str, message: str) -> int:
+    """Tokens left for history once the prompt, new message and completion are reserved."""
+    reserved = provider.max_tokens + estimate_tokens(system_prompt) + estimate_tokens(message)
+    return max(0, context_window_size(provider) - reserved)
+
+
+class ContextWindow(NamedTuple):
+    """History messages that fit the budget, plus what was left out."""
+    messages: List[BaseMessage]
+    history_tokens: int
+    dropped_turns: int
+
+
+def build_context_window(turns: Sequence, budget: int) -> ContextWindow:
+    """Keep the newest turns whose summed token counts fit in ``budget``.
+
+    ``turns`` are oldest first and carry ``user``, ``ai`` and ``tokens``.
+    """
+    used = 0
+    kept = 0
+    for turn in reversed(turns):
+        if used + turn.tokens > budget:
+            break
+        used += turn.tokens
+        kept += 1
+
+    messages = []
+    for turn in turns[len(turns) - kept:]:
+        messages.extend([turn.user, turn.ai])
+    dropped = len(turns) - kept
+    if dropped:
+        logger.info(f"Context window dropped {dropped} of {len(turns)} turns (budget {budget} tokens)")
+    return ContextWindow(messages, used, dropped)
@@ -0,0 +1,22 @@
+"""Database access for the async LLMChat code paths.
+
+``sync_to_async`` (and Django's own ``aget``/``acreate``, which wrap it) is
+thread sensitive by default, so every query issued by every open WebSocket
+chat runs on the same single thread. LLMChat queries are independent of the
+request thread, so they run on a dedicated, explicitly sized pool instead.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+
+# Each worker thread holds its own database connection
+DB_EXECUTOR = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'LLMCHAT_DB_THREADS', 8),
+    thread_name_prefix='llmchat-db',
+)
+
+
+def db_sync_to_async(func):
+    """Wrap a blocking ORM callable so it runs on the LLMChat database pool."""
+    return DatabaseSyncToAsync(func, thread_sensitive=False, executor=DB_EXECUTOR)
@@ -0,0 +1,246 @@
+"""Request deadlines, provider call timeouts and retries with backoff.
+
+A deadline starts when a WebSocket message or HTTP chat request arrives and
+is carried in a context variable, so everything the request awaits
+(including tasks it starts, such as shared flights and hedges) sees how
+much time is left. Provider calls are bounded by their own timeouts and by
+that remaining time, and failed calls are only retried while it lasts.
+"""
+import asyncio
+import contextvars
+import itertools
+import logging
+import random
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Awaitable, Callable, Iterator, NamedTuple, Optional, TypeVar
+
+import httpx
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+MIN_ATTEMPT_SECONDS = 1.0  # A retry is only worth it with this much time left after its backoff
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a request has no time left for what it is waiting on."""
+
+
+class ProviderTimeout(Exception):
+    """Raised when a provider call hit its first-token, inter-token or call timeout."""
+
+
+class Deadline:
+    """The moment a request has to be answered by."""
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.at - time.monotonic())
+
+    def expired(self) -> bool:
+        return time.monotonic() >= self.at
+
+
+_deadline: contextvars.ContextVar[Optional[Deadline]] = contextvars.ContextVar('llmchat_deadline', default=None)
+
+
+@contextmanager
+def deadline_scope(seconds: Optional[float] = None) -> Iterator[Optional[Deadline]]:
+    """Run the block under a deadline ``seconds`` from now (default LLMCHAT_REQUEST_DEADLINE).
+
+    An enclosing deadline that ends earlier stays in force; ``0`` or
+    ``None`` in the setting means no deadline.
+    """
+    if seconds is None:
+        seconds = getattr(settings, 'LLMCHAT_REQUEST_DEADLINE', 120.0)
+    deadline = Deadline(seconds) if seconds else None
+    outer = _deadline.get()
+    if outer is not None and (deadline is None or outer.at <= deadline.at):
+        deadline = outer
+    token = _deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _deadline.reset(token)
+
+
+def current_deadline() -> Optional[Deadline]:
+    return _deadline.get()
+
+
+def time_left(timeout: Optional[float] = None) -> Optional[float]:
+    """``timeout`` capped by the time the current request has left.
+
+    Raises DeadlineExceeded once the deadline has passed; ``None`` means
+    no limit at all.
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return timeout
+    remaining = deadline.remaining()
+    if remaining <= 0:
+        raise DeadlineExceeded(f"Request deadline of {deadline.seconds:g}s exceeded")
+    return remaining if timeout is None else min(timeout, remaining)
+
+
+@asynccontextmanager
+async def within(timeout: Optional[float], what: str):
+    """Bound the block by ``timeout`` and the request deadline.
+
+    Raises ProviderTimeout (``what`` says what did not happen in time) or,
+    if it was the deadline that ran out, DeadlineExceeded.
+    """
+    limit = time_left(timeout)
+    try:
+        async with asyncio.timeout(limit):
+            yield
+    except TimeoutError:
+        deadline = _deadline.get()
+        if deadline is not None and deadline.expired():
+            raise DeadlineExceeded(f"Request deadline of {deadline.seconds:g}s exceeded ({what})") from None
+        raise ProviderTimeout(f"{what} within {limit:.1f}s") from None
+
+
+class StreamWatchdog:
+    """Waits for the chunks of one stream, cutting it when it stalls or outlasts the deadline.
+
+    ``await watchdog.next(stream)`` raises ProviderTimeout once the next
+    chunk takes longer than ``timeout`` seconds, and DeadlineExceeded once
+    the request deadline passes. An asyncio timeout per chunk would
+    schedule and cancel a timer for every token; this keeps one timer for
+    the whole stream and only re-arms it when it fires early. Create it in
+    the task that reads the stream and ``close()`` it when done.
+    """
+
+    def __init__(self, timeout: Optional[float], what: str):
+        self.timeout = timeout
+        self.what = what
+        self.deadline = _deadline.get()
+        self.loop = asyncio.get_running_loop()
+        self.task = asyncio.current_task()
+        self._waiting_since = None
+        self._handle = None
+        self._fired = None
+
+    def _due(self) -> Optional[float]:
+        # The loop's clock is time.monotonic(), like the deadline's
+        due = None if self.timeout is None else self._waiting_since + self.timeout
+        if self.deadline is not None:
+            due = self.deadline.at if due is None else min(due, self.deadline.at)
+        return due
+
+    def _check(self) -> None:
+        self._handle = None
+        if self._waiting_since is None:
+            return  # Re-armed by the next wait
+        due = self._due()
+        if due > self.loop.time():
+            self._handle = self.loop.call_at(due, self._check)
+        elif self.deadline is not None and self.deadline.expired():
+            self._fired = DeadlineExceeded(f"Request deadline of {self.deadline.seconds:g}s exceeded ({self.what})")
+            self.task.cancel()
+        else:
+            self._fired = ProviderTimeout(f"{self.what} within {self.timeout:.1f}s")
+            self.task.cancel()
+
+    async def next(self, stream):
+        """The stream's next chunk, or ``None`` at its end."""
+        time_left()
+        self._waiting_since = self.loop.time()
+        if self._handle is None:
+            due = self._due()
+            if due is not None:
+                self._handle = self.loop.call_at(due, self._check)
+        try:
+            return await anext(stream, None)
+        except asyncio.CancelledError:
+            if self._fired is not None and self.task.uncancel() == 0:
+                raise self._fired from None
+            raise
+        finally:
+            self._waiting_since = None
+
+    def close(self) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+
+class CallTimeouts(NamedTuple):
+    """Per provider call timeouts, in seconds (``None``: only the deadline applies)."""
+    first_token: Optional[float]  # until a stream's first chunk
+    inter_token: Optional[float]  # between two chunks of a stream
+    call: Optional[float]  # for a whole non-streamed call
+
+
+def call_timeouts(provider) -> CallTimeouts:
+    """Timeouts from ``extra_settings``, falling back to the LLMCHAT_*_TIMEOUT settings.
+
+    Connect timeouts are applied by the shared HTTP pools (LLMCHAT_CONNECT_TIMEOUT).
+    """
+    extra = provider.extra_settings or {}
+    return CallTimeouts(
+        first_token=extra.get('first_token_timeout', getattr(settings, 'LLMCHAT_FIRST_TOKEN_TIMEOUT', 30.0)),
+        inter_token=extra.get('inter_token_timeout', getattr(settings, 'LLMCHAT_INTER_TOKEN_TIMEOUT', 15.0)),
+        call=extra.get('call_timeout', getattr(settings, 'LLMCHAT_CALL_TIMEOUT', 60.0)),
+    )
+
+
+class RetryPolicy(NamedTuple):
+    retries: int
+    backoff: float
+    backoff_max: float
+
+    def delay(self, retry: int) -> float:
+        """Exponential backoff with full jitter, so retrying callers spread out."""
+        return random.uniform(0, min(self.backoff_max, self.backoff * 2 ** retry))
+
+
+def retry_policy(provider) -> RetryPolicy:
+    extra = provider.extra_settings or {}
+    return RetryPolicy(
+        retries=extra.get('retries', getattr(settings, 'LLMCHAT_RETRIES', 2)),
+        backoff=extra.get('retry_backoff', getattr(settings, 'LLMCHAT_RETRY_BACKOFF', 0.5)),
+        backoff_max=extra.get('retry_backoff_max', getattr(settings, 'LLMCHAT_RETRY_BACKOFF_MAX', 8.0)),
+    )
+
+
+def retryable(error: BaseException) -> bool:
+    """Whether a failed call may succeed if sent again: timeouts, connection errors, 408/409/429 and 5xx.
+
+    SDK errors wrap the transport error they were raised from, so the
+    chain of causes is checked too.
+    """
+    while error is not None:
+        if isinstance(error, (ProviderTimeout, httpx.TransportError, ConnectionError, TimeoutError)):
+            return True
+        status = getattr(error, 'status_code', None)
+        if status is None:
+            status = getattr(getattr(error, 'response', None), 'status_code', None)
+        if isinstance(status, int):
+            return status in (408, 409, 429) or status >= 500
+        error = error.__cause__
+    return False
+
+
+async def with_retries(provider, attempt: Callable[[], Awaitable[T]]) -> T:
+    """Await ``attempt()``, retrying retryable failures with backoff while the deadline allows."""
+    policy = retry_policy(provider)
+    for retry in itertools.count():
+        try:
+            return await attempt()
+        except Exception as e:
+            if retry >= policy.retries or not retryable(e):
+                raise
+            delay = policy.delay(retry)
+            deadline = _deadline.get()
+            if deadline is not None and deadline.remaining() < delay + MIN_ATTEMPT_SECONDS:
+                raise
+            logger.warning(f"Provider {provider.name} failed ({str(e)}), retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
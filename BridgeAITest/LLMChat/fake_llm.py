@@ -0,0 +1,134 @@
+"""Deterministic local chat model that streams like OpenAI, for load tests."""
+import asyncio
+import hashlib
+import random
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from .context import estimate_tokens
+from .llm_providers import LLMProviderStrategy
+
+WORDS = (
+    'the', 'model', 'answer', 'is', 'a', 'simple', 'response', 'with', 'some', 'words', 'that',
+    'stream', 'at', 'steady', 'rate', 'for', 'testing', 'load', 'and', 'latency', 'of', 'chat',
+)
+SENTENCE_WORDS = 12  # Tokens per sentence, so sentence splitting (TTS) gets exercised
+
+
+class FakeStreamingChatModel(BaseChatModel):
+    """Answers after ``ttft`` seconds, then emits ``tokens_per_second`` tokens.
+
+    The reply depends only on the prompt, so runs are reproducible. Every
+    token is one word with a leading space, like OpenAI stream deltas, and
+    the last streamed chunk carries the usage (as with ``include_usage``).
+    """
+
+    ttft: float = 0.2
+    tokens_per_second: float = 50.0
+    reply_tokens: int = 64
+    model_name: str = 'fake'
+
+    @property
+    def _llm_type(self) -> str:
+        return 'fake-streaming'
+
+    def bind_tools(self, tools, **kwargs):
+        # Tools are never called; accept them so tool-enabled setups still load
+        return self
+
+    def _tokens(self, messages: List[BaseMessage]) -> List[str]:
+        seed = hashlib.sha256("".join(str(m.content) for m in messages).encode('utf-8')).digest()
+        rng = random.Random(seed)
+        tokens = []
+        for index in range(self.reply_tokens):
+            word = rng.choice(WORDS)
+            if index % SENTENCE_WORDS == SENTENCE_WORDS - 1 or index == self.reply_tokens - 1:
+                word += '.'
+            tokens.append(' ' + word if index else word.capitalize())
+        return tokens
+
+    def _usage(self, messages: List[BaseMessage], output_tokens: int) -> Dict[str, int]:
+        input_tokens = sum(estimate_tokens(str(m.content)) for m in messages)
+        return {
+            'input_tokens': input_tokens,
+            'output_tokens': output_tokens,
+            'total_tokens': input_tokens + output_tokens,
+        }
+
+    def _deadline(self, started: float, index: int) -> float:
+        """When token ``index`` is due; tokens follow a fixed schedule so sleeps don't drift."""
+        return started + self.ttft + index / self.tokens_per_second
+
+    def _result(self, messages: List[BaseMessage]) -> ChatResult:
+        tokens = self._tokens(messages)
+        usage = self._usage(messages, len(tokens))
+        message = AIMessage(
+            content="".join(tokens),
+            usage_metadata=usage,
+            response_metadata={'token_usage': {
+                'prompt_tokens': usage['input_tokens'],
+                'completion_tokens': usage['output_tokens'],
+                'total_tokens': usage['total_tokens'],
+            }, 'model_name': self.model_name},
+        )
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager=None, **kwargs: Any) -> ChatResult:
+        time.sleep(self._deadline(0.0, self.reply_tokens))
+        return self._result(messages)
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager=None, **kwargs: Any) -> ChatResult:
+        await asyncio.sleep(self._deadline(0.0, self.reply_tokens))
+        return self._result(messages)
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager=None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        started = time.monotonic()
+        tokens = self._tokens(messages)
+        for index, token in enumerate(tokens):
+            time.sleep(max(0.0, self._deadline(started, index) - time.monotonic()))
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+        yield ChatGenerationChunk(message=AIMessageChunk(content='', usage_metadata=self._usage(messages, len(tokens))))
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager=None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        started = time.monotonic()
+        tokens = self._tokens(messages)
+        for index, token in enumerate(tokens):
+            await asyncio.sleep(max(0.0, self._deadline(started, index) - time.monotonic()))
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+        yield ChatGenerationChunk(message=AIMessageChunk(content='', usage_metadata=self._usage(messages, len(tokens))))
+
+
+class FakeStrategy(LLMProviderStrategy):
+    """Local fake model for load tests.
+
+    Never registered by the app itself; ``llmchat_loadtest`` registers it
+    as the ``fake`` provider type in its own process only.
+
+    ``extra_settings`` may set ``ttft`` (seconds) and ``tokens_per_second``;
+    replies are ``max_tokens`` long.
+    """
+
+    def create_chat_model(self, config: Dict[str, Any]) -> BaseChatModel:
+        extra = config.get('extra_settings') or {}
+        return FakeStreamingChatModel(
+            model_name=config['model_name'],
+            reply_tokens=config['max_tokens'],
+            ttft=extra.get('ttft', 0.2),
+            tokens_per_second=extra.get('tokens_per_second', 50.0),
+        )
+
+    def get_token_usage(self, response: Any) -> Dict[str, int]:
+        usage = response.usage_metadata or {}
+        return {
+            'input_tokens': usage.get('input_tokens', 0),
+            'output_tokens': usage.get('output_tokens', 0),
+            'total_tokens': usage.get('total_tokens', 0)
+        }
@@ -0,0 +1,109 @@
+"""In-memory cache of conversation histories."""
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional
+
+from django.conf import settings
+from langchain_core.messages import AIMessage, HumanMessage
+
+logger = logging.getLogger(__name__)
+
+
+class Turn(NamedTuple):
+    """One user/assistant exchange with its pre-computed token count."""
+    user: HumanMessage
+    ai: AIMessage
+    tokens: int
+
+    @classmethod
+    def build(cls, user_message: str, ai_response: str, tokens: int) -> 'Turn':
+        return cls(HumanMessage(content=user_message), AIMessage(content=ai_response), tokens)
+
+
+class HistoryCache:
+    """Bounded LRU cache of the turns of each conversation.
+
+    The cache holds at most ``max_messages`` messages (two per turn); the least
+    recently used conversations are evicted first. New turns are appended in
+    place when the chat service writes a ChatLog, so a cached conversation
+    never has to be re-read. The cache is per process, so only WebSocket chats
+    use it (they stay on the worker holding the socket); HTTP requests may
+    land on any worker and read the history from the database instead.
+    Edits and deletions are picked up through model signals.
+    """
+
+    def __init__(self, max_messages: int):
+        self.max_messages = max_messages
+        self._entries: 'OrderedDict[int, List[Turn]]' = OrderedDict()
+        self._size = 0
+        # conversation id -> [loaders in progress, appended while loading]
+        self._loads: Dict[int, list] = {}
+        self._lock = threading.Lock()
+
+    def get(self, conversation_id: int) -> Optional[List[Turn]]:
+        """Return a copy of the cached turns, or ``None`` on a miss."""
+        with self._lock:
+            turns = self._entries.get(conversation_id)
+            if turns is None:
+                return None
+            self._entries.move_to_end(conversation_id)
+            return list(turns)
+
+    def begin_load(self, conversation_id: int) -> None:
+        """Mark a cold load as started so concurrent appends are not lost."""
+        with self._lock:
+            self._loads.setdefault(conversation_id, [0, False])[0] += 1
+
+    def end_load(self, conversation_id: int, turns: Optional[List[Turn]]) -> None:
+        """Finish a cold load, caching ``turns`` unless a turn was appended meanwhile."""
+        with self._lock:
+            load = self._loads[conversation_id]
+            load[0] -= 1
+            if load[0] == 0:
+                del self._loads[conversation_id]
+            if turns is None or load[1] or conversation_id in self._entries:
+                return
+            self._entries[conversation_id] = list(turns)
+            self._size += 2 * len(turns)
+            self._evict()
+
+    def append(self, conversation_id: int, user_message: str, ai_response: str, tokens: int) -> None:
+        """Append a finished turn to a cached conversation."""
+        with self._lock:
+            if conversation_id in self._loads:
+                self._loads[conversation_id][1] = True
+            turns = self._entries.get(conversation_id)
+            if turns is None:
+                return
+            turns.append(Turn.build(user_message, ai_response, tokens))
+            self._size += 2
+            self._entries.move_to_end(conversation_id)
+            self._evict()
+
+    def discard(self, conversation_id: int) -> None:
+        """Forget a conversation, e.g. after its logs were edited or deleted."""
+        with self._lock:
+            if conversation_id in self._loads:
+                self._loads[conversation_id][1] = True
+            turns = self._entries.pop(conversation_id, None)
+            if turns is not None:
+                self._size -= 2 * len(turns)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _evict(self) -> None:
+        while self._size > self.max_messages and self._entries:
+            conversation_id, turns = self._entries.popitem(last=False)
+            self._size -= 2 * len(turns)
+            logger.debug(f"Evicted history of conversation {conversation_id} ({len(turns)} turns)")
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# Initialize the global history cache
+HISTORY_CACHE = HistoryCache(getattr(settings, 'LLMCHAT_HISTORY_CACHE_MESSAGES', 20000))
@@ -0,0 +1,211 @@
+"""Process-wide keep-alive HTTP connection pools shared by all provider clients."""
+import asyncio
+import importlib.util
+import logging
+import ssl
+import threading
+import weakref
+from typing import Any, Dict, Optional, Tuple
+
+import httpx
+from django.conf import settings
+
+from .monitoring import RateMeter
+
+logger = logging.getLogger(__name__)
+
+Origin = Tuple[str, str, int]
+
+
+def _origin(url: httpx.URL) -> Origin:
+    return url.scheme, url.host, url.port or (443 if url.scheme == 'https' else 80)
+
+
+class HostStats:
+    """Requests and connection setups towards one host."""
+
+    def __init__(self):
+        self.requests = 0
+        self.reused = 0  # requests sent on a kept-alive connection
+        self.connections = 0
+        self.tls_handshakes = 0
+        self.handshake_rate = RateMeter()
+
+    def record(self, connected: bool, tls: bool) -> None:
+        self.requests += 1
+        if connected:
+            self.connections += 1
+        else:
+            self.reused += 1
+        if tls:
+            self.tls_handshakes += 1
+            self.handshake_rate.mark()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'requests': self.requests,
+            'reused': self.reused,
+            'connections': self.connections,
+            'tls_handshakes': self.tls_handshakes,
+            'reuse_ratio': self.reused / self.requests if self.requests else None,
+            'handshakes_per_second': self.handshake_rate.rate(),
+        }
+
+
+class _Setup:
+    """Watches one request's trace events for a new connection and TLS handshake."""
+
+    __slots__ = ('connected', 'tls')
+
+    def __init__(self):
+        self.connected = False
+        self.tls = False
+
+    def event(self, name: str) -> None:
+        if name.startswith('connection.connect_') and name.endswith('.complete'):
+            self.connected = True
+        elif name == 'connection.start_tls.complete':
+            self.tls = True
+
+
+class PooledAsyncTransport(httpx.AsyncBaseTransport):
+    """Sends each request through the manager's pool for its host on the running event loop."""
+
+    def __init__(self, manager: 'HTTPPoolManager'):
+        self.manager = manager
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        transport = self.manager.async_transport(request.url)
+        setup = _Setup()
+        previous = request.extensions.get('trace')
+
+        async def trace(name, info):
+            setup.event(name)
+            if previous is not None:
+                await previous(name, info)
+
+        request.extensions = {**request.extensions, 'trace': trace,
+                              'timeout': self.manager.timeouts(request.extensions.get('timeout'))}
+        response = await transport.handle_async_request(request)
+        self.manager.record(request.url, setup)
+        return response
+
+    async def aclose(self) -> None:
+        pass  # The pools outlive any one client
+
+
+class PooledTransport(httpx.BaseTransport):
+    """Sends each request through the manager's thread-safe pool for its host."""
+
+    def __init__(self, manager: 'HTTPPoolManager'):
+        self.manager = manager
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        transport = self.manager.transport(request.url)
+        setup = _Setup()
+        previous = request.extensions.get('trace')
+
+        def trace(name, info):
+            setup.event(name)
+            if previous is not None:
+                previous(name, info)
+
+        request.extensions = {**request.extensions, 'trace': trace,
+                              'timeout': self.manager.timeouts(request.extensions.get('timeout'))}
+        response = transport.handle_request(request)
+        self.manager.record(request.url, setup)
+        return response
+
+    def close(self) -> None:
+        pass
+
+
+class HTTPPoolManager:
+    """Keep-alive connection pools for every host the provider clients talk to.
+
+    Each host gets its own pool with ``max_connections`` and
+    ``max_keepalive`` connections; idle ones are closed after
+    ``keepalive_expiry`` seconds. Connecting to a host gives up after
+    ``connect_timeout`` seconds, whatever the SDK asked for. HTTP/2 is negotiated when enabled and the
+    ``h2`` package is installed, multiplexing concurrent streams over one
+    connection. Async pools are kept per event loop, since a connection
+    belongs to the loop that opened it.
+
+    ``client()`` and ``async_client()`` return httpx clients for the SDKs to
+    wrap; they are cheap, and all of them share these pools.
+    """
+
+    def __init__(self, max_connections: int = 100, max_keepalive: int = 20, keepalive_expiry: float = 60.0,
+                 http2: bool = True, connect_timeout: Optional[float] = 10.0):
+        self.connect_timeout = connect_timeout
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive,
+                                   keepalive_expiry=keepalive_expiry)
+        self.http2 = http2 and importlib.util.find_spec('h2') is not None
+        self._ssl_context: Optional[ssl.SSLContext] = None
+        self._transports: Dict[Origin, httpx.HTTPTransport] = {}
+        self._async_transports: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Origin, httpx.AsyncHTTPTransport]]' = weakref.WeakKeyDictionary()
+        self._stats: Dict[str, HostStats] = {}
+        self._lock = threading.Lock()
+
+    def client(self, **kwargs) -> httpx.Client:
+        return httpx.Client(transport=PooledTransport(self), **kwargs)
+
+    def async_client(self, **kwargs) -> httpx.AsyncClient:
+        return httpx.AsyncClient(transport=PooledAsyncTransport(self), **kwargs)
+
+    def timeouts(self, timeout: Optional[Dict[str, Optional[float]]]) -> Dict[str, Optional[float]]:
+        """A request's httpx timeouts with the connect timeout capped."""
+        timeout = dict(timeout or {})
+        if self.connect_timeout is not None:
+            connect = timeout.get('connect')
+            timeout['connect'] = self.connect_timeout if connect is None else min(connect, self.connect_timeout)
+        return timeout
+
+    @property
+    def ssl_context(self) -> ssl.SSLContext:
+        # One context for all pools; building one loads the CA bundle
+        if self._ssl_context is None:
+            self._ssl_context = httpx.create_ssl_context()
+        return self._ssl_context
+
+    def transport(self, url: httpx.URL) -> httpx.HTTPTransport:
+        origin = _origin(url)
+        with self._lock:
+            transport = self._transports.get(origin)
+            if transport is None:
+                transport = self._transports[origin] = httpx.HTTPTransport(
+                    verify=self.ssl_context, http2=self.http2, limits=self.limits)
+            return transport
+
+    def async_transport(self, url: httpx.URL) -> httpx.AsyncHTTPTransport:
+        origin = _origin(url)
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            transports = self._async_transports.setdefault(loop, {})
+            transport = transports.get(origin)
+            if transport is None:
+                transport = transports[origin] = httpx.AsyncHTTPTransport(
+                    verify=self.ssl_context, http2=self.http2, limits=self.limits)
+            return transport
+
+    def record(self, url: httpx.URL, setup: _Setup) -> None:
+        with self._lock:
+            stats = self._stats.get(url.host)
+            if stats is None:
+                stats = self._stats[url.host] = HostStats()
+            stats.record(setup.connected, setup.tls)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Per host: requests, reused, connections, tls_handshakes, reuse_ratio and handshakes_per_second."""
+        with self._lock:
+            return {host: stats.snapshot() for host, stats in self._stats.items()}
+
+
+# Initialize the global HTTP pool manager
+HTTP_POOLS = HTTPPoolManager(
+    max_connections=getattr(settings, 'LLMCHAT_HTTP_MAX_CONNECTIONS', 100),
+    max_keepalive=getattr(settings, 'LLMCHAT_HTTP_MAX_KEEPALIVE', 20),
+    keepalive_expiry=getattr(settings, 'LLMCHAT_HTTP_KEEPALIVE_EXPIRY', 60.0),
+    http2=getattr(settings, 'LLMCHAT_HTTP2', True),
+    connect_timeout=getattr(settings, 'LLMCHAT_CONNECT_TIMEOUT', 10.0),
+)
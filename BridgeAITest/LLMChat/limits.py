@@ -0,0 +1,268 @@
+"""Per-provider concurrency limits and request/token rate limiting."""
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Optional
+
+from django.conf import settings
+
+from .context import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+
+class QueueTimeout(Exception):
+    """Raised when a call waited longer than its deadline for a provider slot."""
+
+
+def request_tokens(provider, messages) -> int:
+    """Tokens to reserve for a call: the estimated prompt plus the full completion budget."""
+    return sum(estimate_tokens(str(message.content)) for message in messages) + provider.max_tokens
+
+
+class TokenBucket:
+    """Refills ``capacity`` units per minute; not thread-safe on its own."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self._updated_at = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def clamp(self, amount: float) -> float:
+        # A request bigger than the whole bucket could never pass otherwise
+        return min(amount, self.capacity)
+
+    def seconds_until(self, amount: float) -> float:
+        missing = self.clamp(amount) - self.level
+        return max(0.0, missing / self.rate)
+
+
+class Permit:
+    """A granted slot; release it once the provider call (or stream) is over.
+
+    ``used_tokens`` can be set when the real usage is known, so the
+    tokens-per-minute bucket is credited back what was over-reserved.
+    """
+
+    def __init__(self, limiter: 'ProviderLimiter', tokens: float):
+        self.limiter = limiter
+        self.tokens = tokens
+        self.used_tokens: Optional[float] = None
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self.limiter._release(self)
+
+
+class _Waiter:
+    __slots__ = ('loop', 'future', 'tokens', 'granted')
+
+    def __init__(self, loop, future, tokens):
+        self.loop = loop
+        self.future = future
+        self.tokens = tokens
+        self.granted = False
+
+
+def _grant(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class ProviderLimiter:
+    """Bounds concurrent calls and the request and token rate of one provider.
+
+    Callers over a limit queue up first come, first served: nobody is let
+    through while someone queued earlier is still waiting. Waiters can live
+    on different event loops; they are woken with ``call_soon_threadsafe``.
+    """
+
+    def __init__(self, name: str, max_concurrency: Optional[int] = None,
+                 requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None,
+                 queue_timeout: Optional[float] = None):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self._queue: deque = deque()
+        self._lock = threading.Lock()
+        # Stats
+        self.granted = 0
+        self.timed_out = 0
+        self.queued = 0
+        self.max_queue_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def unlimited(self) -> bool:
+        return self.max_concurrency is None and self.requests is None and self.tokens is None
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        for bucket in (self.requests, self.tokens):
+            if bucket is not None:
+                bucket.refill(now)
+
+    def _can_take(self, tokens: float) -> bool:
+        if self.max_concurrency is not None and self.active >= self.max_concurrency:
+            return False
+        if self.requests is not None and self.requests.level < 1:
+            return False
+        if self.tokens is not None and self.tokens.level < self.tokens.clamp(tokens):
+            return False
+        return True
+
+    def _take(self, tokens: float) -> None:
+        self.active += 1
+        if self.requests is not None:
+            self.requests.level -= 1
+        if self.tokens is not None:
+            self.tokens.level -= self.tokens.clamp(tokens)
+
+    def _retry_after(self, tokens: float) -> Optional[float]:
+        """Seconds until the buckets could cover ``tokens``; ``None`` if only a release can help."""
+        waits = [bucket.seconds_until(amount) for bucket, amount in ((self.requests, 1), (self.tokens, tokens))
+                 if bucket is not None]
+        wait = max(waits, default=0.0)
+        return wait if wait > 0 else None
+
+    def _dispatch(self) -> None:
+        """Grant queued waiters in order while the limits allow (lock held)."""
+        self._refill()
+        while self._queue and self._can_take(self._queue[0].tokens):
+            waiter = self._queue.popleft()
+            self._take(waiter.tokens)
+            waiter.granted = True
+            waiter.loop.call_soon_threadsafe(_grant, waiter.future)
+
+    def _record_wait(self, waited: float) -> None:
+        self.granted += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+
+    async def acquire(self, tokens: float = 0, timeout: Optional[float] = None) -> Permit:
+        """Wait for a slot; raises ``QueueTimeout`` once ``timeout`` (or ``queue_timeout``) has passed."""
+        started = time.monotonic()
+        timeout = self.queue_timeout if timeout is None else timeout
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self._refill()
+            if not self._queue and self._can_take(tokens):
+                self._take(tokens)
+                self._record_wait(0.0)
+                return Permit(self, tokens)
+            waiter = _Waiter(loop, loop.create_future(), tokens)
+            self._queue.append(waiter)
+            self.queued += 1
+            self.max_queue_depth = max(self.max_queue_depth, len(self._queue))
+
+        try:
+            while not waiter.granted:
+                with self._lock:
+                    retry_after = self._retry_after(tokens) if self._queue and self._queue[0] is waiter else None
+                wait = retry_after
+                if timeout is not None:
+                    remaining = started + timeout - time.monotonic()
+                    if remaining <= 0:
+                        raise QueueTimeout(f"Waited {timeout:.1f}s for a slot on provider {self.name}")
+                    wait = remaining if wait is None else min(wait, remaining)
+                await asyncio.wait({waiter.future}, timeout=wait)
+                if not waiter.granted:
+                    # Woken by the clock: the buckets may have refilled meanwhile
+                    with self._lock:
+                        self._dispatch()
+        except BaseException as e:
+            with self._lock:
+                if waiter.granted:
+                    # Granted while we were giving up; hand the slot to the next caller
+                    self._give_back(waiter.tokens, None)
+                else:
+                    self._queue.remove(waiter)
+                if isinstance(e, QueueTimeout):
+                    self.timed_out += 1
+                self._dispatch()
+            raise
+
+        with self._lock:
+            self._record_wait(time.monotonic() - started)
+        return Permit(self, tokens)
+
+    def _give_back(self, tokens: float, used_tokens: Optional[float]) -> None:
+        self.active -= 1
+        if self.tokens is not None and used_tokens is not None:
+            self.tokens.level = min(self.tokens.capacity, self.tokens.level + self.tokens.clamp(tokens) - used_tokens)
+
+    def _release(self, permit: Permit) -> None:
+        with self._lock:
+            self._give_back(permit.tokens, permit.used_tokens)
+            self._dispatch()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'active': self.active,
+                'queue_depth': len(self._queue),
+                'max_queue_depth': self.max_queue_depth,
+                'queued': self.queued,
+                'granted': self.granted,
+                'timed_out': self.timed_out,
+                'total_wait': self.total_wait,
+                'avg_wait': self.total_wait / self.granted if self.granted else 0.0,
+                'max_wait': self.max_wait,
+            }
+
+
+class ProviderLimiterRegistry:
+    """One limiter per provider, configured from ``extra_settings``.
+
+    ``max_concurrency``, ``requests_per_minute`` and ``tokens_per_minute`` are
+    off unless set; ``queue_timeout`` falls back to LLMCHAT_QUEUE_TIMEOUT.
+    """
+
+    def __init__(self):
+        self._limiters: Dict[int, ProviderLimiter] = {}
+        self._lock = threading.Lock()
+
+    def get(self, provider) -> ProviderLimiter:
+        with self._lock:
+            limiter = self._limiters.get(provider.id)
+            if limiter is None:
+                extra = provider.extra_settings or {}
+                limiter = ProviderLimiter(
+                    provider.name,
+                    max_concurrency=extra.get('max_concurrency'),
+                    requests_per_minute=extra.get('requests_per_minute'),
+                    tokens_per_minute=extra.get('tokens_per_minute'),
+                    queue_timeout=extra.get('queue_timeout', getattr(settings, 'LLMCHAT_QUEUE_TIMEOUT', 30.0)),
+                )
+                self._limiters[provider.id] = limiter
+            return limiter
+
+    def reset(self, provider_id: Optional[int] = None) -> None:
+        """Drop limiter state, e.g. after a provider was reconfigured."""
+        with self._lock:
+            if provider_id is None:
+                self._limiters.clear()
+            else:
+                self._limiters.pop(provider_id, None)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            limiters = list(self._limiters.values())
+        return {limiter.name: limiter.stats() for limiter in limiters}
+
+
+# Initialize the global provider limiters
+LIMITS = ProviderLimiterRegistry()
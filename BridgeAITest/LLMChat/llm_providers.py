@@ -1,5 +1,7 @@
+import logging
 from abc import ABC, abstractmethod
-from typing import Dict, Any
+from django.conf import settings
+from typing import Dict, Any, Optional, Sequence
 from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_cohere import ChatCohere
 from langchain_huggingface import HuggingFaceEndpoint
@@ -9,7 +11,11 @@ from langchain_community.chat_models import (
 )
 from langchain_openai import AzureChatOpenAI
 from langchain_google_genai import ChatGoogleGenerativeAI
-from asgiref.sync import sync_to_async
+from .http_pool import HTTP_POOLS
+from .local_llm import DEFAULT_CONTEXT_WINDOW, ChatLlamaCpp
+from .native_stream import AnthropicStreamClient, OpenAIStreamClient, native_streaming
+
+logger = logging.getLogger(__name__)
 
 class LLMProviderStrategy(ABC):
     """Abstract base class for LLM provider strategies."""
@@ -24,6 +30,33 @@ class LLMProviderStrategy(ABC):
         """Extract token usage from the model's response."""
         pass
 
+    def get_stream_usage(self, chunks: Sequence[Any]) -> Optional[Dict[str, int]]:
+        """Extract token usage from streamed chunks, or ``None`` if the provider sent none.
+
+        LangChain reports streaming usage in the chunks' ``usage_metadata``;
+        some providers split it over several chunks (e.g. input tokens first,
+        output tokens last), so the counts are summed.
+        """
+        usage = None
+        for chunk in chunks:
+            metadata = getattr(chunk, 'usage_metadata', None)
+            if not metadata:
+                continue
+            usage = usage or {'input_tokens': 0, 'output_tokens': 0, 'total_tokens': 0}
+            for key in usage:
+                usage[key] += metadata.get(key, 0) or 0
+        if usage and not usage['total_tokens']:
+            usage['total_tokens'] = usage['input_tokens'] + usage['output_tokens']
+        return usage
+
+    def create_stream_client(self, config: Dict[str, Any]) -> Optional[Any]:
+        """A client streaming straight from the provider's API, or ``None`` to stream through the chat model.
+
+        Its ``astream(messages)`` yields chunks with ``content`` and
+        ``usage_metadata`` like the chat model's, without tool support.
+        """
+        return None
+
 class OpenAIStrategy(LLMProviderStrategy):
     def create_chat_model(self, config: Dict[str, Any]) -> BaseChatModel:
         return ChatOpenAI(
@@ -34,12 +67,12 @@ class OpenAIStrategy(LLMProviderStrategy):
             openai_api_key=config['api_key'],
         )
 
+    def create_stream_client(self, config: Dict[str, Any]) -> Optional[Any]:
+        return OpenAIStreamClient(config) if native_streaming(config) else None
+
     def get_token_usage(self, response: Any) -> Dict[str, int]:
-        print(response)
         usage = response.response_metadata.get('token_usage')
-        print("----------------     ")
-        print(usage)
-        print("----------------     ")
+        logger.debug(f"OpenAI token usage: {usage}")
         return {
             'input_tokens': usage.get('prompt_tokens', 0),
             'output_tokens': usage.get('completion_tokens', 0),
@@ -55,6 +88,9 @@ class AnthropicStrategy(LLMProviderStrategy):
             anthropic_api_key=config['api_key'],
         )
 
+    def create_stream_client(self, config: Dict[str, Any]) -> Optional[Any]:
+        return AnthropicStreamClient(config) if native_streaming(config) else None
+
     def get_token_usage(self, response: Any) -> Dict[str, int]:
         # Anthropic provides usage in response headers
         usage = response.usage
@@ -85,9 +121,6 @@ class CohereStrategy(LLMProviderStrategy):
 class HuggingFaceStrategy(LLMProviderStrategy):
     
     def create_chat_model(self, config: Dict[str, Any]) -> BaseChatModel:
-        print("----------------     ")
-        print(config)
-        print("----------------     ")
         llm = HuggingFaceEndpoint(
                 repo_id=config['extra_settings'].get('api_base'),
                 task="text-generation",
@@ -98,9 +131,6 @@ class HuggingFaceStrategy(LLMProviderStrategy):
         return llm
 
     def get_token_usage(self, response: Any) -> Dict[str, int]:
-        print("----------------     ")
-        print(response)
-        print("----------------     ")
         text = response.content
         estimated_tokens = len(text.split()) * 1.3  # rough estimate
         return {
@@ -118,6 +148,9 @@ class AzureOpenAIStrategy(LLMProviderStrategy):
             azure_endpoint=config['extra_settings']['api_base'],
             azure_api_key=config['api_key'],
             api_version=config['extra_settings'].get('api_version', '2023-05-15'),
+            max_retries=0,  # ChatService retries within the request deadline
+            http_client=HTTP_POOLS.client(),
+            http_async_client=HTTP_POOLS.async_client(),
         )
 
     def get_token_usage(self, response: Any) -> Dict[str, int]:
@@ -145,6 +178,100 @@ class GoogleStrategy(LLMProviderStrategy):
             'total_tokens': usage.get('total_tokens', 0)
         }
 
+class LlamaCppStrategy(LLMProviderStrategy):
+    """GGUF model run in-process by llama.cpp.
+
+    ``extra_settings`` holds ``model_path`` and optionally ``context_window``
+    (the llama.cpp context size, per sequence), ``n_threads``,
+    ``n_gpu_layers``, ``chat_format``, ``max_batch`` (concurrent requests
+    decoded together, LLMCHAT_LOCAL_MAX_BATCH by default; 1 keeps batching off)
+    and ``prompt_cache`` (with batching, keep each conversation's evaluated
+    prompt between turns, LLMCHAT_PROMPT_STATE_CACHE by default).
+    """
+
+    def create_chat_model(self, config: Dict[str, Any]) -> BaseChatModel:
+        extra = config.get('extra_settings') or {}
+        return ChatLlamaCpp(
+            model_path=extra['model_path'],
+            model_name=config['model_name'],
+            temperature=config['temperature'],
+            max_tokens=config['max_tokens'],
+            top_p=config['top_p'],
+            n_ctx=int(extra.get('context_window', DEFAULT_CONTEXT_WINDOW)),
+            n_threads=extra.get('n_threads'),
+            n_gpu_layers=extra.get('n_gpu_layers', 0),
+            chat_format=extra.get('chat_format'),
+            max_batch=int(extra.get('max_batch', getattr(settings, 'LLMCHAT_LOCAL_MAX_BATCH', 1))),
+            prompt_cache=bool(extra.get('prompt_cache', getattr(settings, 'LLMCHAT_PROMPT_STATE_CACHE', True))),
+        )
+
+    def get_token_usage(self, response: Any) -> Dict[str, int]:
+        usage = response.usage_metadata or {}
+        return {
+            'input_tokens': usage.get('input_tokens', 0),
+            'output_tokens': usage.get('output_tokens', 0),
+            'total_tokens': usage.get('total_tokens', 0)
+        }
+
+def provider_config(provider) -> Dict[str, Any]:
+    """The config dict strategies build their chat model from."""
+    return {
+        'model_name': provider.model_name,
+        'temperature': provider.temperature,
+        'max_tokens': provider.max_tokens,
+        'top_p': provider.top_p,
+        'api_key': provider.api_key,
+        'extra_settings': provider.extra_settings or {},
+    }
+
+def _secret(value) -> Optional[str]:
+    return value.get_secret_value() if hasattr(value, 'get_secret_value') else value
+
+def use_shared_http_pools(llm):
+    """Rebuild a chat model's SDK clients on the process-wide HTTP pools.
+
+    The OpenAI, Anthropic and Cohere chat models create their SDK clients,
+    each with a private connection pool, while validating; this swaps them
+    for clients sending through HTTP_POOLS, so every model shares warm
+    connections to its provider. The SDKs' own retries are turned off:
+    ChatService retries with backoff while the request deadline allows.
+    Other models are returned unchanged.
+    """
+    if isinstance(llm, ChatOpenAI):
+        import openai
+        params = {
+            'api_key': _secret(llm.openai_api_key),
+            'organization': llm.openai_organization,
+            'base_url': llm.openai_api_base,
+            'timeout': llm.request_timeout,
+            'max_retries': 0,
+            'default_headers': llm.default_headers,
+            'default_query': llm.default_query,
+        }
+        llm.client = openai.OpenAI(**params, http_client=HTTP_POOLS.client()).chat.completions
+        llm.async_client = openai.AsyncOpenAI(**params, http_client=HTTP_POOLS.async_client()).chat.completions
+    elif isinstance(llm, ChatAnthropic):
+        import anthropic
+        params = {
+            'base_url': llm.anthropic_api_url,
+            'api_key': _secret(llm.anthropic_api_key),
+            'timeout': llm.default_request_timeout,
+            'max_retries': 0,
+        }
+        llm.client = anthropic.Anthropic(**params, http_client=HTTP_POOLS.client())
+        llm.async_client = anthropic.AsyncAnthropic(**params, http_client=HTTP_POOLS.async_client())
+    elif isinstance(llm, ChatCohere):
+        import cohere
+        params = {
+            'api_key': _secret(llm.cohere_api_key),
+            'client_name': llm.user_agent,
+            'timeout': llm.timeout_seconds,
+            'base_url': llm.base_url,
+        }
+        llm.client = cohere.Client(**params, httpx_client=HTTP_POOLS.client())
+        llm.async_client = cohere.AsyncClient(**params, httpx_client=HTTP_POOLS.async_client())
+    return llm
+
 class LLMProviderFactory:
     """Factory class for creating LLM provider strategies."""
     
@@ -155,19 +282,19 @@ class LLMProviderFactory:
         'huggingface': HuggingFaceStrategy(),
         'azure_openai': AzureOpenAIStrategy(),
         'google': GoogleStrategy(),
+        'llama_cpp': LlamaCppStrategy(),
     }
 
     @classmethod
     async def get_strategy(cls, provider: str) -> LLMProviderStrategy:
-        from .models import ModelProvider
-        get_active_provider = sync_to_async(lambda: ModelProvider.objects.filter(is_active=True).first())
-        active_provider = await get_active_provider()
+        from .registry import PROVIDER_REGISTRY
+        active_providers = await PROVIDER_REGISTRY.aactive_providers()
         
-        if not active_provider:
+        if not active_providers:
             raise ValueError("No active provider configured")
             
-        if active_provider.provider != provider:
-            raise ValueError(f"Requested provider {provider} does not match active provider {active_provider.provider}")
+        if not any(active.provider == provider for active in active_providers):
+            raise ValueError(f"Requested provider {provider} is not an active provider")
             
         strategy = cls._strategies.get(provider)
         if not strategy:
@@ -175,6 +302,11 @@ class LLMProviderFactory:
             
         return strategy
 
+    @classmethod
+    def registered(cls, provider: str) -> Optional[LLMProviderStrategy]:
+        """The strategy registered for a provider type, without checking it is active."""
+        return cls._strategies.get(provider)
+
     @classmethod
     def register_strategy(cls, provider: str, strategy: LLMProviderStrategy):
         """Register a new provider strategy."""
@@ -0,0 +1,350 @@
+"""Local GGUF models served in-process with llama.cpp (``llama-cpp-python``)."""
+import asyncio
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage, SystemMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import PrivateAttr
+
+from .batching import BatchScheduler, LlamaBatchBackend
+from .prompt_state import PROMPT_STATES, current_conversation, shared_generation
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONTEXT_WINDOW = 4096
+
+_ROLES = {SystemMessage: 'system', HumanMessage: 'user', AIMessage: 'assistant'}
+
+
+def load_llama(model_path: str, **params):
+    """Load a GGUF model; ``llama-cpp-python`` is only needed by deployments using local models.
+
+    The weights are memory-mapped read-only and not locked, so they stay in
+    the page cache shared by every process that maps the same file.
+    """
+    try:
+        from llama_cpp import Llama
+    except ImportError as e:
+        raise ValueError("The llama_cpp provider needs the llama-cpp-python package") from e
+    if not os.path.isfile(model_path):
+        raise ValueError(f"Model file {model_path} does not exist")
+    params.setdefault('use_mmap', True)
+    params.setdefault('use_mlock', False)
+    logger.info(f"Loading GGUF model {model_path}")
+    return Llama(model_path=model_path, verbose=False, **params)
+
+
+def llama_params(n_ctx: int = DEFAULT_CONTEXT_WINDOW, n_gpu_layers: int = 0, n_threads: Optional[int] = None,
+                 chat_format: Optional[str] = None) -> Dict[str, Any]:
+    """Load parameters of a ``Llama``, leaving llama.cpp's defaults out."""
+    params = {'n_ctx': int(n_ctx), 'n_gpu_layers': int(n_gpu_layers)}
+    if n_threads:
+        params['n_threads'] = int(n_threads)
+    if chat_format:
+        params['chat_format'] = chat_format
+    return params
+
+
+class LocalModel:
+    """One loaded model file: the ``Llama`` instance, the thread its own
+    context is used from, and the batch schedulers decoding with its weights."""
+
+    def __init__(self, path: str, params: Dict[str, Any]):
+        self.path = path
+        self.params = params
+        self.llm = None
+        self.load_seconds: Optional[float] = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='llama-cpp')
+        self._schedulers: Dict[tuple, BatchScheduler] = {}
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    def client(self):
+        """The loaded ``Llama`` instance; generate with it from the executor thread only."""
+        with self._load_lock:
+            if self.llm is None:
+                started = time.perf_counter()
+                self.llm = load_llama(self.path, **self.params)
+                self.load_seconds = time.perf_counter() - started
+            return self.llm
+
+    def scheduler(self, max_batch: int, n_ctx: int, n_threads: Optional[int], states, name: str) -> BatchScheduler:
+        key = (max_batch, n_ctx, n_threads, states is not None)
+        with self._lock:
+            scheduler = self._schedulers.get(key)
+            if scheduler is None:
+                scheduler = self._schedulers[key] = BatchScheduler(
+                    lambda: LlamaBatchBackend(self.client(), max_batch, n_ctx, n_threads),
+                    max_batch, name=name, states=states,
+                )
+            return scheduler
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            schedulers = [scheduler.stats() for scheduler in self._schedulers.values()]
+        return {
+            'path': self.path,
+            'params': self.params,
+            'loaded': self.llm is not None,
+            'load_seconds': self.load_seconds,
+            'file_bytes': os.path.getsize(self.path) if os.path.isfile(self.path) else None,
+            'schedulers': schedulers,
+        }
+
+
+class LocalModelRegistry:
+    """Local models of this process, shared by model file and load parameters.
+
+    Every provider (and every chat model rebuilt after a provider change)
+    using the same file with the same parameters gets the same LocalModel,
+    so a file is mapped and its contexts are allocated once per process.
+    Across processes, llama.cpp's read-only memory map means the weights are
+    read into the page cache once and all ASGI workers on the host share
+    them; only what a worker allocates itself is private (KV caches and
+    compute buffers, and layers offloaded to a GPU). Models load on first
+    use unless preloaded when the worker starts.
+    """
+
+    def __init__(self):
+        self._models: Dict[tuple, LocalModel] = {}
+        self._lock = threading.Lock()
+
+    def get(self, model_path: str, params: Dict[str, Any]) -> LocalModel:
+        path = os.path.realpath(model_path)
+        key = (path, tuple(sorted(params.items())))
+        with self._lock:
+            model = self._models.get(key)
+            if model is None:
+                model = self._models[key] = LocalModel(path, dict(params))
+            return model
+
+    def preload(self, models: Dict[str, Dict[str, Any]]) -> Optional[threading.Thread]:
+        """Load ``{model path: load parameters}`` in the background, so startup is not held up."""
+        if not models:
+            return None
+
+        def load():
+            for path, params in models.items():
+                try:
+                    self.get(path, llama_params(**(params or {}))).client()
+                except Exception as e:
+                    logger.error(f"Preloading local model {path} failed: {str(e)}")
+
+        thread = threading.Thread(target=load, name='llama-preload', daemon=True)
+        thread.start()
+        return thread
+
+    def stats(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            models = list(self._models.values())
+        return [model.stats() for model in models]
+
+    def __len__(self) -> int:
+        return len(self._models)
+
+
+# Initialize the global local model registry
+LOCAL_MODELS = LocalModelRegistry()
+
+
+def to_chat_messages(messages: List[BaseMessage]) -> List[Dict[str, str]]:
+    return [{'role': _ROLES.get(type(message), 'user'), 'content': str(message.content)} for message in messages]
+
+
+class ChatLlamaCpp(BaseChatModel):
+    """Chat model over a local llama.cpp model.
+
+    The model is shared through LOCAL_MODELS and loaded on first use; all
+    work on a context runs on one dedicated thread (a llama.cpp context is
+    not thread-safe), so generation never blocks the event loop. Usage is
+    counted with the model's own tokenizer.
+
+    With ``max_batch`` above 1, async calls go through a BatchScheduler that
+    decodes up to ``max_batch`` concurrent requests in shared steps. With
+    ``prompt_cache``, the KV cache of each conversation's last turn is then
+    kept (see prompt_state), so a new turn only evaluates the new message
+    instead of the whole history.
+    """
+
+    model_path: str
+    model_name: str = 'local'
+    temperature: float = 0.7
+    max_tokens: int = 256
+    top_p: float = 1.0
+    n_ctx: int = DEFAULT_CONTEXT_WINDOW
+    n_threads: Optional[int] = None
+    n_gpu_layers: int = 0
+    chat_format: Optional[str] = None
+    max_batch: int = 1
+    prompt_cache: bool = True
+
+    _local: Any = PrivateAttr(default=None)
+
+    @property
+    def _llm_type(self) -> str:
+        return 'llama_cpp'
+
+    def bind_tools(self, tools, **kwargs):
+        # Local models are used for plain chat; tool calling is not wired up
+        return self
+
+    @property
+    def local(self) -> LocalModel:
+        if self._local is None:
+            self._local = LOCAL_MODELS.get(self.model_path, llama_params(
+                self.n_ctx, self.n_gpu_layers, self.n_threads, self.chat_format))
+        return self._local
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        return self.local.executor
+
+    @property
+    def scheduler(self) -> BatchScheduler:
+        return self.local.scheduler(self.max_batch, self.n_ctx, self.n_threads,
+                                    PROMPT_STATES if self.prompt_cache else None, self.model_name)
+
+    def batched(self, stop: Optional[List[str]]) -> bool:
+        # Opt-in; stop sequences are only handled by llama.cpp's own completion loop
+        return self.max_batch > 1 and not stop
+
+    def state_key(self):
+        """Key of the current conversation's prompt state, if it is kept."""
+        conversation = current_conversation()
+        if not self.prompt_cache or conversation is None:
+            return None
+        return (self.model_path, conversation)
+
+    def client(self):
+        """The loaded ``Llama`` instance; generate with it from the executor thread only."""
+        return self.local.client()
+
+    def _params(self, stop: Optional[List[str]]) -> Dict[str, Any]:
+        return {
+            'temperature': self.temperature,
+            'top_p': self.top_p,
+            'max_tokens': self.max_tokens,
+            'stop': stop or [],
+        }
+
+    def count_tokens(self, text: str) -> int:
+        if not text:
+            return 0
+        return len(self.client().tokenize(text.encode('utf-8'), add_bos=False, special=True))
+
+    def _complete(self, messages: List[BaseMessage], stop: Optional[List[str]]) -> ChatResult:
+        response = self.client().create_chat_completion(messages=to_chat_messages(messages), **self._params(stop))
+        usage = response.get('usage') or {}
+        message = AIMessage(
+            content=response['choices'][0]['message'].get('content') or '',
+            usage_metadata={
+                'input_tokens': usage.get('prompt_tokens', 0),
+                'output_tokens': usage.get('completion_tokens', 0),
+                'total_tokens': usage.get('total_tokens', 0),
+            },
+            response_metadata={'token_usage': usage, 'model_name': self.model_name,
+                               'finish_reason': response['choices'][0].get('finish_reason')},
+        )
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream_usage(self, messages: List[BaseMessage], reply: str) -> Dict[str, int]:
+        # llama.cpp reports no usage for streams; count prompt and reply with the model's tokenizer
+        input_tokens = sum(self.count_tokens(str(message.content)) for message in messages)
+        output_tokens = self.count_tokens(reply)
+        return {'input_tokens': input_tokens, 'output_tokens': output_tokens,
+                'total_tokens': input_tokens + output_tokens}
+
+    def _iter_chunks(self, messages: List[BaseMessage], stop: Optional[List[str]],
+                     cancelled: threading.Event) -> Iterator[ChatGenerationChunk]:
+        stream = self.client().create_chat_completion(
+            messages=to_chat_messages(messages), stream=True, **self._params(stop))
+        reply = []
+        try:
+            for chunk in stream:
+                if cancelled.is_set():
+                    return
+                content = chunk['choices'][0].get('delta', {}).get('content')
+                if content:
+                    reply.append(content)
+                    yield ChatGenerationChunk(message=AIMessageChunk(content=content))
+        finally:
+            stream.close()
+        yield ChatGenerationChunk(message=AIMessageChunk(
+            content='', usage_metadata=self._stream_usage(messages, "".join(reply))))
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager=None, **kwargs: Any) -> ChatResult:
+        return self.executor.submit(self._complete, messages, stop).result()
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager=None, **kwargs: Any) -> ChatResult:
+        if self.batched(stop):
+            reply = []
+            usage = None
+            async for chunk in self._astream(messages, stop):
+                reply.append(chunk.message.content)
+                usage = chunk.message.usage_metadata or usage
+            message = AIMessage(content="".join(reply), usage_metadata=usage,
+                                response_metadata={'model_name': self.model_name})
+            return ChatResult(generations=[ChatGeneration(message=message)])
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._complete, messages, stop)
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager=None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        yield from self._iter_chunks(messages, stop, threading.Event())
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager=None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        """Generate on the model's thread and hand each chunk over to the event loop."""
+        if self.batched(stop):
+            # A reply shared through single-flight keeps no state: it would land under the leader's key
+            generation = self.scheduler.submit(to_chat_messages(messages), self.max_tokens,
+                                               self.temperature, self.top_p, self.state_key(),
+                                               keep_state=not shared_generation())
+            pieces = generation.__aiter__()
+            try:
+                async for piece in pieces:
+                    yield ChatGenerationChunk(message=AIMessageChunk(content=piece))
+            finally:
+                await pieces.aclose()
+            # Exact counts: the prompt as tokenized for the model and every sampled token
+            yield ChatGenerationChunk(message=AIMessageChunk(content='', usage_metadata={
+                'input_tokens': generation.input_tokens,
+                'output_tokens': generation.output_tokens,
+                'total_tokens': generation.input_tokens + generation.output_tokens,
+            }))
+            return
+
+        loop = asyncio.get_running_loop()
+        chunks: asyncio.Queue = asyncio.Queue()
+        cancelled = threading.Event()
+        done = object()
+
+        def produce():
+            try:
+                for chunk in self._iter_chunks(messages, stop, cancelled):
+                    loop.call_soon_threadsafe(chunks.put_nowait, chunk)
+            except BaseException as e:
+                loop.call_soon_threadsafe(chunks.put_nowait, e)
+            else:
+                loop.call_soon_threadsafe(chunks.put_nowait, done)
+
+        generation = loop.run_in_executor(self.executor, produce)
+        try:
+            while True:
+                item = await chunks.get()
+                if item is done:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            # Stops the generation at the next token if the caller went away early
+            cancelled.set()
+            await asyncio.shield(generation)
@@ -0,0 +1,142 @@
+"""Benchmark continuous batching of local model generations.
+
+Compares aggregate tokens/sec of concurrent requests decoded in shared
+batches with one-at-a-time decoding, e.g.::
+
+    python manage.py llmchat_bench_batching --concurrency 1 2 4 8 16 32
+    python manage.py llmchat_bench_batching --model /models/qwen2.5-0.5b-instruct-q4_k_m.gguf
+
+With ``--conversation-turns`` it times the first token of each turn of one
+growing conversation instead, with and without the previous turn's prompt
+state kept::
+
+    python manage.py llmchat_bench_batching --conversation-turns 20
+
+Without ``--model`` a fake backend with the cost profile of CPU decoding
+is used (each step costs ``--step-ms`` whatever the batch size, plus
+``--sequence-ms`` per sequence), so it shows the scheduler's behaviour
+rather than a particular model's speed.
+"""
+import asyncio
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+
+from LLMChat.batching import BatchScheduler, FakeBatchBackend, LlamaBatchBackend
+from LLMChat.local_llm import load_llama
+from LLMChat.prompt_state import PromptStateCache
+
+MESSAGE = "Here is some more context about the project, please keep it in mind for the next answers. " * 3
+
+
+class Command(BaseCommand):
+    help = "Measure aggregate tokens/sec of batched vs one-at-a-time local generation as concurrency grows."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32],
+                            help="Numbers of concurrent requests")
+        parser.add_argument('--max-batch', type=int, default=32, help="Sequences decoded together")
+        parser.add_argument('--max-tokens', type=int, default=64, help="Tokens generated per request")
+        parser.add_argument('--model', help="GGUF file to benchmark instead of the fake backend")
+        parser.add_argument('--n-ctx', type=int, default=1024, help="Context size per sequence (with --model)")
+        parser.add_argument('--threads', type=int, help="llama.cpp threads (with --model)")
+        parser.add_argument('--step-ms', type=float, default=20.0, help="Fake decode step cost")
+        parser.add_argument('--sequence-ms', type=float, default=0.5, help="Fake extra cost per batched sequence")
+        parser.add_argument('--prompt-token-ms', type=float, default=0.1, help="Fake cost per prompt token")
+        parser.add_argument('--conversation-turns', type=int,
+                            help="Time each turn of one conversation with and without kept prompt states instead")
+
+    def handle(self, *args, **options):
+        if options['model']:
+            llm = load_llama(options['model'], n_ctx=options['n_ctx'], n_threads=options['threads'])
+
+            def backend_factory(max_batch):
+                return lambda: LlamaBatchBackend(llm, max_batch, options['n_ctx'], options['threads'], seed=0)
+        else:
+            def backend_factory(max_batch):
+                return lambda: FakeBatchBackend(options['step_ms'] / 1000, options['sequence_ms'] / 1000,
+                                                options['prompt_token_ms'] / 1000)
+
+        if options['conversation_turns']:
+            schedulers = {
+                'full': BatchScheduler(backend_factory(1), 1, 'full'),
+                'kept': BatchScheduler(backend_factory(1), 1, 'kept', states=PromptStateCache(2 ** 40)),
+            }
+            self.stdout.write(f"{'turn':>4} {'prompt tokens':>13} {'full ttft ms':>13} {'kept ttft ms':>13} "
+                              f"{'reused tokens':>14}")
+            asyncio.run(self._conversation(schedulers, options))
+            return
+
+        schedulers = {
+            'batched': BatchScheduler(backend_factory(options['max_batch']), options['max_batch'], 'batched'),
+            'sequential': BatchScheduler(backend_factory(1), 1, 'sequential'),
+        }
+        self.stdout.write(
+            f"{'concurrency':>11} {'batched tok/s':>14} {'ttft p50 ms':>12} {'avg batch':>10} "
+            f"{'sequential tok/s':>17} {'ttft p50 ms':>12} {'speedup':>8}"
+        )
+        asyncio.run(self._run_all(schedulers, options))
+
+    async def _run_all(self, schedulers, options):
+        for concurrency in options['concurrency']:
+            row = {}
+            for mode, scheduler in schedulers.items():
+                steps, sequences = scheduler.steps, scheduler.batched_sequences
+                row[mode] = await self._measure(scheduler, concurrency, options['max_tokens'])
+                batch_steps = scheduler.steps - steps
+                row[mode]['avg_batch'] = (scheduler.batched_sequences - sequences) / batch_steps if batch_steps else 0.0
+            batched, sequential = row['batched'], row['sequential']
+            self.stdout.write(
+                f"{concurrency:>11} {batched['tokens_per_second']:>14.1f} {batched['ttft_ms']:>12.1f} "
+                f"{batched['avg_batch']:>10.1f} {sequential['tokens_per_second']:>17.1f} "
+                f"{sequential['ttft_ms']:>12.1f} "
+                f"{batched['tokens_per_second'] / sequential['tokens_per_second']:>7.1f}x"
+            )
+
+    async def _conversation(self, schedulers, options):
+        histories = {mode: [{'role': 'system', 'content': "You are a helpful assistant."}] for mode in schedulers}
+        for turn in range(1, options['conversation_turns'] + 1):
+            row = {}
+            for mode, scheduler in schedulers.items():
+                messages = histories[mode]
+                messages.append({'role': 'user', 'content': f"Turn {turn}. {MESSAGE}"})
+                started = time.perf_counter()
+                generation = scheduler.submit(list(messages), options['max_tokens'], temperature=0.0,
+                                              state_key=('bench', 1))
+                reply, ttft = [], None
+                async for piece in generation:
+                    ttft = ttft if ttft is not None else time.perf_counter() - started
+                    reply.append(piece)
+                messages.append({'role': 'assistant', 'content': "".join(reply)})
+                row[mode] = (generation, (ttft or 0.0) * 1000)
+            (full, full_ttft), (kept, kept_ttft) = row['full'], row['kept']
+            self.stdout.write(f"{turn:>4} {full.input_tokens:>13} {full_ttft:>13.1f} {kept_ttft:>13.1f} "
+                              f"{kept.reused_tokens:>14}")
+
+    @staticmethod
+    async def _measure(scheduler, concurrency, max_tokens):
+        ttfts = []
+        tokens = 0
+
+        async def request(index):
+            nonlocal tokens
+            started = time.perf_counter()
+            generation = scheduler.submit(
+                [{'role': 'user', 'content': f"Request {index}: write a short paragraph about batching."}],
+                max_tokens, temperature=0.0,
+            )
+            first = True
+            async for _ in generation:
+                if first:
+                    ttfts.append(time.perf_counter() - started)
+                    first = False
+            tokens += generation.output_tokens
+
+        started = time.perf_counter()
+        await asyncio.gather(*(request(index) for index in range(concurrency)))
+        wall = time.perf_counter() - started
+        return {
+            'tokens_per_second': tokens / wall,
+            'ttft_ms': statistics.median(ttfts) * 1000 if ttfts else 0.0,
+        }
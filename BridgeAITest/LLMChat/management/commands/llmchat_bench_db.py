@@ -0,0 +1,84 @@
+"""Benchmark chat-history reads under concurrent WebSocket chats.
+
+Runs against a throwaway test database, e.g.::
+
+    python manage.py llmchat_bench_db --chats 1 4 16 64 --latency-ms 2
+"""
+import asyncio
+import statistics
+import time
+
+from asgiref.sync import sync_to_async
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from LLMChat.db import db_sync_to_async
+from LLMChat.models import ChatLog, Conversation, ModelProvider
+
+
+class Command(BaseCommand):
+    help = "Compare thread-sensitive and pooled DB access latency as concurrent chats grow."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chats', type=int, nargs='+', default=[1, 4, 16, 64],
+                            help="Numbers of concurrent chats to simulate")
+        parser.add_argument('--turns', type=int, default=50, help="ChatLog rows per conversation")
+        parser.add_argument('--rounds', type=int, default=5, help="History reads per chat")
+        parser.add_argument('--latency-ms', type=float, default=0.0,
+                            help="Extra per-query delay emulating a networked database")
+
+    def handle(self, *args, **options):
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            conversation_ids = self._populate(max(options['chats']), options['turns'])
+            self.stdout.write(f"{'chats':>6} {'sync_to_async p50/p95 ms':>28} {'db pool p50/p95 ms':>24}")
+            for chats in options['chats']:
+                ids = conversation_ids[:chats]
+                legacy = asyncio.run(self._measure(sync_to_async, ids, options))
+                pooled = asyncio.run(self._measure(db_sync_to_async, ids, options))
+                self.stdout.write(
+                    f"{chats:>6} {self._fmt(legacy):>28} {self._fmt(pooled):>24}"
+                )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def _populate(self, conversations, turns):
+        provider = ModelProvider.objects.create(name='bench', provider='openai', model_name='bench', api_key='-')
+        ids = []
+        for index in range(conversations):
+            conversation = Conversation.objects.create(title=f"bench {index}")
+            ChatLog.objects.bulk_create([
+                ChatLog(provider=provider, conversation=conversation, system_prompt='',
+                        user_message=f"question {turn}", ai_response=f"answer {turn}",
+                        input_tokens=0, output_tokens=0, total_tokens=0)
+                for turn in range(turns)
+            ])
+            ids.append(conversation.id)
+        return ids
+
+    async def _measure(self, wrapper, conversation_ids, options):
+        delay = options['latency_ms'] / 1000
+
+        def read_history(conversation_id):
+            if delay:
+                time.sleep(delay)
+            return list(ChatLog.objects.filter(conversation_id=conversation_id))
+
+        get_history = wrapper(read_history)
+        samples = []
+
+        async def chat(conversation_id):
+            for _ in range(options['rounds']):
+                started = time.perf_counter()
+                await get_history(conversation_id)
+                samples.append((time.perf_counter() - started) * 1000)
+
+        await asyncio.gather(*(chat(conversation_id) for conversation_id in conversation_ids))
+        return samples
+
+    @staticmethod
+    def _fmt(samples):
+        ordered = sorted(samples)
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+        return f"{statistics.median(ordered):.2f}/{p95:.2f}"
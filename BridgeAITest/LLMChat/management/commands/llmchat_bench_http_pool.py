@@ -0,0 +1,141 @@
+"""Benchmark connection reuse of chat models with their own HTTP clients vs the shared pools.
+
+A stand-in HTTPS server on localhost (self-signed certificate made with the
+``openssl`` command) answers chat completion calls of several OpenAI chat
+models, so no network is involved, e.g.::
+
+    python manage.py llmchat_bench_http_pool --models 8 --requests 400 --concurrency 16
+
+The server counts the TLS connections it accepts; every one is a full
+handshake a real provider would have charged in latency.
+"""
+import asyncio
+import http.server
+import json
+import os
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import warnings
+
+from django.core.management.base import BaseCommand, CommandError
+
+from LLMChat.http_pool import HTTP_POOLS
+from LLMChat.llm_providers import use_shared_http_pools
+
+COMPLETION = json.dumps({
+    'id': 'chatcmpl-bench', 'object': 'chat.completion', 'created': 0, 'model': 'bench',
+    'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': 'Hello!'}, 'finish_reason': 'stop'}],
+    'usage': {'prompt_tokens': 5, 'completion_tokens': 2, 'total_tokens': 7},
+}).encode()
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def setup(self):
+        self.request.do_handshake()
+        self.server.count_connection()
+        super().setup()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(COMPLETION)))
+        self.end_headers()
+        self.wfile.write(COMPLETION)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, certfile, keyfile):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        # Handshakes happen in the handler threads, not in the accept loop
+        self.socket = context.wrap_socket(self.socket, server_side=True, do_handshake_on_connect=False)
+        self.connections = 0
+        self._lock = threading.Lock()
+
+    def count_connection(self):
+        with self._lock:
+            self.connections += 1
+
+
+def self_signed_certificate(directory):
+    certfile, keyfile = os.path.join(directory, 'cert.pem'), os.path.join(directory, 'key.pem')
+    try:
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                        '-subj', '/CN=127.0.0.1', '-addext', 'subjectAltName=IP:127.0.0.1',
+                        '-keyout', keyfile, '-out', certfile], check=True, capture_output=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise CommandError(f"Making a self-signed certificate with openssl failed: {e}")
+    return certfile, keyfile
+
+
+class Command(BaseCommand):
+    help = "Compare TLS handshakes and connection reuse of per-model HTTP clients and the shared HTTP pools."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--models', type=int, default=8, help="Chat models calling the same host")
+        parser.add_argument('--requests', type=int, default=400, help="Calls per run")
+        parser.add_argument('--concurrency', type=int, default=16, help="Calls in flight at once")
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as directory:
+            certfile, keyfile = self_signed_certificate(directory)
+            # Both the SDKs' own clients and the shared pools then trust the stand-in server
+            os.environ['SSL_CERT_FILE'] = certfile
+            server = StandInServer(certfile, keyfile)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            try:
+                base = f"https://127.0.0.1:{server.server_address[1]}/v1"
+                self.stdout.write(f"{'clients':<8} {'requests':>8} {'handshakes':>10} {'reuse':>6} "
+                                  f"{'handshakes/s':>12} {'ms/call':>8}")
+                for name, shared in (('own', False), ('shared', True)):
+                    models = [self._model(base, index, shared) for index in range(options['models'])]
+                    before = server.connections
+                    elapsed = asyncio.run(self._run(models, options['requests'], options['concurrency']))
+                    handshakes = server.connections - before
+                    requests = options['requests']
+                    self.stdout.write(f"{name:<8} {requests:>8} {handshakes:>10} {1 - handshakes / requests:>6.1%} "
+                                      f"{handshakes / elapsed:>12.1f} {elapsed / requests * 1000:>8.2f}")
+            finally:
+                server.shutdown()
+                server.server_close()
+        stats = HTTP_POOLS.stats().get('127.0.0.1')
+        if stats:
+            self.stdout.write(f"Shared pool stats: {stats['requests']} requests, {stats['connections']} connections, "
+                              f"reuse ratio {stats['reuse_ratio']:.1%}")
+
+    @staticmethod
+    def _model(base, index, shared):
+        from langchain_community.chat_models import ChatOpenAI
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')  # the same deprecated class the chat service uses
+            llm = ChatOpenAI(model=f'bench-{index}', openai_api_key='bench', openai_api_base=base, max_retries=0)
+        return use_shared_http_pools(llm) if shared else llm
+
+    @staticmethod
+    async def _run(models, requests, concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def call(index):
+            async with semaphore:
+                await models[index % len(models)].ainvoke("Hello")
+
+        started = time.perf_counter()
+        await asyncio.gather(*(call(index) for index in range(requests)))
+        elapsed = time.perf_counter() - started
+        # Close the SDK clients while their loop still runs (the shared pools stay open)
+        for llm in models:
+            await llm.async_client._client.close()
+        return elapsed
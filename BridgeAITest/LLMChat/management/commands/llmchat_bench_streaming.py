@@ -0,0 +1,153 @@
+"""Benchmark the CPU cost per streamed token of native streaming vs LangChain.
+
+Canned server-sent event streams are served by an in-process mock transport,
+so no network is involved and the CPU time measured is the client side
+only, e.g.::
+
+    python manage.py llmchat_bench_streaming --tokens 500 --runs 20
+
+``http floor`` is reading the same response line by line without parsing
+it, i.e. what any client pays. The LangChain row for Anthropic needs the
+``anthropic`` package and is skipped without it.
+"""
+import asyncio
+import json
+import time
+import warnings
+
+import httpx
+from django.core.management.base import BaseCommand
+from langchain_core.messages import HumanMessage, SystemMessage
+
+from LLMChat.native_stream import AnthropicStreamClient, OpenAIStreamClient
+
+MESSAGES = [SystemMessage(content="You are a helpful assistant."), HumanMessage(content="Tell me a story.")]
+
+
+def _openai_events(tokens):
+    base = {'id': 'chatcmpl-bench', 'object': 'chat.completion.chunk', 'created': 0, 'model': 'bench'}
+    events = [dict(base, choices=[{'index': 0, 'delta': {'role': 'assistant', 'content': ''}, 'finish_reason': None}])]
+    events += [dict(base, choices=[{'index': 0, 'delta': {'content': f" word{index}"}, 'finish_reason': None}])
+               for index in range(tokens)]
+    events.append(dict(base, choices=[{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]))
+    events.append(dict(base, choices=[], usage={'prompt_tokens': 12, 'completion_tokens': tokens,
+                                                'total_tokens': 12 + tokens}))
+    return [f"data: {json.dumps(event)}\n\n".encode() for event in events] + [b"data: [DONE]\n\n"]
+
+
+def _anthropic_events(tokens):
+    def event(name, payload):
+        return f"event: {name}\ndata: {json.dumps(dict(payload, type=name))}\n\n".encode()
+
+    events = [event('message_start', {'message': {'id': 'msg_bench', 'type': 'message', 'role': 'assistant',
+                                                  'content': [], 'model': 'bench',
+                                                  'usage': {'input_tokens': 12, 'output_tokens': 1}}}),
+              event('content_block_start', {'index': 0, 'content_block': {'type': 'text', 'text': ''}})]
+    events += [event('content_block_delta', {'index': 0, 'delta': {'type': 'text_delta', 'text': f" word{index}"}})
+               for index in range(tokens)]
+    events += [event('content_block_stop', {'index': 0}),
+               event('message_delta', {'delta': {'stop_reason': 'end_turn'}, 'usage': {'output_tokens': tokens}}),
+               event('message_stop', {})]
+    return events
+
+
+def mock_http(events):
+    """An HTTP client whose every request gets ``events`` streamed back, one per network read."""
+    async def body():
+        for event in events:
+            yield event
+
+    def handler(request):
+        return httpx.Response(200, headers={'content-type': 'text/event-stream'}, content=body())
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+class Command(BaseCommand):
+    help = "Measure client CPU time per streamed token for native SSE streaming and the LangChain path."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tokens', type=int, default=500, help="Tokens per streamed reply")
+        parser.add_argument('--runs', type=int, default=20, help="Replies streamed per path (the best run counts)")
+
+    def handle(self, *args, **options):
+        config = {'model_name': 'bench', 'temperature': 0.7, 'max_tokens': options['tokens'], 'top_p': 1.0,
+                  'api_key': 'bench', 'extra_settings': {'api_base': 'http://bench/v1'}}
+        tokens = options['tokens']
+        openai_events, anthropic_events = _openai_events(tokens), _anthropic_events(tokens)
+        # Clients are built up front, so only streaming is timed
+        paths = [
+            ('openai', 'http floor', lambda: mock_http(openai_events), self._floor),
+            ('openai', 'native', lambda: OpenAIStreamClient(config, mock_http(openai_events)), self._stream),
+            ('openai', 'langchain', lambda: self._langchain_openai(openai_events), self._stream),
+            ('anthropic', 'http floor', lambda: mock_http(anthropic_events), self._floor),
+            ('anthropic', 'native', lambda: AnthropicStreamClient(config, mock_http(anthropic_events)), self._stream),
+            ('anthropic', 'langchain', lambda: self._langchain_anthropic(anthropic_events), self._stream),
+        ]
+        self.stdout.write(f"{'api':<10} {'path':<11} {'us/token':>9} {'tokens':>7}")
+        results = {}
+        for api, path, build, stream in paths:
+            try:
+                client = build()
+                per_token, streamed = asyncio.run(self._measure(lambda: stream(client), options['runs'], tokens))
+            except ImportError as e:
+                self.stdout.write(f"{api:<10} {path:<11} {'-':>9} {'-':>7}  ({e})")
+                continue
+            results[(api, path)] = per_token
+            self.stdout.write(f"{api:<10} {path:<11} {per_token * 1e6:>9.2f} {streamed:>7}")
+        for api in ('openai', 'anthropic'):
+            if (api, 'native') in results and (api, 'langchain') in results:
+                self.stdout.write(f"{api}: native streaming uses "
+                                  f"{results[(api, 'langchain')] / results[(api, 'native')]:.1f}x less CPU per token")
+
+    @staticmethod
+    async def _measure(make, runs, tokens):
+        best, streamed = None, 0
+        await make()  # warm up
+        for _ in range(runs):
+            started = time.process_time()
+            streamed = await make()
+            elapsed = time.process_time() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return best / tokens, streamed
+
+    @staticmethod
+    async def _stream(client):
+        count = 0
+        async for chunk in client.astream(MESSAGES):
+            if chunk.content:
+                count += 1
+        return count
+
+    @staticmethod
+    async def _floor(http):
+        count = 0
+        async with http.stream('POST', 'http://bench/v1/stream') as response:
+            async for line in response.aiter_lines():
+                if line.startswith('data:'):
+                    count += 1
+        return count
+
+    @staticmethod
+    def _langchain_openai(events):
+        import openai
+        from langchain_community.chat_models import ChatOpenAI
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')  # the same deprecated class the chat service uses
+            llm = ChatOpenAI(model='bench', openai_api_key='bench', streaming=True)
+        llm.async_client = openai.AsyncOpenAI(api_key='bench', base_url='http://bench/v1',
+                                              http_client=mock_http(events)).chat.completions
+        return llm
+
+    @staticmethod
+    def _langchain_anthropic(events):
+        import anthropic
+        from langchain_community.chat_models import ChatAnthropic
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            llm = ChatAnthropic(model='bench', anthropic_api_key='bench', streaming=True)
+        llm.async_client = anthropic.AsyncAnthropic(api_key='bench', base_url='http://bench',
+                                                    http_client=mock_http(events))
+        return llm
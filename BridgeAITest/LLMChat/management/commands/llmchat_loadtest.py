@@ -0,0 +1,270 @@
+"""Load-test the chat WebSocket and HTTP endpoints against a local fake provider.
+
+Boots the ASGI application in-process on a throwaway test database, with a
+fake provider that streams OpenAI-style, so no network is needed, e.g.::
+
+    python manage.py llmchat_loadtest --clients 1 10 50 --requests 5 --ttft-ms 200 --tokens-per-second 50
+
+CPU and RSS are those of this process, i.e. the server plus the simulated
+clients, which are cheap next to the server side.
+"""
+import asyncio
+import json
+import os
+import tempfile
+import time
+from collections import Counter
+
+from channels.testing import HttpCommunicator, WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from LLMChat.consumers import new_tts_session
+from LLMChat.fake_llm import FakeStrategy
+from LLMChat.llm_providers import LLMProviderFactory
+from LLMChat.models import ModelProvider
+from LLMChat.writer import CHATLOG_WRITER
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+HEADERS = [(b'host', b'localhost'), (b'origin', b'http://localhost')]
+
+
+def percentile(samples, percent):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+def current_rss():
+    """Resident set size in bytes (peak RSS where /proc is unavailable)."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        if resource is None:
+            return None
+        # ru_maxrss is in kilobytes on Linux, bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Run:
+    """Samples and errors of one endpoint at one concurrency level."""
+
+    def __init__(self, endpoint, clients):
+        self.endpoint = endpoint
+        self.clients = clients
+        self.latencies = []
+        self.ttfts = []
+        self.tokens = 0
+        self.errors = Counter()
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.peak_rss = None
+
+    @property
+    def requests(self):
+        return len(self.latencies) + sum(self.errors.values())
+
+    def report(self):
+        return {
+            'endpoint': self.endpoint,
+            'clients': self.clients,
+            'requests': self.requests,
+            'errors': dict(self.errors),
+            'error_rate': sum(self.errors.values()) / self.requests if self.requests else 0.0,
+            'requests_per_second': len(self.latencies) / self.wall if self.wall else 0.0,
+            'tokens_per_second': self.tokens / self.wall if self.wall else 0.0,
+            'latency_ms': {f"p{p}": _ms(percentile(self.latencies, p)) for p in (50, 95, 99)},
+            'ttft_ms': {f"p{p}": _ms(percentile(self.ttfts, p)) for p in (50, 95, 99)},
+            'cpu_percent': 100 * self.cpu / self.wall if self.wall else 0.0,
+            'peak_rss_mb': self.peak_rss / 2 ** 20 if self.peak_rss else None,
+        }
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 1) if seconds is not None else None
+
+
+class Command(BaseCommand):
+    help = "Measure chat throughput, latency, errors and CPU/RSS under concurrent clients, offline."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, nargs='+', default=[1, 10, 50],
+                            help="Numbers of concurrent clients to simulate")
+        parser.add_argument('--requests', type=int, default=5, help="Chat messages sent by each client")
+        parser.add_argument('--endpoint', choices=['ws', 'http', 'both'], default='both',
+                            help="ws/chat/ (streaming), /api/llm/chat/ or both")
+        parser.add_argument('--ttft-ms', type=float, default=200.0, help="Fake provider time to first token")
+        parser.add_argument('--tokens-per-second', type=float, default=50.0, help="Fake provider token rate")
+        parser.add_argument('--reply-tokens', type=int, default=64, help="Tokens per fake reply")
+        parser.add_argument('--think-ms', type=float, default=0.0, help="Pause of each client between messages")
+        parser.add_argument('--timeout', type=float, default=60.0, help="Seconds before a request counts as timed out")
+        parser.add_argument('--tts', action='store_true', help="Ask the chat consumer to forward replies to TTS")
+        parser.add_argument('--json', dest='json_path', help="Also write the results to this JSON file")
+
+    def handle(self, *args, **options):
+        LLMProviderFactory.register_strategy('fake', FakeStrategy())
+        old_name = connection.settings_dict['NAME']
+        if connection.vendor == 'sqlite':
+            # Shared in-memory SQLite fails concurrent writers with "table is locked"
+            connection.settings_dict['TEST']['NAME'] = os.path.join(tempfile.mkdtemp(), 'loadtest.sqlite3')
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            ModelProvider.objects.create(
+                name='loadtest', provider='fake', model_name='fake', api_key='-', is_active=True,
+                max_tokens=options['reply_tokens'],
+                extra_settings={'ttft': options['ttft_ms'] / 1000, 'tokens_per_second': options['tokens_per_second']},
+            )
+            from BridgeAITest.asgi import application
+            results = asyncio.run(self._run_all(application, options))
+        finally:
+            # Chat logs still queued for the batch writer belong to the test database
+            CHATLOG_WRITER.flush()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        self.stdout.write(
+            f"{'endpoint':>8} {'clients':>7} {'reqs':>6} {'err%':>6} {'req/s':>8} {'tok/s':>9} "
+            f"{'latency p50/p95/p99 ms':>24} {'ttft p50/p95 ms':>17} {'cpu%':>6} {'rss MB':>7}"
+        )
+        for result in results:
+            latency, ttft = result['latency_ms'], result['ttft_ms']
+            self.stdout.write(
+                f"{result['endpoint']:>8} {result['clients']:>7} {result['requests']:>6} "
+                f"{100 * result['error_rate']:>6.1f} {result['requests_per_second']:>8.2f} "
+                f"{result['tokens_per_second']:>9.1f} "
+                f"{_fmt(latency['p50'], latency['p95'], latency['p99']):>24} "
+                f"{_fmt(ttft['p50'], ttft['p95']):>17} {result['cpu_percent']:>6.1f} "
+                f"{_fmt(result['peak_rss_mb']):>7}"
+            )
+            if result['errors']:
+                self.stdout.write(f"{'':>8} errors: {result['errors']}")
+        if options['json_path']:
+            with open(options['json_path'], 'w', encoding='utf-8') as handle:
+                json.dump({'options': {k: options[k] for k in (
+                    'clients', 'requests', 'ttft_ms', 'tokens_per_second', 'reply_tokens', 'think_ms')},
+                    'results': results}, handle, indent=2)
+
+    async def _run_all(self, application, options):
+        endpoints = ['ws', 'http'] if options['endpoint'] == 'both' else [options['endpoint']]
+        results = []
+        for endpoint in endpoints:
+            for clients in options['clients']:
+                run = Run(endpoint, clients)
+                await self._run(application, run, options)
+                results.append(run.report())
+        return results
+
+    async def _run(self, application, run, options):
+        client = self._ws_client if run.endpoint == 'ws' else self._http_client
+        sampling = asyncio.ensure_future(self._sample_rss(run))
+        cpu_started = time.process_time()
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(client(application, run, index, options) for index in range(run.clients)))
+        finally:
+            run.wall = time.perf_counter() - started
+            run.cpu = time.process_time() - cpu_started
+            sampling.cancel()
+
+    @staticmethod
+    async def _sample_rss(run):
+        while True:
+            rss = current_rss()
+            if rss is not None:
+                run.peak_rss = max(run.peak_rss or 0, rss)
+            await asyncio.sleep(0.1)
+
+    @staticmethod
+    def _message(run, client, turn):
+        # Distinct prompts, so response caching and request coalescing don't kick in
+        return f"Load test {run.endpoint} {run.clients} client {client} turn {turn}: say something."
+
+    async def _ws_client(self, application, run, client, options):
+        communicator = WebsocketCommunicator(application, '/ws/chat/', headers=HEADERS)
+        try:
+            connected, _ = await communicator.connect(timeout=options['timeout'])
+        except Exception as e:
+            run.errors[f"connect: {type(e).__name__}"] += options['requests']
+            return
+        if not connected:
+            run.errors['connect: rejected'] += options['requests']
+            return
+        # Replies are forwarded to a TTS session of this client that no voice socket listens on
+        tts_session = new_tts_session() if options['tts'] else None
+        try:
+            for turn in range(options['requests']):
+                await communicator.send_to(text_data=json.dumps({
+                    'message': self._message(run, client, turn),
+                    'stream': True,
+                    'enable_tts': options['tts'],
+                    'tts_session': tts_session,
+                }))
+                started = time.perf_counter()
+                ttft = None
+                chunks = 0
+                try:
+                    while True:
+                        reply = json.loads(await communicator.receive_from(timeout=options['timeout']))
+                        if 'error' in reply:
+                            run.errors[reply['error'][:60]] += 1
+                            break
+                        if reply.get('type') == 'chat.message':
+                            ttft = ttft if ttft is not None else time.perf_counter() - started
+                            chunks += 1
+                        elif reply.get('type') == 'chat.complete':
+                            run.latencies.append(time.perf_counter() - started)
+                            if ttft is not None:
+                                run.ttfts.append(ttft)
+                            run.tokens += chunks
+                            break
+                except asyncio.TimeoutError:
+                    run.errors['timeout'] += 1
+                    # The connection may still deliver the late reply; start over on a fresh one
+                    await communicator.disconnect()
+                    communicator = WebsocketCommunicator(application, '/ws/chat/', headers=HEADERS)
+                    await communicator.connect(timeout=options['timeout'])
+                await self._think(options)
+        finally:
+            await communicator.disconnect()
+
+    async def _http_client(self, application, run, client, options):
+        for turn in range(options['requests']):
+            body = json.dumps({'message': self._message(run, client, turn)}).encode('utf-8')
+            communicator = HttpCommunicator(
+                application, 'POST', '/api/llm/chat/', body=body,
+                headers=HEADERS + [(b'content-type', b'application/json'),
+                                   (b'content-length', str(len(body)).encode('ascii'))],
+            )
+            started = time.perf_counter()
+            try:
+                response = await communicator.get_response(timeout=options['timeout'])
+            except asyncio.TimeoutError:
+                run.errors['timeout'] += 1
+                continue
+            finally:
+                # Let the handler finish (it also listens for the client going away)
+                await communicator.send_input({'type': 'http.disconnect'})
+                try:
+                    await communicator.wait()
+                except asyncio.TimeoutError:
+                    pass
+            if response['status'] != 200:
+                run.errors[f"HTTP {response['status']}"] += 1
+                continue
+            run.latencies.append(time.perf_counter() - started)
+            run.tokens += json.loads(response['body'])['usage'].get('output_tokens', 0)
+            await self._think(options)
+
+    @staticmethod
+    async def _think(options):
+        if options['think_ms']:
+            await asyncio.sleep(options['think_ms'] / 1000)
+
+
+def _fmt(*values):
+    return "/".join('-' if value is None else f"{value:.1f}" for value in values)
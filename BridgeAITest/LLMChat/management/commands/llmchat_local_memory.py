@@ -0,0 +1,85 @@
+"""Measure the memory local-model workers use each, and how much of it they share.
+
+Starts groups of worker processes that load a GGUF model through the local
+model registry, as ASGI workers do, run one token through it so the weights
+are actually paged in, and report their resident memory, e.g.::
+
+    python manage.py llmchat_local_memory --model /models/qwen2.5-0.5b-instruct-q4_k_m.gguf --workers 1 2 4
+
+Private memory is what a worker allocated itself (KV cache, buffers); the
+file-backed part is the memory-mapped weights, one page-cache copy for all
+workers, which PSS (proportional set size) splits between them. Linux only.
+"""
+import multiprocessing
+
+from django.core.management.base import BaseCommand, CommandError
+
+from LLMChat.local_llm import DEFAULT_CONTEXT_WINDOW, LOCAL_MODELS, llama_params
+
+MB = 2 ** 20
+
+
+def memory_usage():
+    """Private (anonymous) and file-backed resident bytes, and the PSS, of this process."""
+    usage = {}
+    with open('/proc/self/status') as status:
+        for line in status:
+            key, _, value = line.partition(':')
+            if key in ('RssAnon', 'RssFile'):
+                usage[key] = int(value.split()[0]) * 1024
+    with open('/proc/self/smaps_rollup') as rollup:
+        for line in rollup:
+            if line.startswith('Pss:'):
+                usage['Pss'] = int(line.split()[1]) * 1024
+    return usage
+
+
+def _worker(path, params, barrier, results):
+    try:
+        llm = LOCAL_MODELS.get(path, params).client()
+        llm.create_completion('Hello', max_tokens=1)
+        barrier.wait()
+        results.put(memory_usage())
+    except Exception as e:
+        barrier.abort()
+        results.put(e)
+        return
+    # Stay mapped until every worker has measured
+    barrier.wait()
+
+
+class Command(BaseCommand):
+    help = "Report per-worker private and shared memory of local-model workers as workers are added."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', required=True, help="GGUF file to load")
+        parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help="Numbers of worker processes")
+        parser.add_argument('--n-ctx', type=int, default=DEFAULT_CONTEXT_WINDOW, help="Context size")
+        parser.add_argument('--n-gpu-layers', type=int, default=0, help="Layers offloaded to a GPU")
+
+    def handle(self, *args, **options):
+        try:
+            memory_usage()
+        except OSError:
+            raise CommandError("Measuring memory needs Linux /proc")
+        params = llama_params(options['n_ctx'], options['n_gpu_layers'])
+        context = multiprocessing.get_context('spawn')
+        self.stdout.write(f"{'workers':>7} {'private MB/worker':>18} {'file MB/worker':>15} "
+                          f"{'PSS MB/worker':>14} {'PSS MB total':>13}")
+        for workers in options['workers']:
+            barrier = context.Barrier(workers)
+            results = context.Queue()
+            processes = [context.Process(target=_worker, args=(options['model'], params, barrier, results))
+                         for _ in range(workers)]
+            for process in processes:
+                process.start()
+            usages = [results.get() for _ in processes]
+            for process in processes:
+                process.join()
+            errors = [usage for usage in usages if isinstance(usage, Exception)]
+            if errors:
+                raise CommandError(f"A worker failed: {errors[0]}")
+            private = sum(usage['RssAnon'] for usage in usages) / workers / MB
+            mapped = sum(usage['RssFile'] for usage in usages) / workers / MB
+            pss = sum(usage['Pss'] for usage in usages) / MB
+            self.stdout.write(f"{workers:>7} {private:>18.1f} {mapped:>15.1f} {pss / workers:>14.1f} {pss:>13.1f}")
@@ -0,0 +1,260 @@
+"""Micro-benchmarks of the LLMChat, todo and accounts hot paths.
+
+Runs on an in-memory SQLite test database without network access and
+compares the per-operation times with the baseline kept in the repository::
+
+    python manage.py llmchat_microbench                   # fail on regressions
+    python manage.py llmchat_microbench -k prepare        # only matching benchmarks
+    python manage.py llmchat_microbench --save-baseline   # record a new baseline
+
+Baseline times are scaled by a pure-Python calibration workload timed next to
+each benchmark, which absorbs most differences in CPU speed between machines
+and runs; re-record the baseline after an intended change in performance.
+"""
+import asyncio
+import gc
+import json
+import platform
+import time
+from pathlib import Path
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import RequestFactory
+from langchain_core.messages import HumanMessage
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from rest_framework.request import Request
+
+from LLMChat.consumers import ChatConsumer, new_tts_session, tts_group
+from LLMChat.fake_llm import FakeStreamingChatModel
+from LLMChat.history import HISTORY_CACHE
+from LLMChat.models import ChatLog, Conversation, ModelProvider
+from LLMChat.serializers import ChatLogSerializer
+from LLMChat.services import ChatService
+from todo.models import Todo
+from todo.serializers import TodoSerializer
+
+BASELINE_PATH = Path(__file__).resolve().parents[2] / 'benchmarks' / 'baseline.json'
+
+# Benchmarks by name; each builds its fixtures and returns the operation to time
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+def _provider():
+    provider, _ = ModelProvider.objects.get_or_create(
+        name='microbench', defaults={
+            'provider': 'openai', 'model_name': 'microbench', 'api_key': '-', 'max_tokens': 256,
+            'extra_settings': {'context_window': 128000},
+        })
+    return provider
+
+
+def _conversation(provider, turns):
+    conversation = Conversation.objects.create(title=f"microbench {turns} turns")
+    ChatLog.objects.bulk_create([
+        ChatLog(provider=provider, conversation=conversation, system_prompt='',
+                user_message=f"Question number {turn} about the project?",
+                ai_response=f"Answer number {turn}, with a few more words of detail.",
+                input_tokens=0, output_tokens=0, total_tokens=0, turn_tokens=24)
+        for turn in range(turns)
+    ], batch_size=1000)
+    return conversation
+
+
+def _prepare_messages(turns, warm):
+    provider = _provider()
+    conversation = _conversation(provider, turns)
+    service = ChatService(provider)
+
+    async def op():
+        if not warm:
+            HISTORY_CACHE.discard(conversation.id)
+        await service.prepare_messages("And the next question?", conversation.id)
+
+    return op
+
+
+for _turns in (10, 100, 1000, 10000):
+    benchmark(f"prepare_messages[cold,turns={_turns}]")(lambda turns=_turns: _prepare_messages(turns, warm=False))
+    benchmark(f"prepare_messages[warm,turns={_turns}]")(lambda turns=_turns: _prepare_messages(turns, warm=True))
+
+
+def _stream_reply(chunks, enable_tts):
+    consumer = ChatConsumer()
+    consumer.scope = {'type': 'websocket', 'path': '/ws/chat/'}
+
+    async def base_send(message):
+        pass
+
+    consumer.base_send = base_send
+    # Fake model replies are words with a sentence end every twelve tokens
+    tokens = FakeStreamingChatModel(reply_tokens=chunks)._tokens([HumanMessage(content='microbench')])
+
+    async def stream():
+        for token in tokens:
+            yield token
+
+    # Sentences go to a TTS group nobody listens on, which costs the same group_send
+    tts = tts_group(new_tts_session()) if enable_tts else None
+
+    async def op():
+        await consumer.stream_reply(stream(), tts)
+
+    return op
+
+
+for _tts in (False, True):
+    benchmark(f"consumer.stream_reply[chunks=500{',tts' if _tts else ''}]")(
+        lambda tts=_tts: _stream_reply(500, tts))
+
+
+@benchmark('ChatLogSerializer[many=1000]')
+def _chatlog_serializer():
+    conversation = _conversation(_provider(), 1000)
+    chat_logs = list(ChatLog.objects.filter(conversation=conversation))
+    return lambda: ChatLogSerializer(chat_logs, many=True).data
+
+
+@benchmark('TodoSerializer[many=100]')
+def _todo_serializer():
+    user = User.objects.create_user('microbench-todo')
+    Todo.objects.bulk_create([Todo(user=user, title=f"Todo {index}") for index in range(100)])
+    todos = list(Todo.objects.filter(user=user).select_related('user'))
+    return lambda: TodoSerializer(todos, many=True).data
+
+
+@benchmark('TokenAuthentication.authenticate')
+def _token_auth():
+    user = User.objects.create_user('microbench-auth')
+    token = Token.objects.create(user=user)
+    request = Request(RequestFactory().get('/api/', HTTP_AUTHORIZATION=f"Token {token.key}"))
+    authentication = TokenAuthentication()
+    return lambda: authentication.authenticate(request)
+
+
+def measure(op, loop, repeat, min_time):
+    """Best seconds per call of ``op`` over ``repeat`` rounds of at least ``min_time`` each."""
+    if asyncio.iscoroutinefunction(op):
+        async def run(number):
+            started = time.perf_counter()
+            for _ in range(number):
+                await op()
+            return time.perf_counter() - started
+        timed = lambda number: loop.run_until_complete(run(number))
+    else:
+        def timed(number):
+            started = time.perf_counter()
+            for _ in range(number):
+                op()
+            return time.perf_counter() - started
+
+    timed(1)  # Warm up (imports, caches, first queries)
+    # Like timeit, keep garbage collection pauses out of the timings
+    gc.collect()
+    gc.disable()
+    try:
+        number = 1
+        while True:
+            elapsed = timed(number)
+            if elapsed >= min_time:
+                break
+            number = max(number * 2, int(number * min_time / max(elapsed, 1e-9)))
+        return min([elapsed / number] + [timed(number) / number for _ in range(repeat - 1)])
+    finally:
+        gc.enable()
+
+
+def calibration_op():
+    """Fixed pure-Python work, timed to scale the baseline to this machine's speed."""
+    data = {f"key{index}": [index, str(index), index / 3] for index in range(200)}
+    return sorted(json.loads(json.dumps(data)).items())
+
+
+def _fmt(seconds):
+    if seconds is None:
+        return '-'
+    if seconds >= 1e-3:
+        return f"{seconds * 1e3:.2f} ms"
+    return f"{seconds * 1e6:.1f} us"
+
+
+class Command(BaseCommand):
+    help = "Time LLMChat, todo and accounts hot paths and fail if they regressed against the baseline."
+
+    def add_arguments(self, parser):
+        parser.add_argument('-k', '--filter', nargs='+', default=[],
+                            help="Only run benchmarks whose name contains one of these strings")
+        parser.add_argument('--tolerance', type=float, default=0.5,
+                            help="Allowed slowdown against the baseline, as a fraction")
+        parser.add_argument('--repeat', type=int, default=5, help="Rounds per benchmark (the best one counts)")
+        parser.add_argument('--min-time', type=float, default=0.2, help="Minimum seconds per round")
+        parser.add_argument('--baseline', default=str(BASELINE_PATH), help="Baseline JSON file")
+        parser.add_argument('--save-baseline', action='store_true',
+                            help="Store the results as the new baseline instead of comparing")
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError("Benchmarks run on in-memory SQLite; use settings with a SQLite database.")
+        names = [name for name in BENCHMARKS
+                 if not options['filter'] or any(part in name for part in options['filter'])]
+        if not names:
+            raise CommandError("No benchmark matches the filter.")
+
+        baseline_path = Path(options['baseline'])
+        baseline = json.loads(baseline_path.read_text()) if baseline_path.exists() else {'benchmarks': {}}
+        results = {}
+        old_name = connection.settings_dict['NAME']
+        connection.settings_dict['TEST']['NAME'] = None  # in-memory
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        loop = asyncio.new_event_loop()
+        try:
+            self.stdout.write(f"{'benchmark':<40} {'per op':>12} {'baseline':>12} {'change':>8}")
+            for name in names:
+                op = BENCHMARKS[name]()
+                # Calibrate right before each benchmark, so drifting CPU speed is tracked too
+                calibration = measure(calibration_op, loop, options['repeat'], options['min_time'])
+                seconds = measure(op, loop, options['repeat'], options['min_time'])
+                results[name] = {'seconds': seconds, 'calibration': calibration}
+                expected = self._expected(baseline, name, calibration)
+                change = f"{100 * (seconds / expected - 1):+.1f}%" if expected else 'new'
+                self.stdout.write(f"{name:<40} {_fmt(seconds):>12} {_fmt(expected):>12} {change:>8}")
+        finally:
+            loop.close()
+            HISTORY_CACHE.clear()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if options['save_baseline']:
+            baseline['benchmarks'].update(results)
+            baseline.update(python=platform.python_version(), machine=platform.machine())
+            baseline_path.parent.mkdir(parents=True, exist_ok=True)
+            baseline_path.write_text(json.dumps(baseline, indent=2, sort_keys=True) + '\n')
+            self.stdout.write(f"Saved baseline to {baseline_path}")
+            return
+
+        regressed = [
+            name for name, result in results.items()
+            if name in baseline['benchmarks']
+            and result['seconds'] > self._expected(baseline, name, result['calibration']) * (1 + options['tolerance'])
+        ]
+        if regressed:
+            raise CommandError(
+                f"{len(regressed)} benchmark(s) regressed by more than {options['tolerance']:.0%}: "
+                + ", ".join(regressed)
+            )
+
+    @staticmethod
+    def _expected(baseline, name, calibration):
+        """Baseline time of ``name`` scaled to the current calibration, or ``None`` if new."""
+        recorded = baseline['benchmarks'].get(name)
+        if not recorded:
+            return None
+        return recorded['seconds'] * calibration / recorded['calibration']
@@ -0,0 +1,182 @@
+"""In-process latency, throughput and token usage metrics of LLM calls."""
+import bisect
+import math
+import threading
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+from .context import estimate_tokens
+
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKENS_PER_SECOND_BUCKETS = (1, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Histogram:
+    """Cumulative-bucket histogram (Prometheus style); not thread-safe on its own."""
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, percent: float) -> Optional[float]:
+        """Upper bound of the bucket holding the percentile (``inf`` past the last bucket)."""
+        if not self.count:
+            return None
+        rank = math.ceil(self.count * percent / 100)
+        seen = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return math.inf
+
+    def snapshot(self) -> Dict[str, Any]:
+        cumulative = []
+        seen = 0
+        for count in self.counts:
+            seen += count
+            cumulative.append(seen)
+        return {
+            'buckets': list(zip(self.buckets + (math.inf,), cumulative)),
+            'count': self.count,
+            'sum': self.sum,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+        }
+
+
+class ModelMetrics:
+    """Aggregates of one provider and model."""
+
+    def __init__(self):
+        self.ttft = Histogram(SECONDS_BUCKETS)
+        self.latency = Histogram(SECONDS_BUCKETS)
+        self.tokens_per_second = Histogram(TOKENS_PER_SECOND_BUCKETS)
+        self.requests = 0
+        self.errors = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.estimated_usage = 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'input_tokens': self.input_tokens,
+            'output_tokens': self.output_tokens,
+            'estimated_usage': self.estimated_usage,
+            'ttft_seconds': self.ttft.snapshot(),
+            'latency_seconds': self.latency.snapshot(),
+            'tokens_per_second': self.tokens_per_second.snapshot(),
+        }
+
+
+class LLMMetrics:
+    """Per provider and model histograms of time to first token, latency and tokens/sec."""
+
+    def __init__(self):
+        self._models: Dict[Tuple[str, str], ModelMetrics] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, provider) -> ModelMetrics:
+        key = (provider.name, provider.model_name)
+        metrics = self._models.get(key)
+        if metrics is None:
+            metrics = self._models[key] = ModelMetrics()
+        return metrics
+
+    def observe(self, provider, latency: float, input_tokens: int, output_tokens: int,
+                ttft: Optional[float] = None, estimated: bool = False) -> None:
+        with self._lock:
+            metrics = self._get(provider)
+            metrics.requests += 1
+            metrics.input_tokens += input_tokens
+            metrics.output_tokens += output_tokens
+            metrics.estimated_usage += int(estimated)
+            metrics.latency.observe(latency)
+            if ttft is not None:
+                metrics.ttft.observe(ttft)
+            rate = tokens_per_second(output_tokens, latency, ttft)
+            if rate is not None:
+                metrics.tokens_per_second.observe(rate)
+
+    def record_error(self, provider) -> None:
+        with self._lock:
+            self._get(provider).errors += 1
+
+    def snapshot(self) -> Dict[Tuple[str, str], Dict[str, Any]]:
+        with self._lock:
+            return {key: metrics.snapshot() for key, metrics in self._models.items()}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._models.clear()
+
+
+def tokens_per_second(output_tokens: int, latency: float, ttft: Optional[float] = None) -> Optional[float]:
+    """Output tokens per second of generation (after the first token, for streams)."""
+    generating = latency - ttft if ttft is not None else latency
+    if output_tokens <= 0 or generating <= 0:
+        return None
+    return output_tokens / generating
+
+
+class UsageEstimator:
+    """Estimates token counts from text when a provider reports no usage.
+
+    Starts at the same 4 characters per token as ``context.estimate_tokens``
+    and is calibrated per provider and model (separately for prompts and
+    completions) from every response that does report usage.
+    """
+
+    def __init__(self, alpha: float = 0.1):
+        self.alpha = alpha
+        self._ratios: Dict[Tuple[str, str, str], float] = {}
+        self._lock = threading.Lock()
+
+    def calibrate(self, provider, kind: str, chars: int, tokens: int) -> None:
+        if chars <= 0 or tokens <= 0:
+            return
+        key = (provider.name, provider.model_name, kind)
+        with self._lock:
+            ratio = self._ratios.get(key)
+            observed = chars / tokens
+            self._ratios[key] = observed if ratio is None else ratio + self.alpha * (observed - ratio)
+
+    def estimate(self, provider, kind: str, text: str) -> int:
+        with self._lock:
+            ratio = self._ratios.get((provider.name, provider.model_name, kind))
+        if ratio is None:
+            return estimate_tokens(text)
+        return math.ceil(len(text) / ratio) if text else 0
+
+
+def resolve_usage(provider, prompt: str, reply: str,
+                  reported: Optional[Dict[str, int]]) -> Tuple[Dict[str, int], bool]:
+    """Return ``(usage, estimated)`` for a call.
+
+    Usage the provider reported is used as is and calibrates the estimator;
+    without it, prompt and reply tokens are estimated from their text.
+    """
+    if reported and (reported.get('input_tokens') or reported.get('output_tokens')):
+        USAGE_ESTIMATOR.calibrate(provider, 'input', len(prompt), reported.get('input_tokens', 0))
+        USAGE_ESTIMATOR.calibrate(provider, 'output', len(reply), reported.get('output_tokens', 0))
+        return reported, False
+    input_tokens = USAGE_ESTIMATOR.estimate(provider, 'input', prompt)
+    output_tokens = USAGE_ESTIMATOR.estimate(provider, 'output', reply)
+    return {
+        'input_tokens': input_tokens,
+        'output_tokens': output_tokens,
+        'total_tokens': input_tokens + output_tokens,
+    }, True
+
+
+# Initialize the global LLM metrics and usage estimator
+LLM_METRICS = LLMMetrics()
+USAGE_ESTIMATOR = UsageEstimator()
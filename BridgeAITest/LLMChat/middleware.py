@@ -0,0 +1,99 @@
+"""HTTP request metrics and tracing middleware."""
+import re
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from .monitoring import METRICS
+from .tracing import TRACER, server_timing
+
+TRACEPARENT_RE = re.compile(r'^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$')
+
+
+def view_label(request) -> str:
+    """Class name of the resolved view (e.g. ``ChatAPIView``), or its URL name."""
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    view_class = getattr(match.func, 'view_class', None) or getattr(match.func, 'cls', None)
+    if view_class is not None:
+        return view_class.__name__
+    return match.view_name or getattr(match.func, '__name__', 'unknown')
+
+
+class MetricsMiddleware:
+    """Counts requests and observes their latency per view, method and status.
+
+    Works in both sync and async middleware chains, so it adds no thread
+    hop under ASGI.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        started = time.perf_counter()
+        response = self.get_response(request)
+        self.record(request, response, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        response = await self.get_response(request)
+        self.record(request, response, time.perf_counter() - started)
+        return response
+
+    @staticmethod
+    def record(request, response, duration: float) -> None:
+        view = view_label(request)
+        METRICS.inc('llmchat_http_requests_total', view=view, method=request.method, status=response.status_code)
+        METRICS.observe('llmchat_http_request_duration_seconds', duration, view=view, method=request.method)
+
+
+class TracingMiddleware:
+    """Runs every request in a trace span and reports its stages in ``Server-Timing``.
+
+    An incoming W3C ``traceparent`` header continues the caller's trace; the
+    trace id is returned in ``X-Trace-Id``.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def start_span(self, request):
+        match = TRACEPARENT_RE.match(request.headers.get('traceparent', ''))
+        trace_id, parent_id = match.groups() if match else (None, None)
+        return TRACER.span('http.request', trace_id=trace_id, parent_id=parent_id, collect=True,
+                           method=request.method, path=request.path)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with self.start_span(request) as span:
+            response = self.get_response(request)
+            self.annotate(span, request, response)
+        return response
+
+    async def __acall__(self, request):
+        with self.start_span(request) as span:
+            response = await self.get_response(request)
+            self.annotate(span, request, response)
+        return response
+
+    @staticmethod
+    def annotate(span, request, response) -> None:
+        span.set(view=view_label(request), status=response.status_code)
+        response['Server-Timing'] = server_timing(span)
+        response['X-Trace-Id'] = span.trace_id
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 05:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('LLMChat', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatlog',
+            name='turn_tokens',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.4 on 2026-10-18 05:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('LLMChat', '0002_chatlog_turn_tokens'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='summarized_turns',
+            field=models.IntegerField(default=0, help_text='Number of oldest turns folded into the summary'),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='summary',
+            field=models.TextField(blank=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 05:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('LLMChat', '0003_conversation_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatlog',
+            name='cached',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.1.4 on 2026-10-18 05:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('LLMChat', '0004_chatlog_cached'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatlog',
+            name='latency_ms',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatlog',
+            name='tokens_per_second',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatlog',
+            name='ttft_ms',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatlog',
+            name='usage_estimated',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.4 on 2026-10-18 06:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('LLMChat', '0005_chatlog_timings'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='modelprovider',
+            name='api_key',
+            field=models.CharField(blank=True, help_text='Not needed for local models', max_length=200),
+        ),
+        migrations.AlterField(
+            model_name='modelprovider',
+            name='provider',
+            field=models.CharField(choices=[('openai', 'OpenAI'), ('cohere', 'Cohere'), ('anthropic', 'Anthropic'), ('huggingface', 'HuggingFace'), ('azure_openai', 'Azure OpenAI'), ('google', 'Google PaLM/Gemini'), ('llama_cpp', 'llama.cpp (local GGUF)')], max_length=20),
+        ),
+    ]
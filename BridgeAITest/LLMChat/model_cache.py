@@ -0,0 +1,87 @@
+"""Process-wide cache of instantiated LangChain chat models."""
+import hashlib
+import json
+import logging
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def provider_fingerprint(provider, tool_names: Iterable[str]) -> str:
+    """Hash every provider setting that changes how its chat model is built."""
+    payload = {
+        'provider': provider.provider,
+        'model_name': provider.model_name,
+        'api_key': provider.api_key,
+        'temperature': provider.temperature,
+        'max_tokens': provider.max_tokens,
+        'top_p': provider.top_p,
+        'extra_settings': provider.extra_settings,
+        'tools': sorted(tool_names),
+    }
+    raw = json.dumps(payload, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class ChatModelCache:
+    """Keeps one chat model (and its HTTP client) per provider configuration.
+
+    Entries are keyed by ``(ModelProvider.id, fingerprint)`` so an edited
+    provider never gets a model built from its old settings. The list of
+    enabled tool names is cached alongside because it is part of every
+    fingerprint. ``generation`` is bumped on each invalidation; a build that
+    started before an invalidation is not stored.
+    """
+
+    def __init__(self):
+        self._models: Dict[Tuple[int, str], Any] = {}
+        self._tool_names: Optional[List[str]] = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    @property
+    def tool_names(self) -> Optional[List[str]]:
+        return self._tool_names
+
+    def set_tool_names(self, tool_names: List[str], generation: int) -> None:
+        """Store the enabled tool names unless an invalidation happened meanwhile."""
+        with self._lock:
+            if generation == self._generation:
+                self._tool_names = list(tool_names)
+
+    def get(self, provider_id: int, fingerprint: str) -> Any:
+        """Return the cached model or ``None``."""
+        return self._models.get((provider_id, fingerprint))
+
+    def set(self, provider_id: int, fingerprint: str, llm: Any, generation: int) -> None:
+        """Cache a model, replacing any model built from older provider settings."""
+        with self._lock:
+            if generation != self._generation:
+                return
+            for key in [key for key in self._models if key[0] == provider_id]:
+                del self._models[key]
+            self._models[(provider_id, fingerprint)] = llm
+
+    def invalidate(self, provider_id: Optional[int] = None) -> None:
+        """Drop the models of one provider, or everything (including tool names)."""
+        with self._lock:
+            self._generation += 1
+            if provider_id is None:
+                self._models.clear()
+                self._tool_names = None
+            else:
+                for key in [key for key in self._models if key[0] == provider_id]:
+                    del self._models[key]
+        logger.debug(f"Chat model cache invalidated (provider={provider_id})")
+
+    def __len__(self) -> int:
+        return len(self._models)
+
+
+# Initialize the global chat model cache
+MODEL_CACHE = ChatModelCache()
@@ -10,12 +10,13 @@ class ModelProvider(models.Model):
         ('huggingface', 'HuggingFace'),
         ('azure_openai', 'Azure OpenAI'),
         ('google', 'Google PaLM/Gemini'),
+        ('llama_cpp', 'llama.cpp (local GGUF)'),
     ]
     
     name = models.CharField(max_length=50, unique=True)
     provider = models.CharField(max_length=20, choices=PROVIDER_CHOICES)
     model_name = models.CharField(max_length=100)
-    api_key = models.CharField(max_length=200)
+    api_key = models.CharField(max_length=200, blank=True, help_text="Not needed for local models")
     
     # Common model parameters
     temperature = models.FloatField(default=0.7)
@@ -49,6 +50,9 @@ class ModelProvider(models.Model):
         if self.provider == 'huggingface' and 'api_base' not in self.extra_settings:
             raise ValidationError({'extra_settings': 'HuggingFace requires api_base URL'})
 
+        if self.provider == 'llama_cpp' and 'model_path' not in self.extra_settings:
+            raise ValidationError({'extra_settings': 'llama.cpp requires the model_path of a GGUF file'})
+
 class Tool(models.Model):
     """Metadata for a custom tool (Python function) that LLM can call."""
     name = models.CharField(max_length=100, unique=True)  # tool identifier
@@ -66,6 +70,9 @@ class Conversation(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     title = models.CharField(max_length=200, blank=True)
     system_prompt = models.TextField(blank=True)
+    # Running summary of the oldest turns, maintained by the background summarizer
+    summary = models.TextField(blank=True)
+    summarized_turns = models.IntegerField(default=0, help_text="Number of oldest turns folded into the summary")
     
     def __str__(self):
         return f"Conversation {self.id} - {self.title or 'Untitled'}"
@@ -80,6 +87,16 @@ class ChatLog(models.Model):
     input_tokens = models.IntegerField()
     output_tokens = models.IntegerField()
     total_tokens = models.IntegerField()
+    # Estimated tokens of user_message + ai_response, used to trim history to a context budget
+    turn_tokens = models.IntegerField(default=0)
+    # Served from a response cache without calling the provider (tokens are zero)
+    cached = models.BooleanField(default=False)
+    # Timings of the provider call (time to first token only for streamed replies)
+    ttft_ms = models.FloatField(null=True, blank=True)
+    latency_ms = models.FloatField(null=True, blank=True)
+    tokens_per_second = models.FloatField(null=True, blank=True)
+    # Token counts were estimated from the text because the provider reported none
+    usage_estimated = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     
     class Meta:
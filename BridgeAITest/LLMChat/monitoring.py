@@ -0,0 +1,489 @@
+"""Prometheus metrics for HTTP views, WebSocket consumers and LLM providers.
+
+Every worker process keeps its own counters, gauges and histograms. With
+LLMCHAT_METRICS_DIR set (one directory per host), each process writes a
+snapshot to ``<dir>/metrics-<pid>-<start time>.json`` every flush interval
+and when it exits, and ``/metrics`` merges the snapshots of the running
+processes. Snapshots of processes that are gone, or that were not rewritten
+for LLMCHAT_METRICS_SNAPSHOT_TTL seconds, are deleted while merging; their
+counters drop out of the totals, which Prometheus treats as a counter
+reset. The start time keeps a new worker that got a dead worker's pid from
+being mistaken for it.
+"""
+import atexit
+import glob
+import hmac
+import ipaddress
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from django.conf import settings
+
+from .metrics import SECONDS_BUCKETS, Histogram
+
+logger = logging.getLogger(__name__)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def label_key(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def format_bound(bound: float) -> str:
+    return '+Inf' if bound == math.inf else repr(float(bound))
+
+
+class RateMeter:
+    """Events per second over a sliding window of whole seconds."""
+
+    def __init__(self, window: int = 60):
+        self.window = window
+        self._counts: Dict[int, int] = defaultdict(int)
+
+    def mark(self, count: int = 1) -> None:
+        now = int(time.time())
+        self._counts[now] += count
+        if len(self._counts) > self.window * 2:
+            for second in [s for s in self._counts if s <= now - self.window]:
+                del self._counts[second]
+
+    def rate(self) -> float:
+        since = int(time.time()) - self.window
+        return sum(count for second, count in self._counts.items() if second > since) / self.window
+
+
+class MetricsRegistry:
+    """Process-local metric store plus collectors for stats kept elsewhere."""
+
+    def __init__(self):
+        self._help: Dict[str, Tuple[str, str]] = {}
+        self._values: Dict[str, Dict[Labels, float]] = defaultdict(dict)
+        self._histograms: Dict[str, Dict[Labels, Histogram]] = defaultdict(dict)
+        self._rates: Dict[str, Dict[Labels, RateMeter]] = defaultdict(dict)
+        self._collectors: List[Callable[[], List[dict]]] = []
+        self._lock = threading.Lock()
+        self._flusher = None
+
+    def describe(self, name: str, kind: str, help_text: str) -> None:
+        self._help[name] = (kind, help_text)
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        key = label_key(labels)
+        with self._lock:
+            values = self._values[name]
+            values[key] = values.get(key, 0) + amount
+        self._ensure_flusher()
+
+    def dec(self, name: str, amount: float = 1, **labels) -> None:
+        self.inc(name, -amount, **labels)
+
+    def observe(self, name: str, value: float, buckets=SECONDS_BUCKETS, **labels) -> None:
+        key = label_key(labels)
+        with self._lock:
+            histogram = self._histograms[name].get(key)
+            if histogram is None:
+                histogram = self._histograms[name][key] = Histogram(buckets)
+            histogram.observe(value)
+        self._ensure_flusher()
+
+    def mark(self, name: str, **labels) -> None:
+        """Count an event towards a per-second rate gauge."""
+        key = label_key(labels)
+        with self._lock:
+            meter = self._rates[name].get(key)
+            if meter is None:
+                meter = self._rates[name][key] = RateMeter()
+            meter.mark()
+
+    def register_collector(self, collector: Callable[[], List[dict]]) -> None:
+        """``collector`` returns families built with ``family()``; called on every snapshot."""
+        self._collectors.append(collector)
+
+    def collect(self) -> Dict[str, dict]:
+        """Snapshot of this process as JSON-serializable families."""
+        families: Dict[str, dict] = {}
+        with self._lock:
+            for name, values in self._values.items():
+                kind, help_text = self._help.get(name, (COUNTER, ''))
+                families[name] = family(name, kind, help_text, [(dict(key), value) for key, value in values.items()])
+            for name, histograms in self._histograms.items():
+                kind, help_text = self._help.get(name, (HISTOGRAM, ''))
+                families[name] = family(name, HISTOGRAM, help_text, [
+                    (dict(key), histogram_sample(histogram.snapshot())) for key, histogram in histograms.items()
+                ])
+            for name, meters in self._rates.items():
+                kind, help_text = self._help.get(name, (GAUGE, ''))
+                families[name] = family(name, GAUGE, help_text,
+                                        [(dict(key), meter.rate()) for key, meter in meters.items()])
+        for collector in self._collectors:
+            try:
+                for collected in collector():
+                    families[collected['name']] = collected
+            except Exception as e:
+                logger.error(f"Metrics collector {collector.__name__} failed: {str(e)}", exc_info=True)
+        return families
+
+    def write_snapshot(self) -> None:
+        """Write this process' snapshot to LLMCHAT_METRICS_DIR (no-op if unset)."""
+        directory = metrics_dir()
+        if not directory:
+            return
+        os.makedirs(directory, exist_ok=True)
+        pid, started = os.getpid(), process_started()
+        path = os.path.join(directory, f'metrics-{pid}-{started}.json')
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as handle:
+            json.dump({'pid': pid, 'started': started, 'written_at': time.time(),
+                       'families': self.collect()}, handle)
+        os.replace(tmp_path, path)
+
+    def _ensure_flusher(self) -> None:
+        if self._flusher is not None or not metrics_dir():
+            return
+        with self._lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, name='metrics-flusher', daemon=True)
+                self._flusher.start()
+                atexit.register(self.write_snapshot)
+
+    def _flush_loop(self) -> None:
+        interval = getattr(settings, 'LLMCHAT_METRICS_FLUSH_INTERVAL', 5.0)
+        while True:
+            time.sleep(interval)
+            try:
+                self.write_snapshot()
+            except Exception as e:
+                logger.error(f"Writing metrics snapshot failed: {str(e)}")
+
+
+def metrics_dir() -> Optional[str]:
+    directory = getattr(settings, 'LLMCHAT_METRICS_DIR', None)
+    return str(directory) if directory else None
+
+
+def family(name: str, kind: str, help_text: str, samples: List[Tuple[Dict[str, Any], Any]],
+           aggregate: str = 'sum') -> dict:
+    """A metric family; gauges can be aggregated across processes with ``sum``, ``max`` or ``min``."""
+    return {
+        'name': name,
+        'type': kind,
+        'help': help_text,
+        'aggregate': aggregate,
+        'samples': [[{key: str(value) for key, value in labels.items()}, value] for labels, value in samples],
+    }
+
+
+def histogram_sample(snapshot: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'buckets': [[format_bound(bound), count] for bound, count in snapshot['buckets']],
+        'sum': snapshot['sum'],
+        'count': snapshot['count'],
+    }
+
+
+def start_time(pid: int) -> Optional[int]:
+    """When ``pid`` started, in clock ticks since boot, or ``None`` without ``/proc``."""
+    try:
+        with open(f'/proc/{pid}/stat', encoding='utf-8') as handle:
+            stat = handle.read()
+    except OSError:
+        return None
+    # starttime is the 22nd field; the command name before it may contain spaces
+    return int(stat.rsplit(')', 1)[1].split()[19])
+
+
+_started: Dict[int, int] = {}
+
+
+def process_started() -> int:
+    """Start time of this process, which together with the pid names it uniquely.
+
+    Falls back to the first call's wall clock time (in milliseconds) where
+    ``/proc`` is not available. Cached per pid, so forked workers get their own.
+    """
+    pid = os.getpid()
+    if pid not in _started:
+        started = start_time(pid)
+        _started[pid] = started if started is not None else int(time.time() * 1000)
+    return _started[pid]
+
+
+def process_alive(pid: int, started: Optional[int] = None) -> bool:
+    """Whether ``pid`` runs and, where it can be checked, is still the process that started at ``started``."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    if started is None:
+        return True
+    current = start_time(pid)
+    return current is None or current == started
+
+
+def load_snapshots() -> List[dict]:
+    """Snapshots of the running processes, with this process' one freshly collected.
+
+    Snapshots of exited processes and ones older than LLMCHAT_METRICS_SNAPSHOT_TTL are deleted.
+    """
+    snapshots = [{'pid': os.getpid(), 'started': process_started(), 'families': METRICS.collect()}]
+    directory = metrics_dir()
+    if not directory:
+        return snapshots
+    ttl = getattr(settings, 'LLMCHAT_METRICS_SNAPSHOT_TTL', 300.0)
+    for path in glob.glob(os.path.join(directory, 'metrics-*.json')):
+        try:
+            with open(path, encoding='utf-8') as handle:
+                snapshot = json.load(handle)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Skipping unreadable metrics snapshot {path}: {str(e)}")
+            continue
+        if snapshot.get('pid') == os.getpid() and snapshot.get('started') == process_started():
+            continue
+        expired = ttl and time.time() - snapshot.get('written_at', 0) > ttl
+        if expired or not process_alive(snapshot['pid'], snapshot.get('started')):
+            logger.info(f"Removing stale metrics snapshot {path}")
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # another worker's scrape removed it first
+            continue
+        snapshots.append(snapshot)
+    return snapshots
+
+
+def merge_snapshots(snapshots: List[dict]) -> Dict[str, dict]:
+    """Combine the families of several processes: counters, histograms and sum gauges add up."""
+    merged: Dict[str, dict] = {}
+    for snapshot in snapshots:
+        for name, source in snapshot['families'].items():
+            target = merged.setdefault(name, {**source, 'samples': {}})
+            for labels, value in source['samples']:
+                key = label_key(labels)
+                current = target['samples'].get(key)
+                if current is None:
+                    target['samples'][key] = value
+                elif source['type'] == HISTOGRAM:
+                    target['samples'][key] = {
+                        'buckets': [[bound, count + other] for (bound, count), (_, other)
+                                    in zip(current['buckets'], value['buckets'])],
+                        'sum': current['sum'] + value['sum'],
+                        'count': current['count'] + value['count'],
+                    }
+                elif source.get('aggregate') == 'max':
+                    target['samples'][key] = max(current, value)
+                elif source.get('aggregate') == 'min':
+                    target['samples'][key] = min(current, value)
+                else:
+                    target['samples'][key] = current + value
+    return merged
+
+
+def escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels: Labels, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+
+def render(merged: Dict[str, dict]) -> str:
+    """Prometheus text exposition format (version 0.0.4)."""
+    lines = []
+    for name in sorted(merged):
+        metric = merged[name]
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        for labels, value in sorted(metric['samples'].items()):
+            if metric['type'] == HISTOGRAM:
+                for bound, count in value['buckets']:
+                    lines.append(f"{name}_bucket{format_labels(labels, (('le', bound),))} {count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {value['sum']}")
+                lines.append(f"{name}_count{format_labels(labels)} {value['count']}")
+            else:
+                lines.append(f"{name}{format_labels(labels)} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+def scrape_allowed(request) -> bool:
+    """Whether ``request`` may read ``/metrics``.
+
+    Allowed are clients whose address is in LLMCHAT_METRICS_ALLOWED_IPS
+    (addresses or networks) and, when LLMCHAT_METRICS_TOKEN is set, requests
+    sending ``Authorization: Bearer <token>``. Behind a reverse proxy the
+    proxy's address is the client address, so set a token or have the proxy
+    restrict the path.
+    """
+    token = getattr(settings, 'LLMCHAT_METRICS_TOKEN', None)
+    if token:
+        scheme, _, credentials = request.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() == 'bearer' and hmac.compare_digest(credentials.strip().encode(), token.encode()):
+            return True
+    try:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        return False
+    for allowed in getattr(settings, 'LLMCHAT_METRICS_ALLOWED_IPS', ['127.0.0.1', '::1']):
+        try:
+            if address in ipaddress.ip_network(allowed, strict=False):
+                return True
+        except ValueError:
+            logger.warning(f"Ignoring invalid LLMCHAT_METRICS_ALLOWED_IPS entry {allowed!r}")
+    return False
+
+
+def export() -> str:
+    """Metrics of all worker processes in Prometheus text format."""
+    return render(merge_snapshots(load_snapshots()))
+
+
+class ConsumerMetricsMixin:
+    """Counts open connections and messages of a WebSocket consumer.
+
+    Put it before ``AsyncWebsocketConsumer`` in the bases; the consumer's
+    class name is the ``consumer`` label.
+    """
+
+    _metrics_open = False
+
+    async def accept(self, *args, **kwargs):
+        await super().accept(*args, **kwargs)
+        if not self._metrics_open:
+            self._metrics_open = True
+            consumer = type(self).__name__
+            METRICS.inc('llmchat_websocket_connections', consumer=consumer)
+            METRICS.inc('llmchat_websocket_connections_total', consumer=consumer)
+
+    async def websocket_receive(self, message):
+        consumer = type(self).__name__
+        METRICS.inc('llmchat_websocket_messages_total', consumer=consumer, direction='received')
+        METRICS.mark('llmchat_websocket_messages_per_second', consumer=consumer, direction='received')
+        await super().websocket_receive(message)
+
+    async def send(self, *args, **kwargs):
+        consumer = type(self).__name__
+        METRICS.inc('llmchat_websocket_messages_total', consumer=consumer, direction='sent')
+        METRICS.mark('llmchat_websocket_messages_per_second', consumer=consumer, direction='sent')
+        await super().send(*args, **kwargs)
+
+    async def websocket_disconnect(self, message):
+        if self._metrics_open:
+            self._metrics_open = False
+            METRICS.dec('llmchat_websocket_connections', consumer=type(self).__name__)
+        await super().websocket_disconnect(message)
+
+
+def collect_llm_metrics() -> List[dict]:
+    """Per provider and model call stats from LLM_METRICS."""
+    from .metrics import LLM_METRICS
+
+    snapshot = LLM_METRICS.snapshot()
+    labelled = [({'provider': provider, 'model': model}, stats) for (provider, model), stats in snapshot.items()]
+    families = [
+        family(f'llmchat_llm_{key}_total', COUNTER, help_text, [(labels, stats[key]) for labels, stats in labelled])
+        for key, help_text in (
+            ('requests', 'Completed LLM calls.'),
+            ('errors', 'Failed LLM calls.'),
+            ('input_tokens', 'Prompt tokens used.'),
+            ('output_tokens', 'Completion tokens used.'),
+            ('estimated_usage', 'Calls whose token usage was estimated.'),
+        )
+    ]
+    families += [
+        family(f'llmchat_llm_{key}', HISTOGRAM, help_text,
+               [(labels, histogram_sample(stats[key])) for labels, stats in labelled])
+        for key, help_text in (
+            ('ttft_seconds', 'Time to first token of streamed LLM calls.'),
+            ('latency_seconds', 'Total latency of LLM calls.'),
+            ('tokens_per_second', 'Output tokens per second of LLM calls.'),
+        )
+    ]
+    return families
+
+
+def collect_provider_metrics() -> List[dict]:
+    """Circuit breakers, limiter queues, hedging, single-flight and response cache stats."""
+    from .limits import LIMITS
+    from .resilience import BREAKERS, HEDGE_STATS, CircuitBreaker
+    from .response_cache import RESPONSE_CACHE
+    from .singleflight import SINGLE_FLIGHT
+
+    circuit_values = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+    limits = LIMITS.stats()
+    hedges = HEDGE_STATS.snapshot()
+    flights = SINGLE_FLIGHT.stats()
+    cache = RESPONSE_CACHE.stats()
+    return [
+        family('llmchat_provider_circuit_state', GAUGE, 'Circuit breaker state (0 closed, 1 half-open, 2 open).',
+               [({'provider': name}, circuit_values[state]) for name, state in BREAKERS.states().items()],
+               aggregate='max'),
+        family('llmchat_provider_active_calls', GAUGE, 'Calls holding a provider slot.',
+               [({'provider': name}, stats['active']) for name, stats in limits.items()]),
+        family('llmchat_provider_queue_depth', GAUGE, 'Calls waiting for a provider slot.',
+               [({'provider': name}, stats['queue_depth']) for name, stats in limits.items()]),
+        family('llmchat_provider_queue_granted_total', COUNTER, 'Provider slots granted.',
+               [({'provider': name}, stats['granted']) for name, stats in limits.items()]),
+        family('llmchat_provider_queue_wait_seconds_total', COUNTER, 'Time spent waiting for provider slots.',
+               [({'provider': name}, stats['total_wait']) for name, stats in limits.items()]),
+        family('llmchat_provider_queue_timeouts_total', COUNTER, 'Calls that gave up waiting for a provider slot.',
+               [({'provider': name}, stats['timed_out']) for name, stats in limits.items()]),
+        family('llmchat_hedges_total', COUNTER, 'Hedged stream requests by outcome.',
+               [({'provider': name, 'outcome': outcome}, count)
+                for name, counts in hedges.items() for outcome, count in counts.items()]),
+        family('llmchat_single_flight_calls_total', COUNTER, 'Chat requests by single-flight role.',
+               [({'role': 'leader'}, flights['leaders']), ({'role': 'joined'}, flights['joined'])]),
+        family('llmchat_response_cache_lookups_total', COUNTER, 'Exact-match response cache lookups.',
+               [({'result': 'hit'}, cache['hits']), ({'result': 'miss'}, cache['misses'])]),
+    ]
+
+
+def collect_http_pool_metrics() -> List[dict]:
+    """Per host connection reuse of the shared HTTP pools."""
+    from .http_pool import HTTP_POOLS
+
+    hosts = [({'host': host}, stats) for host, stats in HTTP_POOLS.stats().items()]
+    families = [
+        family(f'llmchat_http_pool_{key}_total', COUNTER, help_text, [(labels, stats[key]) for labels, stats in hosts])
+        for key, help_text in (
+            ('requests', 'Requests sent through the shared HTTP pools.'),
+            ('reused', 'Requests sent on a kept-alive connection.'),
+            ('connections', 'Connections opened.'),
+            ('tls_handshakes', 'TLS handshakes performed.'),
+        )
+    ]
+    families += [
+        family('llmchat_http_pool_handshakes_per_second', GAUGE, 'TLS handshakes per second over the last minute.',
+               [(labels, stats['handshakes_per_second']) for labels, stats in hosts]),
+        family('llmchat_http_pool_reuse_ratio', GAUGE, 'Share of requests sent on a kept-alive connection (worst process).',
+               [(labels, stats['reuse_ratio']) for labels, stats in hosts if stats['reuse_ratio'] is not None],
+               aggregate='min'),
+    ]
+    return families
+
+
+# Initialize the global metrics registry
+METRICS = MetricsRegistry()
+METRICS.describe('llmchat_http_requests_total', COUNTER, 'HTTP requests by view, method and status.')
+METRICS.describe('llmchat_http_request_duration_seconds', HISTOGRAM, 'HTTP request latency by view and method.')
+METRICS.describe('llmchat_websocket_connections', GAUGE, 'Open WebSocket connections.')
+METRICS.describe('llmchat_websocket_connections_total', COUNTER, 'Accepted WebSocket connections.')
+METRICS.describe('llmchat_websocket_messages_total', COUNTER, 'WebSocket messages by direction.')
+METRICS.describe('llmchat_websocket_messages_per_second', GAUGE, 'WebSocket messages per second over the last minute.')
+METRICS.register_collector(collect_llm_metrics)
+METRICS.register_collector(collect_provider_metrics)
+METRICS.register_collector(collect_http_pool_metrics)
@@ -0,0 +1,188 @@
+"""Direct streaming from OpenAI-compatible and Anthropic APIs, without LangChain.
+
+Streaming through a LangChain chat model builds a message chunk, runs the
+callback machinery and merges metadata for every token. These clients read
+the server-sent events themselves and yield just the text, which is all the
+chat service passes on.
+"""
+import json
+import logging
+from typing import Any, AsyncIterator, Dict, List, NamedTuple, Optional, Tuple
+
+import httpx
+from django.conf import settings
+
+from .http_pool import HTTP_POOLS
+
+logger = logging.getLogger(__name__)
+
+_ROLES = {'system': 'system', 'human': 'user', 'ai': 'assistant'}
+
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def http_client() -> httpx.AsyncClient:
+    """The HTTP client native streams share; its connections come from HTTP_POOLS."""
+    global _http_client
+    if _http_client is None:
+        _http_client = HTTP_POOLS.async_client(timeout=httpx.Timeout(60.0, connect=10.0))
+    return _http_client
+
+
+def native_streaming(config: Dict[str, Any]) -> bool:
+    """Whether a provider streams natively (extra_settings['native_stream'] or LLMCHAT_NATIVE_STREAMING)."""
+    extra = config.get('extra_settings') or {}
+    return bool(extra.get('native_stream', getattr(settings, 'LLMCHAT_NATIVE_STREAMING', False)))
+
+
+class StreamDelta(NamedTuple):
+    """A piece of a streamed reply, read like the LangChain chunks it replaces."""
+    content: str
+    usage_metadata: Optional[Dict[str, int]] = None
+
+
+async def sse_events(response: httpx.Response) -> AsyncIterator[Tuple[Optional[str], str]]:
+    """The ``(event, data)`` pairs of a ``text/event-stream`` response."""
+    event, data = None, []
+    async for line in response.aiter_lines():
+        if not line:
+            if data:
+                yield event, "\n".join(data)
+            event, data = None, []
+        elif line.startswith('data:'):
+            data.append(line[6:] if line.startswith('data: ') else line[5:])
+        elif line.startswith('event:'):
+            event = line[6:].strip()
+        # Comments (":") and other fields carry nothing for us
+    if data:
+        yield event, "\n".join(data)
+
+
+class NativeStreamClient:
+    """Streams a chat reply straight from a provider's HTTP API.
+
+    ``astream(messages)`` yields StreamDelta pieces: the text as it arrives,
+    then one with the usage the provider reported. Tool calls are not
+    supported, so the chat service only uses these while no tools are enabled.
+    """
+
+    default_api_base = ''
+
+    def __init__(self, config: Dict[str, Any], http: Optional[httpx.AsyncClient] = None):
+        extra = config.get('extra_settings') or {}
+        self.model_name = config['model_name']
+        self.temperature = config['temperature']
+        self.max_tokens = config['max_tokens']
+        self.top_p = config['top_p']
+        self.api_key = config['api_key']
+        self.api_base = (extra.get('api_base') or self.default_api_base).rstrip('/')
+        self.extra = extra
+        self.http = http
+
+    def request(self, messages: List[Any]) -> Tuple[str, Dict[str, str], Dict[str, Any]]:
+        """URL, headers and JSON body of the streaming request."""
+        raise NotImplementedError
+
+    def deltas(self, events: AsyncIterator[Tuple[Optional[str], str]]) -> AsyncIterator[StreamDelta]:
+        raise NotImplementedError
+
+    async def astream(self, messages: List[Any]) -> AsyncIterator[StreamDelta]:
+        url, headers, body = self.request(messages)
+        async with (self.http or http_client()).stream('POST', url, headers=headers, json=body) as response:
+            if response.is_error:
+                await response.aread()
+                raise httpx.HTTPStatusError(
+                    f"{url} returned HTTP {response.status_code}: {response.text[:500]}",
+                    request=response.request, response=response,
+                )
+            async for delta in self.deltas(sse_events(response)):
+                yield delta
+
+
+class OpenAIStreamClient(NativeStreamClient):
+    """Chat completions streaming of OpenAI and compatible servers (``api_base`` in extra_settings).
+
+    Usage is requested with ``stream_options``; servers that reject it can
+    set ``stream_usage`` to false, and usage is then estimated.
+    """
+
+    default_api_base = 'https://api.openai.com/v1'
+
+    def request(self, messages: List[Any]) -> Tuple[str, Dict[str, str], Dict[str, Any]]:
+        body = {
+            'model': self.model_name,
+            'messages': [{'role': _ROLES.get(message.type, 'user'), 'content': str(message.content)}
+                         for message in messages],
+            'temperature': self.temperature,
+            'max_tokens': self.max_tokens,
+            'top_p': self.top_p,
+            'stream': True,
+        }
+        if self.extra.get('stream_usage', True):
+            body['stream_options'] = {'include_usage': True}
+        return f"{self.api_base}/chat/completions", {'Authorization': f"Bearer {self.api_key}"}, body
+
+    async def deltas(self, events: AsyncIterator[Tuple[Optional[str], str]]) -> AsyncIterator[StreamDelta]:
+        async for _, data in events:
+            if data == '[DONE]':
+                return
+            payload = json.loads(data)
+            if 'error' in payload:
+                raise ValueError(f"Stream error: {payload['error']}")
+            choices = payload.get('choices')
+            content = (choices[0].get('delta') or {}).get('content') if choices else None
+            usage = payload.get('usage')
+            if usage:
+                yield StreamDelta(content or '', {
+                    'input_tokens': usage.get('prompt_tokens', 0),
+                    'output_tokens': usage.get('completion_tokens', 0),
+                    'total_tokens': usage.get('total_tokens', 0),
+                })
+            elif content:
+                yield StreamDelta(content)
+
+
+class AnthropicStreamClient(NativeStreamClient):
+    """Anthropic Messages API streaming."""
+
+    default_api_base = 'https://api.anthropic.com/v1'
+    api_version = '2023-06-01'
+
+    def request(self, messages: List[Any]) -> Tuple[str, Dict[str, str], Dict[str, Any]]:
+        system = "\n\n".join(str(message.content) for message in messages if message.type == 'system')
+        body = {
+            'model': self.model_name,
+            'messages': [{'role': _ROLES.get(message.type, 'user'), 'content': str(message.content)}
+                         for message in messages if message.type != 'system'],
+            'max_tokens': self.max_tokens,
+            'temperature': self.temperature,
+            'stream': True,
+        }
+        if system:
+            body['system'] = system
+        headers = {'x-api-key': self.api_key, 'anthropic-version': self.extra.get('api_version', self.api_version)}
+        return f"{self.api_base}/messages", headers, body
+
+    async def deltas(self, events: AsyncIterator[Tuple[Optional[str], str]]) -> AsyncIterator[StreamDelta]:
+        input_tokens = output_tokens = 0
+        async for event, data in events:
+            if event == 'ping':
+                continue
+            payload = json.loads(data)
+            kind = payload.get('type')
+            if kind == 'content_block_delta':
+                text = payload['delta'].get('text')
+                if text:
+                    yield StreamDelta(text)
+            elif kind == 'message_start':
+                usage = payload['message'].get('usage') or {}
+                input_tokens = usage.get('input_tokens', 0)
+                output_tokens = usage.get('output_tokens', 0)
+            elif kind == 'message_delta':
+                output_tokens = (payload.get('usage') or {}).get('output_tokens', output_tokens)
+            elif kind == 'error':
+                raise ValueError(f"Stream error: {payload.get('error')}")
+            elif kind == 'message_stop':
+                break
+        yield StreamDelta('', {'input_tokens': input_tokens, 'output_tokens': output_tokens,
+                               'total_tokens': input_tokens + output_tokens})
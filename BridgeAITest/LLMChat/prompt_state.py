@@ -0,0 +1,257 @@
+"""Evaluated prompt state of local-model conversations, kept between turns."""
+import contextlib
+import contextvars
+import hashlib
+import logging
+import os
+import struct
+import threading
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, NamedTuple, Optional, Tuple
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Conversation the current request belongs to, for models that keep per-conversation state
+_conversation: contextvars.ContextVar = contextvars.ContextVar('llmchat_conversation', default=None)
+# Whether the current request's reply also goes to callers of other conversations
+_shared: contextvars.ContextVar = contextvars.ContextVar('llmchat_shared_generation', default=False)
+
+_MAGIC = b'LLKV1'
+_HEADER = struct.Struct('<5sI')
+
+
+@contextlib.contextmanager
+def conversation_scope(conversation_id: Optional[int], shared: bool = False) -> Iterator[None]:
+    """Make ``conversation_id`` current; tasks started inside inherit it.
+
+    ``shared`` marks a generation that single-flight may hand to callers of
+    other conversations; no prompt state is kept from it.
+    """
+    token = _conversation.set(conversation_id)
+    shared_token = _shared.set(shared)
+    try:
+        yield
+    finally:
+        _shared.reset(shared_token)
+        _conversation.reset(token)
+
+
+def current_conversation() -> Optional[int]:
+    return _conversation.get()
+
+
+def shared_generation() -> bool:
+    return _shared.get()
+
+
+class PromptState(NamedTuple):
+    """The KV-cache contents of one sequence and the tokens they were evaluated from."""
+    tokens: Tuple[int, ...]
+    data: bytes
+
+    @property
+    def size(self) -> int:
+        return len(self.data) + 4 * len(self.tokens)
+
+    def dumps(self) -> bytes:
+        return _HEADER.pack(_MAGIC, len(self.tokens)) + array('i', self.tokens).tobytes() + self.data
+
+    @classmethod
+    def loads(cls, payload: bytes) -> 'PromptState':
+        magic, count = _HEADER.unpack_from(payload)
+        if magic != _MAGIC:
+            raise ValueError("Not a prompt state file")
+        start = _HEADER.size
+        tokens = array('i')
+        tokens.frombytes(payload[start:start + 4 * count])
+        return cls(tuple(tokens), payload[start + 4 * count:])
+
+
+def common_prefix(left, right) -> int:
+    """Length of the common prefix of two token sequences."""
+    count = 0
+    for a, b in zip(left, right):
+        if a != b:
+            break
+        count += 1
+    return count
+
+
+class PromptStateCache:
+    """Prompt states keyed by ``(model, conversation id)``.
+
+    At most ``max_bytes`` of states are held in memory; the least recently
+    used ones are spilled to ``directory`` on a background thread and read
+    back on the conversation's next turn. The directory is kept under
+    ``disk_bytes`` by removing the files used longest ago. Without a
+    directory, evicted states are simply dropped.
+    """
+
+    def __init__(self, max_bytes: int, directory: Optional[str] = None, disk_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.directory = str(directory) if directory else None
+        self.disk_bytes = disk_bytes
+        self._entries: 'OrderedDict[Tuple[str, int], PromptState]' = OrderedDict()
+        self._size = 0
+        # Evicted states whose file is still being written
+        self._spilling: Dict[Tuple[str, int], PromptState] = {}
+        self._lock = threading.Lock()
+        # Disk writes happen in order on one thread; it only starts on the first spill
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='prompt-states') if self.directory else None
+        # Stats
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.spills = 0
+
+    def get(self, key: Tuple[str, int]) -> Optional[PromptState]:
+        with self._lock:
+            state = self._entries.get(key)
+            if state is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return state
+            state = self._spilling.get(key)
+        if state is None:
+            state = self._read(key)
+            if state is None:
+                with self._lock:
+                    self.misses += 1
+                return None
+        with self._lock:
+            self.disk_hits += 1
+            if key not in self._entries:
+                self._entries[key] = state
+                self._size += state.size
+                self._evict()
+        return state
+
+    def put(self, key: Tuple[str, int], state: PromptState) -> None:
+        with self._lock:
+            if self.directory:
+                # An older spilled state of the conversation is stale now
+                self._submit(self._unlink, key)
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old.size
+            self._entries[key] = state
+            self._size += state.size
+            self._evict()
+
+    def discard_conversation(self, conversation_id: int) -> None:
+        """Forget the states of a conversation for every model, e.g. after it was deleted."""
+        with self._lock:
+            for key in [key for key in self._entries if key[1] == conversation_id]:
+                self._size -= self._entries.pop(key).size
+            for key in [key for key in self._spilling if key[1] == conversation_id]:
+                del self._spilling[key]
+        if self.directory:
+            self._submit(self._unlink_conversation, conversation_id)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def flush(self) -> None:
+        """Wait for pending disk writes."""
+        if self._writer is not None:
+            self._writer.submit(lambda: None).result()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'spills': self.spills,
+            }
+
+    def _evict(self) -> None:
+        """Spill least recently used states until memory is under the limit (lock held)."""
+        while self._size > self.max_bytes and self._entries:
+            key, state = self._entries.popitem(last=False)
+            self._size -= state.size
+            if self.directory:
+                self._spilling[key] = state
+                self.spills += 1
+                self._submit(self._spill, key, state)
+            else:
+                logger.debug(f"Dropped prompt state of conversation {key[1]} ({state.size} bytes)")
+
+    def _submit(self, function, *args) -> None:
+        self._writer.submit(function, *args)
+
+    def _path(self, key: Tuple[str, int]) -> str:
+        model = hashlib.sha1(str(key[0]).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.directory, f"{key[1]}-{model}.kv")
+
+    def _spill(self, key: Tuple[str, int], state: PromptState) -> None:
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(key)
+            with open(path + '.tmp', 'wb') as handle:
+                handle.write(state.dumps())
+            os.replace(path + '.tmp', path)
+            self._prune()
+        except OSError as e:
+            logger.warning(f"Spilling prompt state of conversation {key[1]} failed: {str(e)}")
+        finally:
+            with self._lock:
+                if self._spilling.get(key) is state:
+                    del self._spilling[key]
+
+    def _read(self, key: Tuple[str, int]) -> Optional[PromptState]:
+        if not self.directory:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as handle:
+                state = PromptState.loads(handle.read())
+            os.utime(path)  # recently used files are pruned last
+            return state
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, struct.error) as e:
+            logger.warning(f"Reading prompt state {path} failed: {str(e)}")
+            return None
+
+    def _prune(self) -> None:
+        files = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.endswith('.kv'):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.disk_bytes:
+                break
+            with contextlib.suppress(OSError):
+                os.remove(path)
+            total -= size
+
+    def _unlink(self, key: Tuple[str, int]) -> None:
+        with contextlib.suppress(OSError):
+            os.remove(self._path(key))
+
+    def _unlink_conversation(self, conversation_id: int) -> None:
+        with contextlib.suppress(OSError), os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.startswith(f"{conversation_id}-") and entry.name.endswith('.kv'):
+                    with contextlib.suppress(OSError):
+                        os.remove(entry.path)
+
+
+# Initialize the global prompt state cache
+PROMPT_STATES = PromptStateCache(
+    getattr(settings, 'LLMCHAT_PROMPT_STATE_MEMORY_BYTES', 512 * 2 ** 20),
+    getattr(settings, 'LLMCHAT_PROMPT_STATE_PATH', None),
+    getattr(settings, 'LLMCHAT_PROMPT_STATE_DISK_BYTES', 4 * 2 ** 30),
+)
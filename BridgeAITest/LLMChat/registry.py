@@ -0,0 +1,125 @@
+"""In-memory registry of the active LLM providers."""
+import asyncio
+import logging
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .db import db_sync_to_async
+from .models import ModelProvider
+from .model_cache import MODEL_CACHE
+
+logger = logging.getLogger(__name__)
+
+# Shared-cache key set to a fresh token whenever provider or tool configuration changes
+CONFIG_GENERATION_KEY = 'llmchat:config-generation'
+
+
+class ProviderRegistry:
+    """Snapshot of the active providers, ordered by priority.
+
+    The snapshot is loaded once and then served from memory. Local
+    ``post_save``/``post_delete`` signals drop it immediately; other worker
+    processes notice the change through a generation token kept in the
+    shared ``LLMCHAT_REGISTRY_CACHE`` cache, which is polled at most once per
+    ``LLMCHAT_REGISTRY_CHECK_INTERVAL`` seconds (off the event loop in async
+    code). Every change writes a new random token rather than incrementing a
+    counter, so two workers changing it at once cannot both write the same
+    value and hide one change.
+    """
+
+    def __init__(self):
+        # (providers, providers by id), or None when it must be reloaded
+        self._state: Optional[Tuple[List[ModelProvider], Dict[int, ModelProvider]]] = None
+        self._generation = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def _shared_cache(self):
+        return caches[getattr(settings, 'LLMCHAT_REGISTRY_CACHE', 'default')]
+
+    def _check_due(self) -> bool:
+        now = time.monotonic()
+        if now - self._checked_at < getattr(settings, 'LLMCHAT_REGISTRY_CHECK_INTERVAL', 1.0):
+            return False
+        self._checked_at = now
+        return True
+
+    def _read_generation(self):
+        return self._shared_cache.get(CONFIG_GENERATION_KEY)
+
+    def _changed(self, generation) -> bool:
+        if generation == self._generation:
+            return False
+        # Another worker changed the configuration; its models are stale here too
+        logger.info("LLM provider configuration changed in another process, reloading")
+        MODEL_CACHE.invalidate()
+        return True
+
+    def _load(self) -> Tuple[List[ModelProvider], Dict[int, ModelProvider]]:
+        generation = self._read_generation()
+        providers = list(ModelProvider.objects.filter(is_active=True).order_by('-priority', 'name'))
+        state = (providers, {provider.id: provider for provider in providers})
+        with self._lock:
+            self._state = state
+            self._generation = generation
+            self._checked_at = time.monotonic()
+        return state
+
+    def _current(self) -> Tuple[List[ModelProvider], Dict[int, ModelProvider]]:
+        state = self._state
+        if state is None or (self._check_due() and self._changed(self._read_generation())):
+            state = self._load()
+        return state
+
+    async def _acurrent(self) -> Tuple[List[ModelProvider], Dict[int, ModelProvider]]:
+        state = self._state
+        if state is not None and self._check_due():
+            # The shared cache may be file or network backed; keep its I/O off the loop
+            generation = await asyncio.get_running_loop().run_in_executor(None, self._read_generation)
+            if self._changed(generation):
+                state = None
+        if state is None:
+            state = await db_sync_to_async(self._load)()
+        return state
+
+    def active_providers(self) -> List[ModelProvider]:
+        """Return the active providers, highest priority first."""
+        return list(self._current()[0])
+
+    async def aactive_providers(self) -> List[ModelProvider]:
+        """Async version of ``active_providers``."""
+        return list((await self._acurrent())[0])
+
+    def get(self, provider_id: int) -> Optional[ModelProvider]:
+        """Return the active provider with the given id, if any."""
+        return self._current()[1].get(provider_id)
+
+    async def aget(self, provider_id: int) -> Optional[ModelProvider]:
+        """Async version of ``get``."""
+        return (await self._acurrent())[1].get(provider_id)
+
+    def primary(self) -> Optional[ModelProvider]:
+        """Return the highest priority active provider."""
+        providers = self._current()[0]
+        return providers[0] if providers else None
+
+    async def aprimary(self) -> Optional[ModelProvider]:
+        """Async version of ``primary``."""
+        providers = (await self._acurrent())[0]
+        return providers[0] if providers else None
+
+    def invalidate(self) -> None:
+        """Drop the local snapshot and tell the other workers to drop theirs."""
+        with self._lock:
+            self._state = None
+        self._shared_cache.set(CONFIG_GENERATION_KEY, uuid.uuid4().hex, None)
+
+
+# Initialize the global provider registry
+PROVIDER_REGISTRY = ProviderRegistry()
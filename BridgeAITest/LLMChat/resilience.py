@@ -0,0 +1,197 @@
+"""Circuit breakers and request hedging used to fail over between LLM providers."""
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Optional
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class ProvidersUnavailable(Exception):
+    """Raised when every candidate provider failed or has an open circuit."""
+
+
+class CircuitBreaker:
+    """Tracks recent call outcomes of one provider.
+
+    The breaker opens when, over the last ``window`` calls (and at least
+    ``min_calls``), the share of failed or slow calls reaches ``error_rate``.
+    A call is slow when it takes longer than ``latency_threshold`` seconds.
+    After ``open_seconds`` one probe call is let through (half-open); its
+    outcome closes or re-opens the breaker. A call that ends without an
+    outcome (a full queue, the deadline, cancellation) gives the probe slot
+    back with ``release_probe()``.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name: str, window: int = 20, min_calls: int = 5, error_rate: float = 0.5,
+                 latency_threshold: Optional[float] = None, open_seconds: float = 30.0):
+        self.name = name
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.latency_threshold = latency_threshold
+        self.open_seconds = open_seconds
+        self.state = self.CLOSED
+        self._outcomes = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._probe_started_at = None
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Whether a call may be sent to the provider right now."""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == self.OPEN:
+                if now - self._opened_at < self.open_seconds:
+                    return False
+                self.state = self.HALF_OPEN
+                self._probe_started_at = None
+            if self.state == self.HALF_OPEN:
+                # One probe at a time; a probe that never reported back expires
+                if self._probe_started_at is not None and now - self._probe_started_at < self.open_seconds:
+                    return False
+                self._probe_started_at = now
+            return True
+
+    def release_probe(self) -> None:
+        """Let the next call probe a half-open provider; a no-op once an outcome was recorded."""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probe_started_at = None
+
+    def record_success(self, latency: float) -> None:
+        slow = self.latency_threshold is not None and latency > self.latency_threshold
+        self._record(not slow)
+
+    def record_failure(self) -> None:
+        self._record(False)
+
+    def _record(self, ok: bool) -> None:
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                if ok:
+                    logger.info(f"Circuit for provider {self.name} closed")
+                    self.state = self.CLOSED
+                    self._outcomes.clear()
+                else:
+                    self._open()
+                return
+            self._outcomes.append(ok)
+            failures = self._outcomes.count(False)
+            if (self.state == self.CLOSED and len(self._outcomes) >= self.min_calls
+                    and failures / len(self._outcomes) >= self.error_rate):
+                self._open()
+
+    def _open(self) -> None:
+        logger.warning(f"Circuit for provider {self.name} opened")
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._probe_started_at = None
+        self._outcomes.clear()
+
+
+class CircuitBreakerRegistry:
+    """One breaker per provider, configured from settings and ``extra_settings``."""
+
+    def __init__(self):
+        self._breakers: Dict[int, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def get(self, provider) -> CircuitBreaker:
+        with self._lock:
+            breaker = self._breakers.get(provider.id)
+            if breaker is None:
+                extra = provider.extra_settings or {}
+                breaker = CircuitBreaker(
+                    provider.name,
+                    window=extra.get('breaker_window', getattr(settings, 'LLMCHAT_BREAKER_WINDOW', 20)),
+                    min_calls=extra.get('breaker_min_calls', getattr(settings, 'LLMCHAT_BREAKER_MIN_CALLS', 5)),
+                    error_rate=extra.get('breaker_error_rate', getattr(settings, 'LLMCHAT_BREAKER_ERROR_RATE', 0.5)),
+                    latency_threshold=extra.get('breaker_latency', getattr(settings, 'LLMCHAT_BREAKER_LATENCY', None)),
+                    open_seconds=extra.get('breaker_open_seconds', getattr(settings, 'LLMCHAT_BREAKER_OPEN_SECONDS', 30.0)),
+                )
+                self._breakers[provider.id] = breaker
+            return breaker
+
+    def states(self) -> Dict[str, str]:
+        """Current state of every breaker, by provider name."""
+        with self._lock:
+            return {breaker.name: breaker.state for breaker in self._breakers.values()}
+
+    def reset(self, provider_id: Optional[int] = None) -> None:
+        """Forget breaker state, e.g. after a provider was reconfigured."""
+        with self._lock:
+            if provider_id is None:
+                self._breakers.clear()
+            else:
+                self._breakers.pop(provider_id, None)
+
+
+class LatencyTracker:
+    """Keeps the most recent latency samples of each provider."""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples: Dict[int, deque] = {}
+        self._lock = threading.Lock()
+
+    def record(self, provider_id: int, seconds: float) -> None:
+        with self._lock:
+            self._samples.setdefault(provider_id, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, provider_id: int, percent: float) -> Optional[float]:
+        """Return the percentile, or ``None`` until ``min_samples`` were recorded."""
+        with self._lock:
+            samples = sorted(self._samples.get(provider_id, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+
+class HedgeStats:
+    """Counts, per primary provider, how often hedges fired and who won."""
+
+    def __init__(self):
+        self._counts: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, provider_name: str, event: str) -> None:
+        """``event`` is ``fired``, ``hedge_won`` or ``primary_won``."""
+        with self._lock:
+            counts = self._counts.setdefault(provider_name, {'fired': 0, 'hedge_won': 0, 'primary_won': 0})
+            counts[event] += 1
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {name: dict(counts) for name, counts in self._counts.items()}
+
+
+def hedge_delay(provider, enabled: Optional[bool] = None) -> Optional[float]:
+    """Seconds to wait for a first chunk before hedging, or ``None`` if hedging is off.
+
+    ``extra_settings['hedge_delay']`` fixes the delay; otherwise it is the
+    provider's observed p95 time to first chunk, falling back to
+    LLMCHAT_HEDGE_DELAY until enough samples exist.
+    """
+    extra = provider.extra_settings or {}
+    if enabled is None:
+        enabled = extra.get('hedge', getattr(settings, 'LLMCHAT_HEDGING', False))
+    if not enabled:
+        return None
+    if extra.get('hedge_delay') is not None:
+        return float(extra['hedge_delay'])
+    p95 = TTFT_TRACKER.percentile(provider.id, 95)
+    return p95 if p95 is not None else getattr(settings, 'LLMCHAT_HEDGE_DELAY', 1.0)
+
+
+# Initialize the global circuit breakers, latency samples and hedge counters
+BREAKERS = CircuitBreakerRegistry()
+TTFT_TRACKER = LatencyTracker()
+HEDGE_STATS = HedgeStats()
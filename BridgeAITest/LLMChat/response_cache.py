@@ -0,0 +1,134 @@
+"""Exact-match cache of chat responses for deterministic providers."""
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Sequence
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+from langchain_core.messages import BaseMessage
+
+logger = logging.getLogger(__name__)
+
+
+def response_cache_key(fingerprint: str, messages: Sequence[BaseMessage]) -> str:
+    """Key a request by provider fingerprint and its normalized message list.
+
+    The message list already holds the system prompt, the (trimmed) history
+    and the new message. Whitespace runs are collapsed so cosmetic
+    differences still hit.
+    """
+    normalized = [(message.type, " ".join(str(message.content).split())) for message in messages]
+    raw = json.dumps([fingerprint, normalized], ensure_ascii=False)
+    return 'llmchat:response:' + hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def is_cacheable(provider) -> bool:
+    """Responses are reused for temperature 0 providers unless extra_settings says otherwise."""
+    configured = (provider.extra_settings or {}).get('response_cache')
+    if configured is not None:
+        return bool(configured)
+    return provider.temperature == 0
+
+
+class LocalResponseCacheBackend:
+    """In-process LRU with a per-entry TTL."""
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 3600, **kwargs):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: 'OrderedDict[str, tuple]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    async def set(self, key: str, value: Dict[str, Any]) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class DjangoResponseCacheBackend:
+    """Stores responses in a Django cache, shared by workers if the backend is."""
+
+    def __init__(self, alias: str = 'default', ttl: float = 3600, **kwargs):
+        self.alias = alias
+        self.ttl = ttl
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        return await caches[self.alias].aget(key)
+
+    async def set(self, key: str, value: Dict[str, Any]) -> None:
+        await caches[self.alias].aset(key, value, self.ttl)
+
+
+BACKENDS = {
+    'local': LocalResponseCacheBackend,
+    'django': DjangoResponseCacheBackend,
+}
+
+
+class ResponseCache:
+    """Front for the configured backend that counts hits and misses."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        value = None
+        try:
+            value = await self.backend.get(key)
+        except Exception as e:
+            logger.error(f"Response cache lookup failed: {str(e)}")
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key: str, value: Dict[str, Any]) -> None:
+        try:
+            await self.backend.set(key, value)
+        except Exception as e:
+            logger.error(f"Response cache store failed: {str(e)}")
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+        }
+
+
+def load_backend():
+    """Build the backend named by LLMCHAT_RESPONSE_CACHE_BACKEND (a key of BACKENDS or a dotted path)."""
+    name = getattr(settings, 'LLMCHAT_RESPONSE_CACHE_BACKEND', 'local')
+    backend_class = BACKENDS.get(name) or import_string(name)
+    return backend_class(
+        max_entries=getattr(settings, 'LLMCHAT_RESPONSE_CACHE_MAX_ENTRIES', 1000),
+        ttl=getattr(settings, 'LLMCHAT_RESPONSE_CACHE_TTL', 3600),
+        alias=getattr(settings, 'LLMCHAT_RESPONSE_CACHE_ALIAS', 'default'),
+    )
+
+
+# Initialize the global response cache
+RESPONSE_CACHE = ResponseCache(load_backend())
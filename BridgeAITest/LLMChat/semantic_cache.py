@@ -0,0 +1,292 @@
+"""Semantic response cache backed by a local vector index."""
+import asyncio
+import atexit
+import hashlib
+import itertools
+import json
+import logging
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from django.conf import settings
+from django.utils.module_loading import import_string
+from langchain_core.embeddings import Embeddings
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+WORD_RE = re.compile(r"\w+")
+
+
+class HashingEmbedder(Embeddings):
+    """Deterministic, offline embedder based on feature hashing.
+
+    Words and word bigrams are hashed into ``dim`` signed buckets and the
+    vector is L2-normalized, so paraphrases sharing most of their words end up
+    close in cosine similarity. No model or network access is needed.
+    """
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+
+    def _features(self, text: str) -> List[str]:
+        words = WORD_RE.findall(text.lower())
+        return words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+
+    def embed_query(self, text: str) -> List[float]:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature in self._features(text):
+            digest = hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest()
+            value = int.from_bytes(digest, 'little')
+            vector[value % self.dim] += 1.0 if value & (1 << 63) else -1.0
+        norm = np.linalg.norm(vector)
+        if norm:
+            vector /= norm
+        return vector.tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_query(text) for text in texts]
+
+
+def claim_shard(path: str) -> tuple:
+    """Return ``(directory, lock)`` of a shard under ``path`` no other live process uses.
+
+    Worker processes cannot share one index: the vectors are memory-mapped,
+    so a slot another worker overwrote would be matched against this
+    worker's payload. Each worker instead holds an exclusive ``flock`` on
+    its shard for as long as it runs (keep ``lock`` open), and a restarted
+    worker picks up a shard left behind by an earlier one. Without
+    ``fcntl`` the shard is named after the process id.
+    """
+    if fcntl is None:
+        directory = os.path.join(path, f'pid-{os.getpid()}')
+        os.makedirs(directory, exist_ok=True)
+        return directory, None
+    for number in itertools.count():
+        directory = os.path.join(path, f'shard-{number}')
+        os.makedirs(directory, exist_ok=True)
+        lock = open(os.path.join(directory, 'lock'), 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            continue
+        return directory, lock
+
+
+class VectorIndex:
+    """Fixed-capacity cosine-similarity index over normalized vectors.
+
+    With a ``path`` the vectors live in a memory-mapped ``vectors.npy`` and
+    the entry metadata in ``entries.json``, in a shard of ``path`` that only
+    this process uses (see claim_shard), so the index survives restarts
+    without re-embedding anything. When full, the least recently used entry
+    is overwritten. Inserts save the index on a background thread at most
+    every ``SAVE_INTERVAL`` seconds, so callers on the event loop never wait
+    for the disk.
+    """
+
+    SAVE_INTERVAL = 5.0
+
+    def __init__(self, dim: int, capacity: int, path: Optional[str] = None):
+        self.dim = dim
+        self.capacity = capacity
+        self.path, self._shard_lock = claim_shard(path) if path else (None, None)
+        # Namespace id per slot (see semantic_namespace); 0 marks a free slot
+        self._namespaces = np.zeros(capacity, dtype=np.int64)
+        self._payloads: List[Optional[Dict[str, Any]]] = [None] * capacity
+        self._last_used = np.zeros(capacity, dtype=np.float64)
+        self._dirty = False
+        self._saved_at = 0.0
+        self._saving = False
+        self._lock = threading.Lock()
+        # Serializes writing entries.json between the background saver and atexit
+        self._save_lock = threading.Lock()
+        self._vectors = self._open_vectors()
+        if path:
+            self._load_entries()
+
+    def _open_vectors(self) -> np.ndarray:
+        if not self.path:
+            return np.zeros((self.capacity, self.dim), dtype=np.float32)
+        os.makedirs(self.path, exist_ok=True)
+        vectors_path = os.path.join(self.path, 'vectors.npy')
+        if os.path.exists(vectors_path):
+            vectors = np.lib.format.open_memmap(vectors_path, mode='r+')
+            if vectors.shape == (self.capacity, self.dim) and vectors.dtype == np.float32:
+                return vectors
+            logger.warning(f"Semantic cache at {self.path} has shape {vectors.shape}, starting over")
+            del vectors
+            self._remove_entries_file()
+        return np.lib.format.open_memmap(vectors_path, mode='w+', dtype=np.float32,
+                                         shape=(self.capacity, self.dim))
+
+    def _entries_path(self) -> str:
+        return os.path.join(self.path, 'entries.json')
+
+    def _remove_entries_file(self) -> None:
+        if os.path.exists(self._entries_path()):
+            os.remove(self._entries_path())
+
+    def _load_entries(self) -> None:
+        if not os.path.exists(self._entries_path()):
+            return
+        with open(self._entries_path(), encoding='utf-8') as handle:
+            for slot, namespace, payload, last_used in json.load(handle):
+                if slot < self.capacity and namespace:
+                    self._namespaces[slot] = namespace
+                    self._payloads[slot] = payload
+                    self._last_used[slot] = last_used
+
+    def search(self, namespace: int, vector: np.ndarray) -> tuple:
+        """Return ``(similarity, payload)`` of the nearest entry in ``namespace``."""
+        with self._lock:
+            slots = np.flatnonzero(self._namespaces == namespace)
+            if not len(slots):
+                return 0.0, None
+            similarities = self._vectors[slots] @ vector
+            best = int(np.argmax(similarities))
+            slot = slots[best]
+            self._last_used[slot] = time.time()
+            return float(similarities[best]), self._payloads[slot]
+
+    def insert(self, namespace: int, vector: np.ndarray, payload: Dict[str, Any]) -> None:
+        with self._lock:
+            free = np.flatnonzero(self._namespaces == 0)
+            slot = int(free[0]) if len(free) else int(np.argmin(self._last_used))
+            self._vectors[slot] = vector
+            self._namespaces[slot] = namespace
+            self._payloads[slot] = payload
+            self._last_used[slot] = time.time()
+            self._dirty = True
+            due = (self.path and not self._saving
+                   and time.monotonic() - self._saved_at > self.SAVE_INTERVAL)
+            if due:
+                self._saving = True
+        if due:
+            threading.Thread(target=self._save_in_background, name='semantic-cache-save', daemon=True).start()
+
+    def _save_in_background(self) -> None:
+        try:
+            self.save()
+        except Exception as e:
+            logger.error(f"Saving the semantic cache at {self.path} failed: {str(e)}", exc_info=True)
+        finally:
+            with self._lock:
+                self._saving = False
+                self._saved_at = time.monotonic()
+
+    def save(self) -> None:
+        """Flush vectors and metadata to disk (no-op for in-memory indexes)."""
+        if not self.path:
+            return
+        # Taken first, so a save running in the background is finished before this returns
+        with self._save_lock:
+            if not self._dirty:
+                return
+            with self._lock:
+                entries = [
+                    [int(slot), int(self._namespaces[slot]), self._payloads[slot], float(self._last_used[slot])]
+                    for slot in np.flatnonzero(self._namespaces)
+                ]
+                self._dirty = False
+            self._vectors.flush()
+            tmp_path = self._entries_path() + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as handle:
+                json.dump(entries, handle)
+            os.replace(tmp_path, self._entries_path())
+
+    def __len__(self) -> int:
+        return int(np.count_nonzero(self._namespaces))
+
+
+class SemanticCache:
+    """Returns stored replies for messages that are close enough to earlier ones."""
+
+    def __init__(self, embedder: Embeddings, index: VectorIndex):
+        self.embedder = embedder
+        self.index = index
+        self.hits = 0
+        self.misses = 0
+
+    async def embed(self, text: str) -> np.ndarray:
+        return np.asarray(await self.embedder.aembed_query(text), dtype=np.float32)
+
+    async def lookup(self, namespace: int, vector: np.ndarray, threshold: float) -> Optional[str]:
+        similarity, payload = self.index.search(namespace, vector)
+        if payload is not None and similarity >= threshold:
+            self.hits += 1
+            logger.debug(f"Semantic cache hit (similarity {similarity:.3f})")
+            return payload['reply']
+        self.misses += 1
+        return None
+
+    def store(self, namespace: int, vector: np.ndarray, message: str, reply: str) -> None:
+        self.index.insert(namespace, vector, {'message': message, 'reply': reply})
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'entries': len(self.index),
+        }
+
+
+def semantic_threshold(provider) -> Optional[float]:
+    """Similarity needed for a hit, or ``None`` when the provider does not use the cache."""
+    threshold = (provider.extra_settings or {}).get(
+        'semantic_cache_threshold', getattr(settings, 'LLMCHAT_SEMANTIC_CACHE_THRESHOLD', None)
+    )
+    return float(threshold) if threshold else None
+
+
+def semantic_namespace(fingerprint: str, system_prompt: str) -> int:
+    """Replies are only shared between requests with the same provider setup and system prompt."""
+    digest = hashlib.blake2b(f"{fingerprint}\n{system_prompt}".encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little', signed=True) or 1
+
+
+def load_semantic_cache() -> SemanticCache:
+    embedder_path = getattr(settings, 'LLMCHAT_SEMANTIC_CACHE_EMBEDDER', None)
+    embedder = import_string(embedder_path)() if embedder_path else HashingEmbedder()
+    dim = len(embedder.embed_query("dimension probe"))
+    path = getattr(settings, 'LLMCHAT_SEMANTIC_CACHE_PATH', None)
+    index = VectorIndex(dim, getattr(settings, 'LLMCHAT_SEMANTIC_CACHE_CAPACITY', 10000),
+                        str(path) if path else None)
+    atexit.register(index.save)
+    return SemanticCache(embedder, index)
+
+
+_semantic_cache: Optional[SemanticCache] = None
+_semantic_cache_lock = threading.Lock()
+
+
+def get_semantic_cache() -> SemanticCache:
+    """Return the process-wide semantic cache, opening its index on first use."""
+    global _semantic_cache
+    with _semantic_cache_lock:
+        if _semantic_cache is None:
+            _semantic_cache = load_semantic_cache()
+        return _semantic_cache
+
+
+async def aget_semantic_cache() -> SemanticCache:
+    """``get_semantic_cache`` for async code.
+
+    Opening the index locks its shard, maps the vectors file and embeds a
+    probe text, so the first call does that on a worker thread rather than
+    on the event loop.
+    """
+    if _semantic_cache is not None:
+        return _semantic_cache
+    return await asyncio.get_running_loop().run_in_executor(None, get_semantic_cache)
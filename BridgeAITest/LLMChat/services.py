@@ -4,24 +4,89 @@ from langchain_community.chat_models import ChatOpenAI, ChatAnthropic
 from langchain_huggingface import HuggingFaceEndpoint
 from langchain_cohere import ChatCohere
 from .models import ModelProvider, Conversation, ChatLog, Tool
-from typing import List, Dict, Any, Optional, AsyncGenerator
+from typing import List, Dict, Any, Optional, AsyncGenerator, NamedTuple
 from langchain_core.tools import BaseTool
 from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
-from .llm_providers import LLMProviderFactory
-from asgiref.sync import sync_to_async
+from .llm_providers import LLMProviderFactory, provider_config, use_shared_http_pools
+from .model_cache import MODEL_CACHE, provider_fingerprint
+from .registry import PROVIDER_REGISTRY
+from .history import HISTORY_CACHE, Turn
+from .context import build_context_window, estimate_tokens, history_budget, turn_tokens
+from .summarizer import SUMMARIZER
+from .writer import CHATLOG_WRITER
+from .response_cache import RESPONSE_CACHE, is_cacheable, response_cache_key
+from .semantic_cache import aget_semantic_cache, semantic_namespace, semantic_threshold
+from .resilience import BREAKERS, HEDGE_STATS, TTFT_TRACKER, ProvidersUnavailable, hedge_delay
+from .limits import LIMITS, QueueTimeout, request_tokens
+from .deadlines import DeadlineExceeded, ProviderTimeout, StreamWatchdog, call_timeouts, time_left, with_retries, within
+from .metrics import LLM_METRICS, resolve_usage, tokens_per_second
+from .tracing import TRACER
+from .prompt_state import conversation_scope
+from .singleflight import SINGLE_FLIGHT, StreamFlight, coalescing_enabled
+from .db import db_sync_to_async
+from django.conf import settings
+import asyncio
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
-# Create async versions of database operations
-create_chat_log = sync_to_async(ChatLog.objects.create)
-get_conversation = sync_to_async(Conversation.objects.get)
-create_conversation = sync_to_async(Conversation.objects.create)
-get_chat_history = sync_to_async(lambda conv_id: list(ChatLog.objects.filter(conversation_id=conv_id)))
-get_enabled_tools_sync = sync_to_async(lambda: list(Tool.objects.filter(enabled=True)))
+# Create async versions of database operations (run on the LLMChat DB pool)
+create_chat_log = db_sync_to_async(ChatLog.objects.create)
+get_conversation = db_sync_to_async(Conversation.objects.get)
+create_conversation = db_sync_to_async(Conversation.objects.create)
+get_chat_history = db_sync_to_async(lambda conv_id: list(
+    ChatLog.objects.filter(conversation_id=conv_id)
+    .order_by('created_at', 'id')
+    .values_list('id', 'user_message', 'ai_response', 'turn_tokens')
+))
+get_enabled_tools_sync = db_sync_to_async(lambda: list(Tool.objects.filter(enabled=True)))
+write_chat_log_now = db_sync_to_async(CHATLOG_WRITER.write)
+
+async def log_chat(**fields) -> ChatLog:
+    """Queue a ChatLog row for saving and append the turn to the cached history.
+
+    The row is written in the background by CHATLOG_WRITER, so the response
+    does not wait for the database commit (unless synchronous writes are on).
+    Timed provider calls are also added to the LLM_METRICS histograms.
+    """
+    fields['turn_tokens'] = turn_tokens(fields['user_message'], fields['ai_response'])
+    if fields.get('latency_ms') is not None:
+        latency = fields['latency_ms'] / 1000
+        ttft = fields['ttft_ms'] / 1000 if fields.get('ttft_ms') is not None else None
+        fields['tokens_per_second'] = tokens_per_second(fields['output_tokens'], latency, ttft)
+        LLM_METRICS.observe(fields['provider'], latency, fields['input_tokens'], fields['output_tokens'],
+                            ttft=ttft, estimated=fields.get('usage_estimated', False))
+    chat_log = ChatLog(**fields)
+    if CHATLOG_WRITER.synchronous:
+        await write_chat_log_now(chat_log)
+    else:
+        CHATLOG_WRITER.write(chat_log)
+    HISTORY_CACHE.append(chat_log.conversation_id, chat_log.user_message, chat_log.ai_response, chat_log.turn_tokens)
+    return chat_log
+
+async def get_enabled_tool_names() -> List[str]:
+    """Get the names of the enabled tools, cached until a Tool is edited."""
+    tool_names = MODEL_CACHE.tool_names
+    if tool_names is None:
+        generation = MODEL_CACHE.generation
+        tool_names = [tool_cfg.name for tool_cfg in await get_enabled_tools_sync()]
+        MODEL_CACHE.set_tool_names(tool_names, generation)
+    return tool_names
 
 async def get_chat_model(provider: ModelProvider):
-    """Instantiate the LangChain chat model for the given provider config."""
+    """Return the LangChain chat model for the given provider config.
+
+    Models are cached per provider configuration, so steady-state requests
+    reuse the same client (and its HTTP connection pool).
+    """
+    generation = MODEL_CACHE.generation
+    tool_names = await get_enabled_tool_names()
+    fingerprint = provider_fingerprint(provider, tool_names)
+    llm = MODEL_CACHE.get(provider.id, fingerprint)
+    if llm is not None:
+        return llm
+
     try:
         if provider.provider == 'openai':
             llm = ChatOpenAI(
@@ -49,38 +114,89 @@ async def get_chat_model(provider: ModelProvider):
                 huggingfacehub_api_token=provider.api_key,
                 temperature=provider.temperature)
         else:
-            raise ValueError(f"Unsupported provider: {provider.provider}")
+            # Other provider types build their model through their registered strategy
+            strategy = LLMProviderFactory.registered(provider.provider)
+            if strategy is None:
+                raise ValueError(f"Unsupported provider: {provider.provider}")
+            llm = strategy.create_chat_model(provider_config(provider))
         
+        llm = use_shared_http_pools(llm)
         # Attach tools if enabled
-        return await attach_tools(llm)
+        llm = await attach_tools(llm, tool_names)
     except Exception as e:
         logger.error(f"Error initializing chat model: {str(e)}")
         raise
 
+    MODEL_CACHE.set(provider.id, fingerprint, llm, generation)
+    return llm
+
 
 from LLMChat.tools import add, get_current_time
 from .models import Tool
-async def attach_tools(llm):
+async def get_stream_client(strategy, provider: ModelProvider):
+    """The strategy's native streaming client, if it has one and no tools need binding."""
+    if await get_enabled_tool_names():
+        return None
+    return strategy.create_stream_client(provider_config(provider))
+
+def without_tools(llm):
+    """The chat model ``llm`` was built from, before attach_tools bound any tools."""
+    return getattr(llm, 'bound', llm)
+
+async def attach_tools(llm, tool_names: Optional[List[str]] = None):
     """Bind the enabled tools to the chat model."""
     tools = []
     # Add tools that are enabled in the database
-    enabled_tools = await get_enabled_tools_sync()
-    for tool_cfg in enabled_tools:
-        if tool_cfg.name == 'add':
+    if tool_names is None:
+        tool_names = await get_enabled_tool_names()
+    for tool_name in tool_names:
+        if tool_name == 'add':
             tools.append(add)
-        elif tool_cfg.name == 'get_current_time':
+        elif tool_name == 'get_current_time':
             tools.append(get_current_time)
     if tools:
         llm = llm.bind_tools(tools)
     return llm
 
+class StreamStart(NamedTuple):
+    """A provider stream that has produced its first chunk."""
+    provider: ModelProvider
+    strategy: Any
+    stream: Any
+    first: Any  # None for an empty response
+    started: float  # time.monotonic() when the call was sent
+    ttft: float
+    permit: Any  # provider slot, held until the stream is over
+
+
+class StreamOutcome:
+    """What the upstream stream turned out to be; filled in once it has finished."""
+
+    def __init__(self, provider: ModelProvider, ttft: float):
+        self.provider = provider
+        self.ttft = ttft
+        self.latency = None
+        self.usage = {'input_tokens': 0, 'output_tokens': 0, 'total_tokens': 0}
+        self.usage_estimated = False
+
+
+def prompt_text(messages: List[Any]) -> str:
+    return "".join(str(message.content) for message in messages)
+
+
 class ChatService:
     """Main service for handling chat operations."""
     
-    def __init__(self, provider: ModelProvider):
+    def __init__(self, provider: ModelProvider, hedge: Optional[bool] = None, cache_history: bool = True):
         self.provider = provider
+        self.hedge = hedge  # Overrides the provider's hedging setting for chat_stream
+        # HISTORY_CACHE is per process, so only callers pinned to one worker (WebSocket chats) use it
+        self.cache_history = cache_history
         self.strategy = None  # Will be initialized lazily
         self.llm = None  # Will be initialized lazily
+        self.dropped_turns = 0  # History turns left out of the last prompt
+        self.served_provider = None  # Provider that answered the last call (after failover)
+        self._turns = []  # History turns loaded by the last prepare_messages
         
     async def _ensure_llm(self):
         """Ensure LLM is initialized."""
@@ -88,21 +204,311 @@ class ChatService:
             if self.strategy is None:
                 self.strategy = await LLMProviderFactory.get_strategy(self.provider.provider)
             self.llm = await get_chat_model(self.provider)
+
+    async def _model_for(self, provider: ModelProvider):
+        """Return ``(strategy, llm)`` for the requested provider or a failover candidate."""
+        if provider.id == self.provider.id:
+            await self._ensure_llm()
+            return self.strategy, self.llm
+        strategy = await LLMProviderFactory.get_strategy(provider.provider)
+        return strategy, await get_chat_model(provider)
+
+    async def failover_candidates(self) -> List[ModelProvider]:
+        """The requested provider first, then the other active providers by priority."""
+        if not getattr(settings, 'LLMCHAT_FAILOVER', True):
+            return [self.provider]
+        others = [p for p in await PROVIDER_REGISTRY.aactive_providers() if p.id != self.provider.id]
+        return [self.provider] + others
+
+    async def _invoke(self, messages: List[Any]):
+        """Get a full response from the first healthy provider, failing over on errors.
+
+        Providers whose circuit is open are skipped without being called.
+        Returns ``(provider, strategy, response, latency)``.
+        """
+        errors = []
+        for provider in await self.failover_candidates():
+            breaker = BREAKERS.get(provider)
+            if not breaker.allow():
+                continue
+            try:
+                strategy, response, latency = await with_retries(
+                    provider, lambda: self._invoke_once(provider, messages))
+            except QueueTimeout as e:
+                logger.warning(str(e))
+                errors.append(f"{provider.name}: {str(e)}")
+                continue
+            except DeadlineExceeded:
+                # No time is left for another provider either
+                raise
+            except Exception as e:
+                breaker.record_failure()
+                LLM_METRICS.record_error(provider)
+                logger.warning(f"Provider {provider.name} failed: {str(e)}")
+                errors.append(f"{provider.name}: {str(e)}")
+                continue
+            else:
+                breaker.record_success(latency)
+                return provider, strategy, response, latency
+            finally:
+                # Calls that never reached the provider must not keep a half-open probe slot
+                breaker.release_probe()
+        raise ProvidersUnavailable("No provider could answer (" + ("; ".join(errors) or "all circuits are open") + ")")
+
+    async def _acquire(self, provider: ModelProvider, messages: List[Any]):
+        """Wait for a provider slot, for no longer than the request has left."""
+        limiter = LIMITS.get(provider)
+        with TRACER.span('provider.queue', provider=provider.name):
+            return await limiter.acquire(request_tokens(provider, messages), timeout=time_left(limiter.queue_timeout))
+
+    async def _invoke_once(self, provider: ModelProvider, messages: List[Any]):
+        """One non-streamed call; returns ``(strategy, response, latency)``."""
+        permit = await self._acquire(provider, messages)
+        started = time.monotonic()
+        try:
+            strategy, llm = await self._model_for(provider)
+            with TRACER.span('llm.invoke', provider=provider.name, model=provider.model_name):
+                async with within(call_timeouts(provider).call, f"No reply from provider {provider.name}"):
+                    response = await llm.ainvoke(messages)
+            permit.used_tokens = (getattr(response, 'usage_metadata', None) or {}).get('total_tokens')
+        finally:
+            permit.release()
+        return strategy, response, time.monotonic() - started
+
+    async def _start_stream(self, provider: ModelProvider, messages: List[Any]) -> StreamStart:
+        """Open a stream on one provider, retrying while the request has time left."""
+        return await with_retries(provider, lambda: self._start_stream_once(provider, messages))
+
+    async def _start_stream_once(self, provider: ModelProvider, messages: List[Any]) -> StreamStart:
+        """Open a stream on one provider and wait for its first chunk.
+
+        The stream is closed and the provider slot released again if this
+        fails or is cancelled (e.g. by a winning hedge).
+        """
+        permit = await self._acquire(provider, messages)
+        started = time.monotonic()
+        stream = None
+        try:
+            strategy, llm = await self._model_for(provider)
+            # Providers streaming natively skip LangChain's per-chunk work
+            client = await get_stream_client(strategy, provider) or llm
+            with TRACER.span('llm.first_token', provider=provider.name, model=provider.model_name):
+                stream = client.astream(messages)
+                async with within(call_timeouts(provider).first_token, f"No first token from provider {provider.name}"):
+                    first = await anext(stream, None)
+        except BaseException:
+            if stream is not None:
+                await stream.aclose()
+            permit.release()
+            raise
+        return StreamStart(provider, strategy, stream, first, started, time.monotonic() - started, permit)
+
+    async def _open_stream(self, messages: List[Any]) -> StreamStart:
+        """Start a stream on the first healthy provider.
+
+        Failover is only possible until the first chunk arrives; after that the
+        caller owns the stream. With hedging enabled, a provider that has not
+        produced a first chunk within its hedge delay gets raced against the
+        next candidate; the first stream to start wins and the other is
+        cancelled.
+        """
+        errors = []
+        candidates = list(await self.failover_candidates())
+        while candidates:
+            provider = candidates.pop(0)
+            if not BREAKERS.get(provider).allow():
+                continue
+            attempts = {asyncio.ensure_future(self._start_stream(provider, messages)): provider}
+            claimed = [provider]
+            start = None
+            try:
+                hedged = False
+                delay = hedge_delay(provider, self.hedge) if candidates else None
+                if delay is not None:
+                    done, _ = await asyncio.wait(attempts, timeout=delay)
+                    if not done:
+                        backup = self._next_allowed(candidates)
+                        if backup is not None:
+                            logger.info(f"No first chunk from {provider.name} after {delay:.2f}s, hedging with {backup.name}")
+                            HEDGE_STATS.record(provider.name, 'fired')
+                            attempts[asyncio.ensure_future(self._start_stream(backup, messages))] = backup
+                            claimed.append(backup)
+                            hedged = True
+
+                while attempts and start is None:
+                    done, _ = await asyncio.wait(attempts, return_when=asyncio.FIRST_COMPLETED)
+                    for attempt in done:
+                        attempt_provider = attempts.pop(attempt)
+                        try:
+                            start = attempt.result()
+                        except QueueTimeout as e:
+                            # A full queue is not a provider fault; just move on
+                            logger.warning(str(e))
+                            errors.append(f"{attempt_provider.name}: {str(e)}")
+                            continue
+                        except DeadlineExceeded:
+                            raise
+                        except Exception as e:
+                            BREAKERS.get(attempt_provider).record_failure()
+                            LLM_METRICS.record_error(attempt_provider)
+                            logger.warning(f"Provider {attempt_provider.name} failed before streaming: {str(e)}")
+                            errors.append(f"{attempt_provider.name}: {str(e)}")
+                            continue
+                        # For streams, time to first chunk is what the latency threshold applies to
+                        BREAKERS.get(attempt_provider).record_success(start.ttft)
+                        TTFT_TRACKER.record(attempt_provider.id, start.ttft)
+                        if hedged:
+                            HEDGE_STATS.record(provider.name, 'primary_won' if attempt_provider is provider else 'hedge_won')
+                        break
+                while attempts:
+                    await self._discard_attempt(attempts.popitem()[0])
+            except BaseException:
+                # Cancelled (the caller went away) or out of time: nothing may keep
+                # an upstream stream or a provider slot open behind our back
+                for attempt in attempts:
+                    await self._discard_attempt(attempt)
+                if start is not None:
+                    await self._discard_start(start)
+                raise
+            finally:
+                # Attempts without an outcome (full queue, deadline, cancelled, lost the
+                # race) must not keep a half-open probe slot
+                for claimed_provider in claimed:
+                    BREAKERS.get(claimed_provider).release_probe()
+            if start is not None:
+                return start
+        raise ProvidersUnavailable("No provider could answer (" + ("; ".join(errors) or "all circuits are open") + ")")
+
+    @staticmethod
+    def _next_allowed(candidates: List[ModelProvider]) -> Optional[ModelProvider]:
+        """Pop the next candidate whose circuit lets a call through."""
+        while candidates:
+            provider = candidates.pop(0)
+            if BREAKERS.get(provider).allow():
+                return provider
+        return None
+
+    @staticmethod
+    async def _discard_attempt(attempt: asyncio.Future) -> None:
+        """Cancel a losing stream attempt, closing its stream if it had already started."""
+        if not attempt.done():
+            attempt.cancel()
+            # Retrieve the outcome so a late failure is not reported as unhandled
+            attempt.add_done_callback(lambda task: task.cancelled() or task.exception())
+        elif not attempt.cancelled() and attempt.exception() is None:
+            await ChatService._discard_start(attempt.result())
+
+    @staticmethod
+    async def _discard_start(start: StreamStart) -> None:
+        """Close a started stream nobody will read and give its provider slot back."""
+        try:
+            await start.stream.aclose()
+        finally:
+            start.permit.release()
+
+    async def _open_chunks(self, messages: List[Any]):
+        """Open a stream with failover; returns ``(outcome, chunks)`` for a StreamFlight.
+
+        ``outcome`` gets the latency and token usage once the stream is over;
+        usage comes from the stream's usage metadata if the provider sends it
+        and is estimated from the text otherwise. A stream that goes quiet
+        for longer than the provider's inter-token timeout, or outlasts the
+        request deadline, is cut.
+        """
+        start = await self._open_stream(messages)
+        outcome = StreamOutcome(start.provider, start.ttft)
+
+        async def chunks():
+            chunk = start.first
+            usage_chunks = []
+            reply = []
+            watchdog = StreamWatchdog(call_timeouts(start.provider).inter_token,
+                                      f"No token from provider {start.provider.name}")
+            try:
+                while chunk is not None:
+                    if getattr(chunk, 'usage_metadata', None):
+                        usage_chunks.append(chunk)
+                    if chunk.content:
+                        reply.append(chunk.content)
+                        yield chunk.content
+                    chunk = await watchdog.next(start.stream)
+                outcome.latency = time.monotonic() - start.started
+                outcome.usage, outcome.usage_estimated = resolve_usage(
+                    start.provider, prompt_text(messages), "".join(reply),
+                    start.strategy.get_stream_usage(usage_chunks),
+                )
+                start.permit.used_tokens = outcome.usage['total_tokens']
+            except Exception as e:
+                if isinstance(e, (ProviderTimeout, DeadlineExceeded)):
+                    logger.warning(f"Cut the stream from provider {start.provider.name} after "
+                                   f"{len(reply)} chunks: {str(e)}")
+                if not isinstance(e, DeadlineExceeded):
+                    BREAKERS.get(start.provider).record_failure()
+                    LLM_METRICS.record_error(start.provider)
+                raise
+            finally:
+                watchdog.close()
+                await start.stream.aclose()
+                start.permit.release()
+
+        return outcome, chunks()
+
+    async def _schedule_summary(self, provider: ModelProvider, conversation: Conversation) -> None:
+        """Fold older turns into the summary in the background."""
+        _, llm = await self._model_for(provider)
+        SUMMARIZER.maybe_schedule(without_tools(llm), provider, conversation, self._turns)
     
-    async def get_conversation_history(self, conversation_id: int) -> List[dict]:
-        """Get the chat history for a conversation."""
-        chat_logs = await get_chat_history(conversation_id)
-        messages = []
-        for log in chat_logs:
-            messages.extend([
-                HumanMessage(content=log.user_message),
-                AIMessage(content=log.ai_response)
-            ])
-        return messages
+    async def get_conversation_turns(self, conversation_id: int) -> List[Turn]:
+        """Get the turns of a conversation, from the cache when possible.
+
+        Without ``cache_history`` they are always read from the database, since
+        another worker may have added turns this process never saw.
+        """
+        if not self.cache_history:
+            return await self._load_turns(conversation_id)
+
+        turns = HISTORY_CACHE.get(conversation_id)
+        if turns is not None:
+            return turns
+
+        HISTORY_CACHE.begin_load(conversation_id)
+        turns = None
+        try:
+            turns = await self._load_turns(conversation_id)
+        finally:
+            HISTORY_CACHE.end_load(conversation_id, turns)
+        return turns
+
+    @staticmethod
+    async def _load_turns(conversation_id: int) -> List[Turn]:
+        """Read the turns of a conversation from the database."""
+        # Rows still queued in the write-behind writer are newer than anything saved
+        pending = CHATLOG_WRITER.pending_for(conversation_id)
+        rows = await get_chat_history(conversation_id)
+        loaded_ids = {row[0] for row in rows}
+        turns = [
+            # Rows written before token counts were stored have turn_tokens=0
+            Turn.build(user_message, ai_response, tokens or turn_tokens(user_message, ai_response))
+            for _, user_message, ai_response, tokens in rows
+        ]
+        turns.extend(
+            Turn.build(chat_log.user_message, chat_log.ai_response, chat_log.turn_tokens)
+            for chat_log in pending if chat_log.pk not in loaded_ids
+        )
+        return turns
+
+    async def get_conversation_history(self, conversation_id: int, budget: Optional[int] = None) -> List[dict]:
+        """Get the chat history for a conversation, trimmed to ``budget`` tokens if given."""
+        turns = await self.get_conversation_turns(conversation_id)
+        if budget is None:
+            self.dropped_turns = 0
+            return [message for turn in turns for message in (turn.user, turn.ai)]
+        window = build_context_window(turns, budget)
+        self.dropped_turns = window.dropped_turns
+        return window.messages
 
     async def prepare_messages(self, message: str, conversation_id: Optional[int] = None, system_prompt: Optional[str] = None) -> List[Any]:
         """Prepare messages for chat."""
-        ## TODO: i guess it's better to store the conversation in the session(cache)
         try:
             # Get or create conversation
             conversation = None
@@ -118,12 +524,24 @@ class ChatService:
             
             # Prepare messages
             messages = []
-            if system_prompt or conversation.system_prompt:
-                messages.append(SystemMessage(content=system_prompt or conversation.system_prompt))
+            prompt = system_prompt or conversation.system_prompt
+            if prompt:
+                messages.append(SystemMessage(content=prompt))
             
-            # Add conversation history
-            history_messages = await self.get_conversation_history(conversation.id)
-            messages.extend(history_messages)
+            # Add the running summary of older turns, if the conversation was compacted
+            budget = history_budget(self.provider, prompt or "", message)
+            with TRACER.span('chat.history', conversation_id=conversation.id) as span:
+                turns = await self.get_conversation_turns(conversation.id)
+                span.set(turns=len(turns))
+            if conversation.summary:
+                messages.append(SystemMessage(content=f"Summary of the earlier conversation:\n{conversation.summary}"))
+                budget = max(0, budget - estimate_tokens(conversation.summary))
+            
+            # Add the newest unsummarized history that fits the provider's context window
+            window = build_context_window(turns[conversation.summarized_turns:], budget)
+            self.dropped_turns = window.dropped_turns
+            self._turns = turns
+            messages.extend(window.messages)
             
             # Add current message
             messages.append(HumanMessage(content=message))
@@ -134,39 +552,82 @@ class ChatService:
             raise
 
     async def chat_stream(self, message: str, conversation_id: Optional[int] = None, system_prompt: Optional[str] = None) -> AsyncGenerator[str, None]:
-        """Stream the chat response."""
+        """Stream the chat response.
+
+        Identical requests streaming at the same time share one upstream
+        stream; a caller that joins late first gets the chunks received so far.
+        """
         conversation = None
+        # Spans started while preparing and opening the stream hang under this
+        # one; it is not made current across the yields, which belong to the caller
+        span = TRACER.span('chat.stream', provider=self.provider.name)
         try:
-            await self._ensure_llm()
-            messages, conversation = await self.prepare_messages(message, conversation_id, system_prompt)
+            with span.activate():
+                with TRACER.span('chat.prepare_messages'):
+                    messages, conversation = await self.prepare_messages(message, conversation_id, system_prompt)
+                span.set(conversation_id=conversation.id, dropped_turns=self.dropped_turns)
+                fingerprint = None
+                if coalescing_enabled(self.provider):
+                    fingerprint = provider_fingerprint(self.provider, await get_enabled_tool_names())
+                # The flight's task inherits the conversation (local models keep its prompt state)
+                with conversation_scope(conversation.id, shared=fingerprint is not None):
+                    if fingerprint is not None:
+                        flight, joined = SINGLE_FLIGHT.stream(
+                            'stream:' + response_cache_key(fingerprint, messages),
+                            lambda: self._open_chunks(messages),
+                        )
+                    else:
+                        flight, joined = StreamFlight(lambda: self._open_chunks(messages)), False
             full_response = []
-            async for chunk in self.llm.astream(messages):
-                if chunk.content:
-                    full_response.append(chunk.content)
-                    yield chunk.content
-            
-            # Log the chat after completion
-            print(f"CHAT-FULL-RESPONSE: {full_response}")
-            await create_chat_log(
-                provider=self.provider,
-                conversation=conversation,
-                system_prompt=system_prompt or conversation.system_prompt or "",
-                user_message=message,
-                ai_response="".join(full_response),
-                input_tokens=0,  # Token counting for streaming responses
-                output_tokens=0,
-                total_tokens=0
-            )
+            async for chunk in flight.subscribe():
+                if not full_response:
+                    span.set(first_chunk_ms=round(span.elapsed() * 1000, 1))
+                full_response.append(chunk)
+                yield chunk
+            outcome = flight.meta
+            provider = outcome.provider
+            self.served_provider = provider
+            span.set(served_provider=provider.name, joined=joined, chunks=len(full_response))
+            
+            # Log the chat after completion; callers that joined another
+            # caller's stream did not cost anything themselves
+            logger.debug(f"Chat full response: {full_response}")
+            if joined:
+                await log_chat(
+                    provider=provider,
+                    conversation=conversation,
+                    system_prompt=system_prompt or conversation.system_prompt or "",
+                    user_message=message,
+                    ai_response="".join(full_response),
+                    input_tokens=0,
+                    output_tokens=0,
+                    total_tokens=0,
+                    cached=True
+                )
+            else:
+                await log_chat(
+                    provider=provider,
+                    conversation=conversation,
+                    system_prompt=system_prompt or conversation.system_prompt or "",
+                    user_message=message,
+                    ai_response="".join(full_response),
+                    usage_estimated=outcome.usage_estimated,
+                    ttft_ms=outcome.ttft * 1000,
+                    latency_ms=outcome.latency * 1000,
+                    **outcome.usage
+                )
+            await self._schedule_summary(provider, conversation)
             
         except Exception as e:
             logger.error(f"Error in chat_stream: {str(e)}", exc_info=True)
+            span.end(e)
             error_message = f"Error: {str(e)}"
             yield error_message
             
             # Only try to log if we have a conversation
             if conversation:
                 # Log error in chat history
-                await create_chat_log(
+                await log_chat(
                     provider=self.provider,
                     conversation=conversation,
                     system_prompt=system_prompt or conversation.system_prompt or "",
@@ -176,43 +637,123 @@ class ChatService:
                     output_tokens=0,
                     total_tokens=0
                 )
+        finally:
+            span.end()
 
     async def chat(self, message: str, conversation_id: Optional[int] = None, system_prompt: Optional[str] = None) -> Dict[str, Any]:
         """Process a chat message and return the response."""
         try:
-            await self._ensure_llm()
-            messages, conversation = await self.prepare_messages(message, conversation_id, system_prompt)
+            with TRACER.span('chat.prepare_messages'):
+                messages, conversation = await self.prepare_messages(message, conversation_id, system_prompt)
+            
+            # Deterministic providers answer identical prompts identically
+            cache_key = None
+            semantic = None
+            threshold = semantic_threshold(self.provider)
+            if is_cacheable(self.provider) or threshold or coalescing_enabled(self.provider):
+                fingerprint = provider_fingerprint(self.provider, await get_enabled_tool_names())
+            if is_cacheable(self.provider):
+                cache_key = response_cache_key(fingerprint, messages)
+                cached = await RESPONSE_CACHE.get(cache_key)
+                if cached is not None:
+                    return await self._reply_from_cache(cached['reply'], message, conversation, system_prompt)
             
-            # Get response
-            response = await self.llm.ainvoke(messages)
+            # Paraphrases of an opening message can reuse an earlier answer; later
+            # turns depend on their history, so only history-free prompts qualify
+            if threshold and all(m.type == 'system' for m in messages[:-1]) and not conversation.summary:
+                semantic_cache = await aget_semantic_cache()
+                namespace = semantic_namespace(fingerprint, system_prompt or conversation.system_prompt or "")
+                with TRACER.span('cache.semantic') as span:
+                    vector = await semantic_cache.embed(message)
+                    reply = await semantic_cache.lookup(namespace, vector, threshold)
+                    span.set(hit=reply is not None)
+                if reply is not None:
+                    return await self._reply_from_cache(reply, message, conversation, system_prompt)
+                semantic = (semantic_cache, namespace, vector)
+            
+            # Get response (from a lower priority provider if the requested one fails);
+            # identical requests already in flight share that call
+            joined = False
+            with conversation_scope(conversation.id, shared=coalescing_enabled(self.provider)):
+                if coalescing_enabled(self.provider):
+                    (provider, strategy, response, latency), joined = await SINGLE_FLIGHT.call(
+                        'call:' + response_cache_key(fingerprint, messages),
+                        lambda: self._invoke(messages),
+                    )
+                else:
+                    provider, strategy, response, latency = await self._invoke(messages)
+            self.served_provider = provider
+            if joined:
+                return await self._reply_from_cache(response.content, message, conversation, system_prompt, provider)
             
             # Extract usage statistics
-            usage = self.strategy.get_token_usage(response)
+            usage, usage_estimated = resolve_usage(provider, prompt_text(messages), response.content,
+                                                   strategy.get_token_usage(response))
+            
+            # Replies from a failover provider are not stored under the requested provider's key
+            if provider.id == self.provider.id and response.content and not getattr(response, 'tool_calls', None):
+                if cache_key:
+                    await RESPONSE_CACHE.set(cache_key, {'reply': response.content})
+                if semantic:
+                    semantic_cache, namespace, vector = semantic
+                    semantic_cache.store(namespace, vector, message, response.content)
             
             # Log the chat
-            await create_chat_log(
-                provider=self.provider,
+            await log_chat(
+                provider=provider,
                 conversation=conversation,
                 system_prompt=system_prompt or conversation.system_prompt or "",
                 user_message=message,
                 ai_response=response.content,
                 input_tokens=usage['input_tokens'],
                 output_tokens=usage['output_tokens'],
-                total_tokens=usage['total_tokens']
+                total_tokens=usage['total_tokens'],
+                usage_estimated=usage_estimated,
+                latency_ms=latency * 1000
             )
             
+            await self._schedule_summary(provider, conversation)
+            
             return {
                 'reply': response.content,
                 'usage': usage,
-                'conversation_id': conversation.id
+                'provider': provider,
+                'conversation_id': conversation.id,
+                'dropped_turns': self.dropped_turns,
+                'cached': False
             }
             
         except Exception as e:
             logger.error(f"Error in chat: {str(e)}", exc_info=True)
             raise
 
-# Update the get_active_provider function
-get_active_provider = sync_to_async(lambda: ModelProvider.objects.filter(is_active=True).order_by('-priority').first())
+    async def _reply_from_cache(self, reply: str, message: str, conversation: Conversation, system_prompt: Optional[str],
+                                provider: Optional[ModelProvider] = None) -> Dict[str, Any]:
+        """Log and return a reply that was served without calling the provider (again)."""
+        provider = provider or self.provider
+        usage = {'input_tokens': 0, 'output_tokens': 0, 'total_tokens': 0}
+        await log_chat(
+            provider=provider,
+            conversation=conversation,
+            system_prompt=system_prompt or conversation.system_prompt or "",
+            user_message=message,
+            ai_response=reply,
+            cached=True,
+            **usage
+        )
+        self.served_provider = provider
+        return {
+            'reply': reply,
+            'usage': usage,
+            'provider': provider,
+            'conversation_id': conversation.id,
+            'dropped_turns': self.dropped_turns,
+            'cached': True
+        }
+
+async def get_active_provider() -> Optional[ModelProvider]:
+    """Get the highest priority active provider from the in-memory registry."""
+    return await PROVIDER_REGISTRY.aprimary()
 
 async def get_enabled_tools() -> List[BaseTool]:
     """Get all enabled tools from the database."""
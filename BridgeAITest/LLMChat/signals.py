@@ -0,0 +1,44 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import ModelProvider, Tool, Conversation, ChatLog
+from .model_cache import MODEL_CACHE
+from .history import HISTORY_CACHE
+from .prompt_state import PROMPT_STATES
+from .registry import PROVIDER_REGISTRY
+from .resilience import BREAKERS
+from .limits import LIMITS
+
+
+@receiver([post_save, post_delete], sender=ModelProvider)
+def invalidate_provider_models(sender, instance, **kwargs):
+    """Drop cached chat models and the provider snapshot in every worker."""
+    MODEL_CACHE.invalidate(instance.pk)
+    BREAKERS.reset(instance.pk)
+    LIMITS.reset(instance.pk)
+    PROVIDER_REGISTRY.invalidate()
+
+
+@receiver([post_save, post_delete], sender=Tool)
+def invalidate_tool_bindings(sender, instance, **kwargs):
+    """Tool changes affect every bound model, so drop them all."""
+    MODEL_CACHE.invalidate()
+    # Also bumps the shared generation so other workers rebind their tools
+    PROVIDER_REGISTRY.invalidate()
+
+
+@receiver(post_save, sender=ChatLog)
+def invalidate_edited_history(sender, instance, created, **kwargs):
+    """New turns are appended by the chat service; edits need a reload."""
+    if not created:
+        HISTORY_CACHE.discard(instance.conversation_id)
+
+
+@receiver(post_delete, sender=ChatLog)
+def invalidate_deleted_history(sender, instance, **kwargs):
+    HISTORY_CACHE.discard(instance.conversation_id)
+
+
+@receiver(post_delete, sender=Conversation)
+def forget_conversation_history(sender, instance, **kwargs):
+    HISTORY_CACHE.discard(instance.pk)
+    PROMPT_STATES.discard_conversation(instance.pk)
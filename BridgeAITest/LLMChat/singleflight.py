@@ -0,0 +1,174 @@
+"""Coalescing of identical in-flight chat requests."""
+import asyncio
+import logging
+import threading
+import weakref
+from typing import Any, AsyncGenerator, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from django.conf import settings
+
+from .response_cache import is_cacheable
+
+logger = logging.getLogger(__name__)
+
+
+def coalescing_enabled(provider) -> bool:
+    """Whether identical requests in flight share one upstream call.
+
+    ``extra_settings['single_flight']`` decides per provider. Otherwise
+    LLMCHAT_SINGLE_FLIGHT (off by default) turns it on only for providers
+    whose replies are cacheable (temperature 0, see is_cacheable): callers
+    of a sampling provider would all get one shared sample.
+    """
+    configured = (provider.extra_settings or {}).get('single_flight')
+    if configured is not None:
+        return bool(configured)
+    return bool(getattr(settings, 'LLMCHAT_SINGLE_FLIGHT', False)) and is_cacheable(provider)
+
+
+class _CallFlight:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class StreamFlight:
+    """One upstream stream whose chunks are replayed to every subscriber.
+
+    ``opener`` returns ``(meta, chunks)``; ``meta`` (e.g. the provider that
+    answered) is kept on the flight. Chunks are buffered for the lifetime of
+    the flight so a late subscriber first gets everything received so far and
+    then follows the live stream. The upstream stream is cancelled once the
+    last subscriber goes away.
+    """
+
+    def __init__(self, opener: Callable[[], Awaitable[Tuple[Any, AsyncIterator[str]]]]):
+        self.meta = None
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.abandoned = False
+        self._changed = asyncio.Event()
+        self.task = asyncio.ensure_future(self._pump(opener))
+
+    async def _pump(self, opener) -> None:
+        chunks = None
+        try:
+            self.meta, chunks = await opener()
+            async for chunk in chunks:
+                self.chunks.append(chunk)
+                self._notify()
+        except Exception as e:
+            self.error = e
+        finally:
+            if chunks is not None and hasattr(chunks, 'aclose'):
+                await chunks.aclose()
+            self.done = True
+            self._notify()
+
+    def _notify(self) -> None:
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def subscribe(self) -> AsyncGenerator[str, None]:
+        """Yield the buffered chunks, then the live ones; re-raise the upstream error, if any."""
+        self.subscribers += 1
+        index = 0
+        try:
+            while True:
+                # Grab the event first so a chunk published meanwhile still wakes us
+                changed = self._changed
+                while index < len(self.chunks):
+                    yield self.chunks[index]
+                    index += 1
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await changed.wait()
+        finally:
+            self.subscribers -= 1
+            if not self.subscribers and not self.task.done():
+                self.abandoned = True
+                self.task.cancel()
+
+
+class SingleFlight:
+    """Attaches callers to an identical request that is already in flight.
+
+    Flights are tracked per event loop: tasks and events belong to the loop
+    that created them, so requests served by different loops never share.
+    """
+
+    def __init__(self):
+        self._tables = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.joined = 0
+
+    def _table(self) -> Dict[str, Any]:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            table = self._tables.get(loop)
+            if table is None:
+                table = self._tables[loop] = {}
+            return table
+
+    def _count(self, joined: bool) -> None:
+        with self._lock:
+            if joined:
+                self.joined += 1
+            else:
+                self.leaders += 1
+
+    async def call(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Await ``factory()`` or the identical call in flight; returns ``(result, joined)``.
+
+        The upstream call runs in its own task, so one caller being cancelled
+        does not fail the others; it is only cancelled when nobody waits anymore.
+        """
+        table = self._table()
+        flight = table.get(key)
+        joined = isinstance(flight, _CallFlight) and not flight.task.cancelled()
+        if not joined:
+            flight = table[key] = _CallFlight(asyncio.ensure_future(factory()))
+            flight.task.add_done_callback(lambda _: table.get(key) is flight and table.pop(key))
+        self._count(joined)
+        if joined:
+            logger.debug(f"Joined in-flight call {key}")
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task), joined
+        finally:
+            flight.waiters -= 1
+            if not flight.waiters and not flight.task.done():
+                flight.task.cancel()
+
+    def stream(self, key: str, opener: Callable[[], Awaitable[Tuple[Any, AsyncIterator[str]]]]) -> Tuple[StreamFlight, bool]:
+        """Return the stream in flight for ``key`` (or start one) and whether it was joined."""
+        table = self._table()
+        flight = table.get(key)
+        joined = isinstance(flight, StreamFlight) and not flight.done and not flight.abandoned
+        if not joined:
+            flight = table[key] = StreamFlight(opener)
+            flight.task.add_done_callback(lambda _: table.get(key) is flight and table.pop(key))
+        self._count(joined)
+        if joined:
+            logger.debug(f"Joined in-flight stream {key} after {len(flight.chunks)} chunks")
+        return flight, joined
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            in_flight = sum(len(table) for table in self._tables.values())
+            calls = self.leaders + self.joined
+            return {
+                'leaders': self.leaders,
+                'joined': self.joined,
+                'join_ratio': self.joined / calls if calls else 0.0,
+                'in_flight': in_flight,
+            }
+
+
+# Initialize the global single-flight registry
+SINGLE_FLIGHT = SingleFlight()
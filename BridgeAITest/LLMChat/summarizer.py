@@ -0,0 +1,153 @@
+"""Background rolling summarization of old conversation turns."""
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+from typing import Optional, Sequence, Set
+
+from django.conf import settings
+from langchain_core.messages import HumanMessage, SystemMessage
+
+from .db import db_sync_to_async
+from .deadlines import call_timeouts, deadline_scope, time_left, with_retries, within
+from .limits import LIMITS, QueueTimeout, request_tokens
+from .models import Conversation
+from .resilience import BREAKERS
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation between a user and an assistant. "
+    "Merge the new turns into the existing summary. Keep facts, names, decisions and open "
+    "questions; drop small talk. Reply with the updated summary only."
+)
+
+# Only advance the summary if nobody else compacted the conversation meanwhile
+save_summary = db_sync_to_async(
+    lambda conversation_id, previous_turns, summary, summarized_turns: Conversation.objects.filter(
+        id=conversation_id, summarized_turns=previous_turns
+    ).update(summary=summary, summarized_turns=summarized_turns)
+)
+
+
+def summary_settings(provider) -> Optional[tuple]:
+    """Return ``(keep_turns, batch_turns)`` for the provider, or ``None`` if disabled.
+
+    ``keep_turns`` newest turns are always sent verbatim; older turns are folded
+    into the summary once at least ``batch_turns`` of them have accumulated.
+    """
+    extra = provider.extra_settings or {}
+    keep_turns = extra.get('summary_keep_turns', getattr(settings, 'LLMCHAT_SUMMARY_KEEP_TURNS', None))
+    if not keep_turns:
+        return None
+    batch_turns = extra.get('summary_batch_turns', getattr(settings, 'LLMCHAT_SUMMARY_BATCH_TURNS', 10))
+    return int(keep_turns), max(1, int(batch_turns))
+
+
+def format_transcript(turns: Sequence) -> str:
+    return "\n".join(f"User: {turn.user.content}\nAssistant: {turn.ai.content}" for turn in turns)
+
+
+class ConversationSummarizer:
+    """Folds old turns into ``Conversation.summary`` off the request path.
+
+    Each compaction only summarizes the turns added since the previous one
+    (``Conversation.summarized_turns`` marks how far the summary reaches).
+    The call goes through the provider's limiter, circuit breaker and retries
+    like a chat call, under a deadline of its own rather than the request's.
+    """
+
+    def __init__(self):
+        self._running: Set[int] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self._lock = threading.Lock()
+
+    def maybe_schedule(self, llm, provider, conversation: Conversation, turns: Sequence) -> bool:
+        """Start a background compaction if enough unsummarized old turns piled up.
+
+        ``llm`` should have no tools bound: the reply has to be the summary itself.
+        """
+        config = summary_settings(provider)
+        if config is None:
+            return False
+        keep_turns, batch_turns = config
+        target = len(turns) - keep_turns
+        if target - conversation.summarized_turns < batch_turns:
+            return False
+        with self._lock:
+            if conversation.id in self._running:
+                return False
+            self._running.add(conversation.id)
+
+        # A fresh context: the request's deadline, trace and conversation scope do not apply
+        task = asyncio.create_task(self._compact(
+            llm, provider, conversation.id, conversation.summary, conversation.summarized_turns,
+            list(turns[conversation.summarized_turns:target]),
+        ), context=contextvars.Context())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    async def _compact(self, llm, provider, conversation_id: int, summary: str, summarized_turns: int,
+                       delta: list) -> None:
+        messages = [
+            SystemMessage(content=SUMMARY_PROMPT),
+            HumanMessage(content=(
+                f"Existing summary:\n{summary or '(none)'}\n\n"
+                f"New turns:\n{format_transcript(delta)}"
+            )),
+        ]
+        try:
+            response = await self._summarize(llm, provider, messages)
+            if response is None:
+                return
+            content = response.content.strip() if isinstance(response.content, str) else ''
+            if not content:
+                logger.warning(f"Provider {provider.name} returned an empty summary of conversation {conversation_id}")
+                return
+            updated = await save_summary(conversation_id, summarized_turns, content, summarized_turns + len(delta))
+            if updated:
+                logger.info(f"Summarized {len(delta)} turns of conversation {conversation_id}")
+        except Exception as e:
+            logger.error(f"Error summarizing conversation {conversation_id}: {str(e)}", exc_info=True)
+        finally:
+            with self._lock:
+                self._running.discard(conversation_id)
+
+    async def _summarize(self, llm, provider, messages: list):
+        """Call the provider like a chat call would; ``None`` if its circuit is open or its queue is full."""
+        breaker = BREAKERS.get(provider)
+        if not breaker.allow():
+            logger.info(f"Skipped a summary: the circuit of provider {provider.name} is open")
+            return None
+        try:
+            with deadline_scope():
+                response, latency = await with_retries(provider, lambda: self._summarize_once(llm, provider, messages))
+        except QueueTimeout as e:
+            logger.warning(str(e))
+            return None
+        except Exception:
+            breaker.record_failure()
+            raise
+        else:
+            breaker.record_success(latency)
+            return response
+        finally:
+            breaker.release_probe()
+
+    async def _summarize_once(self, llm, provider, messages: list):
+        limiter = LIMITS.get(provider)
+        permit = await limiter.acquire(request_tokens(provider, messages), timeout=time_left(limiter.queue_timeout))
+        started = time.monotonic()
+        try:
+            async with within(call_timeouts(provider).call, f"No summary from provider {provider.name}"):
+                response = await llm.ainvoke(messages)
+            permit.used_tokens = (getattr(response, 'usage_metadata', None) or {}).get('total_tokens')
+        finally:
+            permit.release()
+        return response, time.monotonic() - started
+
+
+# Initialize the global summarizer
+SUMMARIZER = ConversationSummarizer()
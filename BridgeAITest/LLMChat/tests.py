@@ -1,3 +1,1768 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+import httpx
+import numpy as np
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from .batching import BatchScheduler, FakeBatchBackend
+from .consumers import ChatConsumer, new_tts_session, tts_group
+from .context import build_context_window, context_window_size, estimate_tokens, history_budget
+from .deadlines import (DeadlineExceeded, ProviderTimeout, RetryPolicy, StreamWatchdog, current_deadline,
+                        deadline_scope, retryable, time_left, with_retries, within)
+from .models import ChatLog, Conversation, ModelProvider
+from .history import HistoryCache, Turn
+from .http_pool import HostStats, HTTPPoolManager
+from .middleware import TracingMiddleware
+from .monitoring import (METRICS, export, load_snapshots, merge_snapshots, process_started, scrape_allowed,
+                         start_time)
+from .native_stream import AnthropicStreamClient, OpenAIStreamClient, StreamDelta, sse_events
+from .limits import ProviderLimiter, QueueTimeout
+from .metrics import UsageEstimator, resolve_usage
+from .response_cache import (DjangoResponseCacheBackend, LocalResponseCacheBackend, ResponseCache, is_cacheable,
+                             response_cache_key)
+from .prompt_state import PromptState, PromptStateCache, conversation_scope, shared_generation
+from .resilience import BREAKERS, CircuitBreaker, ProvidersUnavailable
+from .semantic_cache import HashingEmbedder, SemanticCache, VectorIndex, claim_shard
+from .services import ChatService
+from .singleflight import SingleFlight, coalescing_enabled
+from .summarizer import ConversationSummarizer
+from .tracing import TRACER, Tracer, current_span, server_timing
+from .writer import ChatLogWriter
+
+
+def make_provider(name='test', **fields):
+    return ModelProvider.objects.create(name=name, provider='openai', model_name='gpt-4o', api_key='test', **fields)
+
+
+class ChatLogWriterTests(TransactionTestCase):
+    """The writer saves from its own thread, so rows must be committed to be seen."""
+
+    def setUp(self):
+        self.provider = make_provider()
+        self.conversation = Conversation.objects.create()
+
+    def writer(self, **kwargs):
+        writer = ChatLogWriter(**{'batch_size': 10, 'flush_interval': 60.0, **kwargs})
+        self.addCleanup(writer.close)
+        return writer
+
+    def chat_log(self, text, conversation=None):
+        return ChatLog(provider=self.provider, conversation=conversation or self.conversation,
+                       user_message=text, ai_response=f"re: {text}",
+                       input_tokens=1, output_tokens=1, total_tokens=2)
+
+    def test_rows_are_queued_until_flushed(self):
+        writer = self.writer()
+        writer.write(self.chat_log('one'))
+        writer.write(self.chat_log('two'))
+        self.assertEqual(ChatLog.objects.count(), 0)
+
+        self.assertEqual(writer.flush(), 2)
+        self.assertEqual(list(ChatLog.objects.order_by('id').values_list('user_message', flat=True)), ['one', 'two'])
+        self.assertEqual(writer.flush(), 0)
+
+    def test_full_batch_is_flushed_in_the_background(self):
+        writer = self.writer(batch_size=2)
+        writer.write(self.chat_log('one'))
+        writer.write(self.chat_log('two'))
+
+        deadline = time.monotonic() + 5
+        while ChatLog.objects.count() < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(ChatLog.objects.count(), 2)
+        self.assertEqual(writer.pending_for(self.conversation.id), [])
+
+    def test_flush_interval_saves_a_partial_batch(self):
+        writer = self.writer(flush_interval=0.05)
+        writer.write(self.chat_log('one'))
+
+        deadline = time.monotonic() + 5
+        while not ChatLog.objects.exists() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(ChatLog.objects.count(), 1)
+
+    def test_pending_for_returns_unsaved_rows_of_one_conversation_oldest_first(self):
+        other = Conversation.objects.create()
+        writer = self.writer()
+        writer.write(self.chat_log('one'))
+        writer.write(self.chat_log('elsewhere', other))
+        writer.write(self.chat_log('two'))
+
+        pending = writer.pending_for(self.conversation.id)
+        self.assertEqual([chat_log.user_message for chat_log in pending], ['one', 'two'])
+
+        writer.flush()
+        self.assertEqual(writer.pending_for(self.conversation.id), [])
+
+    def test_a_bad_row_does_not_lose_the_rest_of_its_batch(self):
+        doomed = Conversation.objects.create()
+        writer = self.writer()
+        writer.write(self.chat_log('kept'))
+        writer.write(self.chat_log('dropped', doomed))
+        doomed.delete()
+
+        with self.assertLogs('LLMChat.writer', 'ERROR'):
+            self.assertEqual(writer.flush(), 1)
+        self.assertEqual(list(ChatLog.objects.values_list('user_message', flat=True)), ['kept'])
+
+    def test_close_flushes_what_is_left(self):
+        writer = ChatLogWriter(batch_size=10, flush_interval=60.0)
+        writer.write(self.chat_log('one'))
+        writer.close()
+        self.assertEqual(ChatLog.objects.count(), 1)
+
+
+class SynchronousChatLogWriterTests(TestCase):
+
+    def test_synchronous_writes_save_right_away(self):
+        writer = ChatLogWriter(batch_size=10, flush_interval=60.0, synchronous=True)
+        self.addCleanup(writer.close)
+        chat_log = ChatLog(provider=make_provider(), conversation=Conversation.objects.create(),
+                           user_message='one', ai_response='re: one',
+                           input_tokens=1, output_tokens=1, total_tokens=2)
+        writer.write(chat_log)
+
+        self.assertIsNotNone(chat_log.pk)
+        self.assertEqual(writer.pending_for(chat_log.conversation_id), [])
+        self.assertTrue(ChatLog.objects.filter(pk=chat_log.pk).exists())
+
+
+class Clock:
+    """A settable stand-in for ``time.monotonic``."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class CircuitBreakerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        for patcher in (mock.patch('LLMChat.resilience.time.monotonic', self.clock),
+                        mock.patch('LLMChat.resilience.logger')):  # no "circuit opened" noise
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker('test', window=4, min_calls=4, error_rate=0.5, open_seconds=30.0)
+
+    def trip(self):
+        for _ in range(4):
+            self.breaker.record_failure()
+
+    def test_opens_once_the_error_rate_is_reached(self):
+        self.breaker.record_success(0.1)
+        self.breaker.record_success(0.1)
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+
+    def test_needs_min_calls_before_opening(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+    def test_slow_calls_count_as_failures(self):
+        breaker = CircuitBreaker('slow', window=2, min_calls=2, error_rate=1.0, latency_threshold=1.0)
+        breaker.record_success(2.0)
+        breaker.record_success(3.0)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+    def test_lets_one_probe_through_after_open_seconds(self):
+        self.trip()
+        self.clock.now += 29
+        self.assertFalse(self.breaker.allow())
+        self.clock.now += 1
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(self.breaker.allow())
+
+    def test_successful_probe_closes(self):
+        self.trip()
+        self.clock.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_success(0.1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+    def test_failed_probe_opens_again(self):
+        self.trip()
+        self.clock.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+
+    def test_probe_that_never_reports_back_expires(self):
+        self.trip()
+        self.clock.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.clock.now += 30
+        self.assertTrue(self.breaker.allow())
+
+    def test_released_probe_lets_the_next_call_probe(self):
+        self.trip()
+        self.clock.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.breaker.release_probe()
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(self.breaker.allow())
+
+    def test_release_after_an_outcome_changes_nothing(self):
+        self.trip()
+        self.clock.now += 30
+        self.breaker.allow()
+        self.breaker.record_failure()
+        self.breaker.release_probe()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+
+
+class HalfOpenProbeReleaseTests(SimpleTestCase):
+    """A probe that never reached the provider must not keep the half-open slot."""
+
+    def setUp(self):
+        self.provider = ModelProvider(id=9001, name='probe', provider='openai', model_name='gpt-4o')
+        self.addCleanup(BREAKERS.reset, self.provider.id)
+        self.breaker = BREAKERS.get(self.provider)
+        self.breaker.state = CircuitBreaker.HALF_OPEN
+        self.service = ChatService(self.provider)
+        self.service.failover_candidates = mock.AsyncMock(return_value=[self.provider])
+
+    async def test_invoke_releases_the_probe_on_queue_timeout(self):
+        self.service._invoke_once = mock.AsyncMock(side_effect=QueueTimeout("full"))
+        with self.assertLogs('LLMChat.services', 'WARNING'), self.assertRaises(ProvidersUnavailable):
+            await self.service._invoke([])
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(self.breaker.allow())
+
+    async def test_open_stream_releases_the_probe_on_queue_timeout(self):
+        self.service._start_stream = mock.AsyncMock(side_effect=QueueTimeout("full"))
+        with self.assertLogs('LLMChat.services', 'WARNING'), self.assertRaises(ProvidersUnavailable):
+            await self.service._open_stream([])
+        self.assertTrue(self.breaker.allow())
+
+
+class OpenStreamCancellationTests(SimpleTestCase):
+
+    async def test_cancelling_open_stream_cancels_its_attempts(self):
+        provider = ModelProvider(id=9003, name='hung', provider='openai', model_name='gpt-4o')
+        self.addCleanup(BREAKERS.reset, provider.id)
+        service = ChatService(provider)
+        service.failover_candidates = mock.AsyncMock(return_value=[provider])
+        started, attempt_cancelled = asyncio.Event(), asyncio.Event()
+
+        async def start_stream(provider, messages):
+            started.set()
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                attempt_cancelled.set()
+                raise
+
+        service._start_stream = start_stream
+        opening = asyncio.create_task(service._open_stream([]))
+        await started.wait()
+        opening.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await opening
+        await asyncio.wait_for(attempt_cancelled.wait(), 1)
+
+
+class ProviderLimiterTests(SimpleTestCase):
+
+    async def test_waiters_are_granted_first_come_first_served(self):
+        limiter = ProviderLimiter('test', max_concurrency=1)
+        held = await limiter.acquire()
+        granted = []
+
+        async def wait(name):
+            permit = await limiter.acquire()
+            granted.append(name)
+            return permit
+
+        waiters = []
+        for name in ('first', 'second', 'third'):
+            waiters.append(asyncio.create_task(wait(name)))
+            await asyncio.sleep(0)
+        self.assertEqual(limiter.stats()['queue_depth'], 3)
+
+        permit = held
+        for waiter in waiters:
+            permit.release()
+            permit = await waiter
+        permit.release()
+        self.assertEqual(granted, ['first', 'second', 'third'])
+        self.assertEqual(limiter.active, 0)
+
+    async def test_new_callers_queue_behind_waiters(self):
+        limiter = ProviderLimiter('test', max_concurrency=1)
+        held = await limiter.acquire()
+        waiter = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        held.release()
+        # The slot is the waiter's now, even before it had a chance to run
+        with self.assertRaises(QueueTimeout):
+            await limiter.acquire(timeout=0.01)
+        (await waiter).release()
+
+    async def test_gives_up_after_the_queue_timeout(self):
+        limiter = ProviderLimiter('test', max_concurrency=1, queue_timeout=0.05)
+        held = await limiter.acquire()
+        started = time.monotonic()
+        with self.assertRaises(QueueTimeout):
+            await limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.05)
+        stats = limiter.stats()
+        self.assertEqual((stats['timed_out'], stats['queue_depth']), (1, 0))
+        held.release()
+        self.assertEqual(limiter.active, 0)
+
+    async def test_cancelled_waiter_leaves_the_queue(self):
+        limiter = ProviderLimiter('test', max_concurrency=1)
+        held = await limiter.acquire()
+        waiter = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiter
+        self.assertEqual(limiter.stats()['queue_depth'], 0)
+        held.release()
+        self.assertEqual(limiter.active, 0)
+
+    async def test_waiter_cancelled_after_being_granted_passes_the_slot_on(self):
+        limiter = ProviderLimiter('test', max_concurrency=1)
+        held = await limiter.acquire()
+        cancelled = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        next_in_line = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+
+        held.release()  # grants the first waiter, which is cancelled before it runs
+        cancelled.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await cancelled
+        permit = await asyncio.wait_for(next_in_line, 1)
+        self.assertEqual(limiter.active, 1)
+        permit.release()
+        self.assertEqual(limiter.active, 0)
+
+    async def test_permit_release_is_idempotent(self):
+        limiter = ProviderLimiter('test', max_concurrency=2)
+        permit = await limiter.acquire()
+        permit.release()
+        permit.release()
+        self.assertEqual(limiter.active, 0)
+
+
+class SingleFlightTests(SimpleTestCase):
+
+    def test_coalescing_is_off_by_default_and_only_for_deterministic_providers(self):
+        greedy = ModelProvider(name='greedy', provider='openai', temperature=0)
+        sampling = ModelProvider(name='sampling', provider='openai', temperature=0.7)
+        self.assertFalse(coalescing_enabled(greedy))
+        with override_settings(LLMCHAT_SINGLE_FLIGHT=True):
+            self.assertTrue(coalescing_enabled(greedy))
+            self.assertFalse(coalescing_enabled(sampling))
+        sampling.extra_settings = {'single_flight': True}
+        self.assertTrue(coalescing_enabled(sampling))
+
+    async def test_identical_calls_share_one_upstream_call(self):
+        flights = SingleFlight()
+        calls = 0
+        release = asyncio.Event()
+
+        async def factory():
+            nonlocal calls
+            calls += 1
+            await release.wait()
+            return 'reply'
+
+        first = asyncio.create_task(flights.call('key', factory))
+        second = asyncio.create_task(flights.call('key', factory))
+        await asyncio.sleep(0)
+        release.set()
+        self.assertEqual(await first, ('reply', False))
+        self.assertEqual(await second, ('reply', True))
+        self.assertEqual(calls, 1)
+        self.assertEqual(flights.stats()['in_flight'], 0)
+
+    async def test_cancelled_leader_does_not_fail_the_callers_that_joined(self):
+        flights = SingleFlight()
+        release = asyncio.Event()
+
+        async def factory():
+            await release.wait()
+            return 'reply'
+
+        leader = asyncio.create_task(flights.call('key', factory))
+        joined = asyncio.create_task(flights.call('key', factory))
+        await asyncio.sleep(0)
+        leader.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await leader
+        release.set()
+        self.assertEqual(await joined, ('reply', True))
+
+    async def test_upstream_call_is_cancelled_when_every_caller_is(self):
+        flights = SingleFlight()
+        upstream_cancelled = asyncio.Event()
+
+        async def factory():
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                upstream_cancelled.set()
+                raise
+
+        callers = [asyncio.create_task(flights.call('key', factory)) for _ in range(2)]
+        await asyncio.sleep(0)
+        for caller in callers:
+            caller.cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        await asyncio.wait_for(upstream_cancelled.wait(), 1)
+
+        # The next identical call starts afresh instead of joining the cancelled one
+        async def fresh():
+            return 'again'
+        self.assertEqual(await flights.call('key', fresh), ('again', False))
+
+    async def test_late_stream_subscriber_gets_the_chunks_so_far(self):
+        flights = SingleFlight()
+        more = asyncio.Event()
+
+        async def opener():
+            async def chunks():
+                yield 'a'
+                yield 'b'
+                await more.wait()
+                yield 'c'
+            return 'meta', chunks()
+
+        flight, joined = flights.stream('key', opener)
+        self.assertFalse(joined)
+        early = flight.subscribe()
+        self.assertEqual([await anext(early), await anext(early)], ['a', 'b'])
+
+        late_flight, joined = flights.stream('key', opener)
+        self.assertIs(late_flight, flight)
+        self.assertTrue(joined)
+        late = flight.subscribe()
+        self.assertEqual([await anext(late), await anext(late)], ['a', 'b'])
+
+        more.set()
+        self.assertEqual([chunk async for chunk in early], ['c'])
+        self.assertEqual([chunk async for chunk in late], ['c'])
+        self.assertEqual(flight.meta, 'meta')
+
+    async def test_subscriber_leaving_mid_stream_keeps_it_going_for_the_others(self):
+        flights = SingleFlight()
+        more = asyncio.Event()
+
+        async def opener():
+            async def chunks():
+                yield 'a'
+                await more.wait()
+                yield 'b'
+            return None, chunks()
+
+        flight, _ = flights.stream('key', opener)
+        leaving, staying = flight.subscribe(), flight.subscribe()
+        self.assertEqual(await anext(leaving), 'a')
+        self.assertEqual(await anext(staying), 'a')
+        await leaving.aclose()
+
+        self.assertEqual(flight.subscribers, 1)
+        self.assertFalse(flight.abandoned)
+        more.set()
+        self.assertEqual([chunk async for chunk in staying], ['b'])
+
+    async def test_stream_is_cancelled_when_the_last_subscriber_leaves(self):
+        flights = SingleFlight()
+        closed = asyncio.Event()
+
+        async def opener():
+            async def chunks():
+                try:
+                    yield 'a'
+                    await asyncio.Event().wait()
+                finally:
+                    closed.set()
+            return None, chunks()
+
+        flight, _ = flights.stream('key', opener)
+        subscriber = flight.subscribe()
+        self.assertEqual(await anext(subscriber), 'a')
+        await subscriber.aclose()
+
+        self.assertTrue(flight.abandoned)
+        await asyncio.wait_for(closed.wait(), 1)
+        # An abandoned flight is not joined by the next identical request
+        fresh, joined = flights.stream('key', opener)
+        self.assertFalse(joined)
+        fresh.task.cancel()
+
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+class DeadlineTests(SimpleTestCase):
+
+    def test_earlier_outer_deadline_stays_in_force(self):
+        with deadline_scope(10) as outer:
+            with deadline_scope(60) as inner:
+                self.assertIs(inner, outer)
+            with deadline_scope(5) as inner:
+                self.assertIsNot(inner, outer)
+            self.assertIs(current_deadline(), outer)
+        self.assertIsNone(current_deadline())
+
+    def test_time_left_caps_timeouts_and_raises_once_expired(self):
+        self.assertEqual(time_left(3.0), 3.0)
+        with deadline_scope(1):
+            self.assertLessEqual(time_left(30.0), 1.0)
+            self.assertEqual(time_left(0.5), 0.5)
+        with deadline_scope(0.01):
+            time.sleep(0.02)
+            with self.assertRaises(DeadlineExceeded):
+                time_left(30.0)
+
+    async def test_within_raises_provider_timeout(self):
+        with self.assertRaises(ProviderTimeout):
+            async with within(0.01, "No reply"):
+                await asyncio.sleep(1)
+
+    async def test_within_raises_deadline_exceeded_when_the_deadline_ran_out(self):
+        with deadline_scope(0.01), self.assertRaises(DeadlineExceeded):
+            async with within(30.0, "No reply"):
+                await asyncio.sleep(1)
+
+
+async def stream_of(*chunks, stall_after=None):
+    for index, chunk in enumerate(chunks):
+        if index == stall_after:
+            await asyncio.Event().wait()
+        yield chunk
+
+
+class StreamWatchdogTests(SimpleTestCase):
+
+    async def read_all(self, stream, timeout):
+        watchdog = StreamWatchdog(timeout, "No chunk")
+        chunks = []
+        try:
+            while (chunk := await watchdog.next(stream)) is not None:
+                chunks.append(chunk)
+        finally:
+            watchdog.close()
+        return chunks
+
+    async def test_passes_chunks_through(self):
+        self.assertEqual(await self.read_all(stream_of('a', 'b', 'c'), 1.0), ['a', 'b', 'c'])
+        self.assertEqual(asyncio.current_task().cancelling(), 0)
+
+    async def test_fires_when_the_next_chunk_is_late(self):
+        chunks = []
+        watchdog = StreamWatchdog(0.05, "No chunk")
+        stream = stream_of('a', 'b', stall_after=1)
+        chunks.append(await watchdog.next(stream))
+        with self.assertRaises(ProviderTimeout):
+            await watchdog.next(stream)
+        watchdog.close()
+        self.assertEqual(chunks, ['a'])
+        # The watchdog's own cancellation must not leak into the reading task
+        self.assertEqual(asyncio.current_task().cancelling(), 0)
+
+    async def test_slow_but_steady_stream_is_not_cut(self):
+        async def steady():
+            for chunk in 'abcde':
+                await asyncio.sleep(0.02)
+                yield chunk
+
+        # Every chunk is on time, although the whole stream takes longer than the timeout
+        self.assertEqual(''.join(await self.read_all(steady(), 0.05)), 'abcde')
+
+    async def test_fires_when_the_deadline_passes(self):
+        with deadline_scope(0.05), self.assertRaises(DeadlineExceeded):
+            await self.read_all(stream_of('a', 'b', stall_after=1), None)
+
+    async def test_outside_cancellation_is_not_turned_into_a_timeout(self):
+        task = asyncio.create_task(self.read_all(stream_of('a', stall_after=0), 1.0))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+
+
+class RetryTests(SimpleTestCase):
+
+    def setUp(self):
+        self.provider = ModelProvider(id=9002, name='retry', provider='openai', model_name='gpt-4o',
+                                      extra_settings={'retries': 2, 'retry_backoff': 0.0, 'retry_backoff_max': 0.0})
+
+    def attempt_until(self, errors):
+        """An attempt raising ``errors`` one by one, then returning how many attempts it took."""
+        calls = 0
+
+        async def attempt():
+            nonlocal calls
+            calls += 1
+            if calls <= len(errors):
+                raise errors[calls - 1]
+            return calls
+
+        return attempt
+
+    def test_backoff_is_jittered_and_capped(self):
+        policy = RetryPolicy(retries=5, backoff=0.5, backoff_max=2.0)
+        for retry, cap in ((0, 0.5), (1, 1.0), (2, 2.0), (6, 2.0)):
+            for _ in range(20):
+                self.assertTrue(0 <= policy.delay(retry) <= cap)
+
+    def test_retryable_errors(self):
+        self.assertTrue(retryable(ProviderTimeout()))
+        self.assertTrue(retryable(httpx.ConnectError("refused")))
+        self.assertTrue(retryable(StatusError(429)))
+        self.assertTrue(retryable(StatusError(503)))
+        self.assertFalse(retryable(StatusError(400)))
+        self.assertFalse(retryable(ValueError("bad request")))
+        wrapped = RuntimeError("SDK error")
+        wrapped.__cause__ = httpx.ReadTimeout("slow")
+        self.assertTrue(retryable(wrapped))
+
+    async def test_retries_retryable_errors(self):
+        attempt = self.attempt_until([ProviderTimeout("slow"), StatusError(502)])
+        with self.assertLogs('LLMChat.deadlines', 'WARNING'):
+            self.assertEqual(await with_retries(self.provider, attempt), 3)
+
+    async def test_gives_up_after_the_configured_retries(self):
+        attempt = self.attempt_until([httpx.ConnectError("refused")] * 3)
+        with self.assertLogs('LLMChat.deadlines', 'WARNING'), self.assertRaises(httpx.ConnectError):
+            await with_retries(self.provider, attempt)
+
+    async def test_does_not_retry_other_errors(self):
+        attempt = self.attempt_until([StatusError(400)])
+        with self.assertNoLogs('LLMChat.deadlines'), self.assertRaises(StatusError):
+            await with_retries(self.provider, attempt)
+
+    async def test_does_not_retry_without_time_for_another_attempt(self):
+        attempt = self.attempt_until([ProviderTimeout("slow")])
+        with deadline_scope(0.5), self.assertNoLogs('LLMChat.deadlines'), self.assertRaises(ProviderTimeout):
+            await with_retries(self.provider, attempt)
+
+
+def unit(*values):
+    vector = np.asarray(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+class VectorIndexTests(SimpleTestCase):
+
+    def test_search_finds_the_nearest_entry_of_the_namespace(self):
+        index = VectorIndex(dim=2, capacity=4)
+        index.insert(1, unit(1, 0), {'reply': 'east'})
+        index.insert(1, unit(0, 1), {'reply': 'north'})
+        index.insert(2, unit(1, 0.1), {'reply': 'other namespace'})
+
+        similarity, payload = index.search(1, unit(1, 0.2))
+        self.assertEqual(payload, {'reply': 'east'})
+        self.assertAlmostEqual(similarity, float(unit(1, 0.2) @ unit(1, 0)), places=5)
+        self.assertEqual(index.search(3, unit(1, 0)), (0.0, None))
+
+    def test_full_index_overwrites_the_least_recently_used_entry(self):
+        index = VectorIndex(dim=2, capacity=2)
+        index.insert(1, unit(1, 0), {'reply': 'east'})
+        index.insert(1, unit(0, 1), {'reply': 'north'})
+        index.search(1, unit(1, 0))  # east was used last
+        index.insert(1, unit(-1, 0), {'reply': 'west'})
+
+        self.assertEqual(len(index), 2)
+        self.assertEqual(index.search(1, unit(0, 1))[1], {'reply': 'east'})
+        self.assertEqual(index.search(1, unit(-1, 0))[1], {'reply': 'west'})
+
+    def test_saved_index_is_loaded_again(self):
+        with tempfile.TemporaryDirectory() as path:
+            index = VectorIndex(dim=2, capacity=4, path=path)
+            index.insert(1, unit(1, 0), {'reply': 'east'})
+            index.save()
+            index._shard_lock.close()
+
+            reopened = VectorIndex(dim=2, capacity=4, path=path)
+            self.addCleanup(reopened._shard_lock.close)
+            self.assertEqual(reopened.path, index.path)
+            self.assertEqual(reopened.search(1, unit(1, 0))[1], {'reply': 'east'})
+
+
+class SemanticCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.cache = SemanticCache(HashingEmbedder(), VectorIndex(dim=256, capacity=16))
+
+    async def test_lookup_hits_only_at_or_above_the_threshold(self):
+        stored = await self.cache.embed("how do I reset my password")
+        self.cache.store(1, stored, "how do I reset my password", "Use the reset link.")
+        paraphrase = await self.cache.embed("how do I reset my password please")
+        similarity = float(stored @ paraphrase)
+
+        self.assertEqual(await self.cache.lookup(1, paraphrase, similarity - 0.01), "Use the reset link.")
+        self.assertIsNone(await self.cache.lookup(1, paraphrase, similarity + 0.01))
+        self.assertIsNone(await self.cache.lookup(2, stored, 0.5))
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 2)
+
+
+class ClaimShardTests(SimpleTestCase):
+
+    def test_live_processes_get_separate_shards_and_freed_ones_are_reused(self):
+        with tempfile.TemporaryDirectory() as path:
+            first, first_lock = claim_shard(path)
+            second, second_lock = claim_shard(path)
+            self.assertNotEqual(first, second)
+
+            first_lock.close()
+            again, again_lock = claim_shard(path)
+            self.assertEqual(again, first)
+            again_lock.close()
+            second_lock.close()
+
+
+class UsageTests(SimpleTestCase):
+
+    def setUp(self):
+        self.estimator = UsageEstimator(alpha=0.5)
+        patcher = mock.patch('LLMChat.metrics.USAGE_ESTIMATOR', self.estimator)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.provider = ModelProvider(name='usage', provider='openai', model_name='gpt-4o')
+
+    def test_reported_usage_is_used_as_is(self):
+        reported = {'input_tokens': 10, 'output_tokens': 5, 'total_tokens': 15}
+        self.assertEqual(resolve_usage(self.provider, 'p' * 40, 'r' * 20, reported), (reported, False))
+
+    def test_missing_usage_is_estimated_at_four_characters_per_token(self):
+        for reported in (None, {}, {'input_tokens': 0, 'output_tokens': 0, 'total_tokens': 0}):
+            usage, estimated = resolve_usage(self.provider, 'p' * 40, 'r' * 20, reported)
+            self.assertTrue(estimated)
+            self.assertEqual(usage, {'input_tokens': 10, 'output_tokens': 5, 'total_tokens': 15})
+
+    def test_reported_usage_calibrates_later_estimates(self):
+        # This model turns out to use two characters per prompt token and five per completion token
+        resolve_usage(self.provider, 'p' * 40, 'r' * 50, {'input_tokens': 20, 'output_tokens': 10, 'total_tokens': 30})
+        usage, estimated = resolve_usage(self.provider, 'p' * 10, 'r' * 10, None)
+        self.assertTrue(estimated)
+        self.assertEqual(usage, {'input_tokens': 5, 'output_tokens': 2, 'total_tokens': 7})
+
+    def test_calibration_is_a_moving_average_per_model(self):
+        self.estimator.calibrate(self.provider, 'output', 40, 10)  # 4 characters per token
+        self.estimator.calibrate(self.provider, 'output', 80, 10)  # 8, averaged in by alpha=0.5
+        self.assertEqual(self.estimator.estimate(self.provider, 'output', 'r' * 60), 10)
+        other = ModelProvider(name='usage', provider='openai', model_name='gpt-4o-mini')
+        self.assertEqual(self.estimator.estimate(other, 'output', 'r' * 60), 15)
+        self.assertEqual(self.estimator.estimate(self.provider, 'output', ''), 0)
+
+
+def turns_of(count, tokens=10):
+    return [Turn.build(f"question {index}", f"answer {index}", tokens) for index in range(count)]
+
+
+class HistoryCacheTests(SimpleTestCase):
+
+    def loaded(self, cache, conversation_id, turns):
+        cache.begin_load(conversation_id)
+        cache.end_load(conversation_id, turns)
+
+    def test_get_returns_a_copy(self):
+        cache = HistoryCache(max_messages=100)
+        self.assertIsNone(cache.get(1))
+        self.loaded(cache, 1, turns_of(2))
+        cache.get(1).append('not cached')
+        self.assertEqual(len(cache.get(1)), 2)
+
+    def test_append_extends_cached_conversations_only(self):
+        cache = HistoryCache(max_messages=100)
+        self.loaded(cache, 1, turns_of(1))
+        cache.append(1, "next question", "next answer", 7)
+        cache.append(2, "uncached", "conversation", 7)
+
+        turns = cache.get(1)
+        self.assertEqual([turn.user.content for turn in turns], ["question 0", "next question"])
+        self.assertEqual(turns[-1].tokens, 7)
+        self.assertIsNone(cache.get(2))
+
+    def test_evicts_least_recently_used_conversations_by_message_count(self):
+        cache = HistoryCache(max_messages=8)  # two messages per turn
+        self.loaded(cache, 1, turns_of(2))
+        self.loaded(cache, 2, turns_of(2))
+        cache.get(1)  # 2 is now the least recently used
+        self.loaded(cache, 3, turns_of(1))
+
+        self.assertIsNone(cache.get(2))
+        self.assertIsNotNone(cache.get(1))
+        self.assertIsNotNone(cache.get(3))
+
+        cache.append(3, "more", "turns", 1)
+        cache.append(3, "even", "more", 1)  # 10 messages: evicts 1, used before 3
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(len(cache.get(3)), 3)
+
+    def test_append_during_a_load_is_not_lost(self):
+        cache = HistoryCache(max_messages=100)
+        cache.begin_load(1)
+        loaded = turns_of(1)  # read from the database before the new turn was written
+        cache.append(1, "written meanwhile", "answer", 7)
+        cache.end_load(1, loaded)
+
+        # The load is not cached, so the next read sees the new turn in the database
+        self.assertIsNone(cache.get(1))
+
+    def test_discard_during_a_load_keeps_the_stale_load_out(self):
+        cache = HistoryCache(max_messages=100)
+        cache.begin_load(1)
+        cache.discard(1)
+        cache.end_load(1, turns_of(1))
+        self.assertIsNone(cache.get(1))
+
+    def test_discard_forgets_a_conversation_and_its_size(self):
+        cache = HistoryCache(max_messages=4)
+        self.loaded(cache, 1, turns_of(2))
+        cache.discard(1)
+        self.assertIsNone(cache.get(1))
+        self.loaded(cache, 2, turns_of(2))
+        self.assertIsNotNone(cache.get(2))
+        self.assertEqual(len(cache), 1)
+
+    def test_failed_load_caches_nothing(self):
+        cache = HistoryCache(max_messages=100)
+        self.loaded(cache, 1, None)
+        self.assertIsNone(cache.get(1))
+        self.loaded(cache, 1, turns_of(1))
+        self.assertEqual(len(cache.get(1)), 1)
+
+
+class ContextWindowTests(SimpleTestCase):
+
+    def test_keeps_the_newest_turns_that_fit(self):
+        turns = turns_of(5, tokens=10)
+        window = build_context_window(turns, budget=30)
+        self.assertEqual(window.dropped_turns, 2)
+        self.assertEqual(window.history_tokens, 30)
+        self.assertEqual([message.content for message in window.messages[::2]],
+                         ["question 2", "question 3", "question 4"])
+
+    def test_a_turn_just_over_the_budget_is_dropped_with_everything_older(self):
+        turns = [Turn.build("old", "short", 1)] + turns_of(2, tokens=10)
+        window = build_context_window(turns, budget=19)
+        # The small oldest turn would fit, but history must stay contiguous
+        self.assertEqual((window.dropped_turns, window.history_tokens), (2, 10))
+        self.assertEqual(window.messages[0].content, "question 1")
+
+    def test_everything_fits_or_nothing_does(self):
+        turns = turns_of(3, tokens=10)
+        self.assertEqual(build_context_window(turns, budget=30).dropped_turns, 0)
+        empty = build_context_window(turns, budget=9)
+        self.assertEqual((empty.messages, empty.dropped_turns), ([], 3))
+        self.assertEqual(build_context_window([], budget=0).dropped_turns, 0)
+
+    def test_history_budget_reserves_prompt_message_and_completion(self):
+        provider = ModelProvider(model_name='gpt-4', max_tokens=1000)
+        self.assertEqual(context_window_size(provider), 8192)
+        self.assertEqual(history_budget(provider, 's' * 400, 'm' * 40), 8192 - 1000 - 100 - 10)
+        provider.extra_settings = {'context_window': 1000}
+        self.assertEqual(history_budget(provider, 's' * 400, ''), 0)
+
+    def test_longest_model_prefix_wins(self):
+        self.assertEqual(context_window_size(ModelProvider(model_name='gpt-4o-mini')), 128000)
+        self.assertEqual(context_window_size(ModelProvider(model_name='GPT-4-0613')), 8192)
+        self.assertEqual(context_window_size(ModelProvider(model_name='unknown')), 4096)
+
+    def test_estimate_tokens_rounds_up(self):
+        self.assertEqual([estimate_tokens(text) for text in ('', 'a', 'abcd', 'abcde')], [0, 1, 1, 2])
+
+
+class PrepareMessagesTests(SimpleTestCase):
+    """The dropped turn count the WebSocket consumer and the HTTP view report."""
+
+    async def prepare(self, turns, conversation, max_tokens=100):
+        provider = ModelProvider(id=9004, name='context', provider='openai', model_name='small',
+                                 max_tokens=max_tokens, extra_settings={'context_window': 200})
+        service = ChatService(provider, cache_history=False)
+        with mock.patch('LLMChat.services.get_conversation', mock.AsyncMock(return_value=conversation)), \
+                mock.patch.object(ChatService, '_load_turns', mock.AsyncMock(return_value=turns)), \
+                mock.patch('LLMChat.context.logger'):
+            messages, _ = await service.prepare_messages("next?", conversation.id)
+        return service, messages
+
+    async def test_dropped_turns_are_counted(self):
+        # 200 - 100 completion - 2 for the message leaves 98 tokens: four 20 token turns
+        service, messages = await self.prepare(turns_of(6, tokens=20), Conversation(id=1))
+        self.assertEqual(service.dropped_turns, 2)
+        self.assertEqual(len(messages), 4 * 2 + 1)
+        self.assertEqual(messages[0].content, "question 2")
+
+    async def test_summarized_turns_are_not_counted_as_dropped(self):
+        conversation = Conversation(id=1, summary='s' * 80, summarized_turns=3)
+        service, messages = await self.prepare(turns_of(6, tokens=20), conversation)
+        # The summary takes 20 tokens, leaving room for three of the three unsummarized turns
+        self.assertEqual(service.dropped_turns, 0)
+        self.assertEqual(messages[0].type, 'system')
+        self.assertEqual(messages[1].content, "question 3")
+
+    async def test_the_summary_counts_against_the_budget(self):
+        conversation = Conversation(id=1, summary='s' * 160, summarized_turns=1)
+        service, _ = await self.prepare(turns_of(6, tokens=20), conversation)
+        # 98 - 40 summary tokens leaves two of the five unsummarized turns
+        self.assertEqual(service.dropped_turns, 3)
+
+
+class ResponseCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch('LLMChat.response_cache.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_only_deterministic_providers_are_cacheable_unless_configured(self):
+        self.assertTrue(is_cacheable(ModelProvider(temperature=0)))
+        self.assertFalse(is_cacheable(ModelProvider(temperature=0.7)))
+        self.assertTrue(is_cacheable(ModelProvider(temperature=0.7, extra_settings={'response_cache': True})))
+        self.assertFalse(is_cacheable(ModelProvider(temperature=0, extra_settings={'response_cache': False})))
+
+    def test_key_ignores_whitespace_but_not_roles_or_the_provider(self):
+        key = response_cache_key('fp', [HumanMessage(content="Hello   there\n")])
+        self.assertEqual(key, response_cache_key('fp', [HumanMessage(content=" Hello there")]))
+        self.assertNotEqual(key, response_cache_key('other', [HumanMessage(content="Hello there")]))
+        self.assertNotEqual(key, response_cache_key('fp', [SystemMessage(content="Hello there")]))
+
+    async def test_local_entries_expire_after_the_ttl(self):
+        backend = LocalResponseCacheBackend(max_entries=10, ttl=60)
+        await backend.set('key', {'reply': 'hi'})
+        self.clock.now += 60
+        self.assertEqual(await backend.get('key'), {'reply': 'hi'})
+        self.clock.now += 1
+        self.assertIsNone(await backend.get('key'))
+
+    async def test_local_backend_evicts_the_least_recently_used_entry(self):
+        backend = LocalResponseCacheBackend(max_entries=2, ttl=60)
+        await backend.set('a', {'reply': 'a'})
+        await backend.set('b', {'reply': 'b'})
+        await backend.get('a')
+        await backend.set('c', {'reply': 'c'})
+        self.assertIsNone(await backend.get('b'))
+        self.assertEqual(await backend.get('a'), {'reply': 'a'})
+        self.assertEqual(await backend.get('c'), {'reply': 'c'})
+
+    async def test_django_backend_stores_with_the_ttl(self):
+        caches['default'].clear()
+        self.addCleanup(caches['default'].clear)
+        backend = DjangoResponseCacheBackend(alias='default', ttl=60)
+        now = time.time()
+        with mock.patch('time.time', return_value=now):
+            await backend.set('key', {'reply': 'hi'})
+            self.assertEqual(await backend.get('key'), {'reply': 'hi'})
+        with mock.patch('time.time', return_value=now + 61):
+            self.assertIsNone(await backend.get('key'))
+
+    async def test_counts_hits_and_misses_and_survives_backend_errors(self):
+        cache = ResponseCache(LocalResponseCacheBackend(max_entries=10, ttl=60))
+        await cache.set('key', {'reply': 'hi'})
+        await cache.get('key')
+        await cache.get('missing')
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'hit_ratio': 0.5})
+
+        broken = mock.Mock(get=mock.AsyncMock(side_effect=OSError("down")), set=mock.AsyncMock(side_effect=OSError("down")))
+        cache = ResponseCache(broken)
+        with self.assertLogs('LLMChat.response_cache', 'ERROR'):
+            self.assertIsNone(await cache.get('key'))
+            await cache.set('key', {'reply': 'hi'})
+
+
+def stream_config(**extra):
+    return {'model_name': 'model', 'temperature': 0.0, 'max_tokens': 16, 'top_p': 1.0, 'api_key': 'key',
+            'extra_settings': {'api_base': 'https://llm.test/v1', **extra}}
+
+
+class NativeStreamTests(SimpleTestCase):
+
+    def serve(self, body, status=200):
+        """An HTTP client whose every request gets ``body`` as an event stream."""
+        self.requests = []
+
+        def handler(request):
+            self.requests.append(request)
+            return httpx.Response(status, content=body.encode(), headers={'Content-Type': 'text/event-stream'})
+
+        return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    async def events(self, body):
+        async with self.serve(body).stream('GET', 'https://llm.test/events') as response:
+            return [event async for event in sse_events(response)]
+
+    async def test_sse_events_join_multi_line_data_and_skip_comments(self):
+        body = (": keep-alive\n\n"
+                "event: greeting\ndata: first line\ndata:second line\nid: 7\n\n"
+                "data: {\"a\": 1}\r\n\r\n"
+                "data: unterminated")
+        self.assertEqual(await self.events(body), [
+            ('greeting', "first line\nsecond line"),
+            (None, '{"a": 1}'),
+            (None, "unterminated"),
+        ])
+
+    async def test_openai_deltas_stop_at_done_and_read_usage(self):
+        frames = [
+            {'choices': [{'delta': {'role': 'assistant'}}]},
+            {'choices': [{'delta': {'content': 'Hel'}}]},
+            {'choices': [{'delta': {'content': 'lo'}}]},
+            {'choices': [], 'usage': {'prompt_tokens': 5, 'completion_tokens': 2, 'total_tokens': 7}},
+        ]
+        body = "".join(f"data: {json.dumps(frame)}\n\n" for frame in frames)
+        body += ": ping\n\ndata: [DONE]\n\ndata: {\"choices\": [{\"delta\": {\"content\": \"late\"}}]}\n\n"
+        client = OpenAIStreamClient(stream_config(), http=self.serve(body))
+
+        deltas = [delta async for delta in client.astream([HumanMessage(content="Hi")])]
+        self.assertEqual(deltas, [
+            StreamDelta('Hel'), StreamDelta('lo'),
+            StreamDelta('', {'input_tokens': 5, 'output_tokens': 2, 'total_tokens': 7}),
+        ])
+        request = self.requests[0]
+        self.assertEqual(str(request.url), 'https://llm.test/v1/chat/completions')
+        self.assertEqual(request.headers['Authorization'], 'Bearer key')
+        self.assertEqual(json.loads(request.content)['stream_options'], {'include_usage': True})
+
+    async def test_openai_stream_usage_can_be_turned_off(self):
+        client = OpenAIStreamClient(stream_config(stream_usage=False), http=self.serve("data: [DONE]\n\n"))
+        self.assertEqual([delta async for delta in client.astream([HumanMessage(content="Hi")])], [])
+        self.assertNotIn('stream_options', json.loads(self.requests[0].content))
+
+    async def test_openai_error_frames_and_statuses_raise(self):
+        client = OpenAIStreamClient(stream_config(), http=self.serve('data: {"error": {"message": "overloaded"}}\n\n'))
+        with self.assertRaises(ValueError):
+            [delta async for delta in client.astream([HumanMessage(content="Hi")])]
+
+        client = OpenAIStreamClient(stream_config(), http=self.serve('{"error": "rate limited"}', status=429))
+        with self.assertRaises(httpx.HTTPStatusError) as raised:
+            [delta async for delta in client.astream([HumanMessage(content="Hi")])]
+        self.assertEqual(raised.exception.response.status_code, 429)
+
+    async def test_anthropic_deltas_skip_pings_and_end_with_usage(self):
+        frames = [
+            ('message_start', {'type': 'message_start', 'message': {'usage': {'input_tokens': 9, 'output_tokens': 1}}}),
+            ('ping', {'type': 'ping'}),
+            ('content_block_delta', {'type': 'content_block_delta', 'delta': {'type': 'text_delta', 'text': 'Hi'}}),
+            ('content_block_delta', {'type': 'content_block_delta', 'delta': {'type': 'text_delta', 'text': '!'}}),
+            ('message_delta', {'type': 'message_delta', 'usage': {'output_tokens': 3}}),
+            ('message_stop', {'type': 'message_stop'}),
+        ]
+        body = "".join(f"event: {event}\ndata: {json.dumps(frame)}\n\n" for event, frame in frames)
+        client = AnthropicStreamClient(stream_config(), http=self.serve(body))
+
+        messages = [SystemMessage(content="Be brief."), HumanMessage(content="Hello")]
+        deltas = [delta async for delta in client.astream(messages)]
+        self.assertEqual(deltas, [
+            StreamDelta('Hi'), StreamDelta('!'),
+            StreamDelta('', {'input_tokens': 9, 'output_tokens': 3, 'total_tokens': 12}),
+        ])
+        body = json.loads(self.requests[0].content)
+        self.assertEqual(body['system'], "Be brief.")
+        self.assertEqual(body['messages'], [{'role': 'user', 'content': "Hello"}])
+
+    async def test_anthropic_error_event_raises(self):
+        body = 'event: error\ndata: {"type": "error", "error": {"type": "overloaded_error"}}\n\n'
+        client = AnthropicStreamClient(stream_config(), http=self.serve(body))
+        with self.assertRaises(ValueError):
+            [delta async for delta in client.astream([HumanMessage(content="Hi")])]
+
+
+class FakeConnections:
+    """Stand-in for httpx's transports: each one "connects" on its first request only."""
+
+    def __init__(self):
+        self.transports = []
+
+    def transport(self, **kwargs):
+        connected = False
+
+        def events(request):
+            nonlocal connected
+            if connected:
+                return []
+            connected = True
+            return ['connection.connect_tcp.complete'] + (
+                ['connection.start_tls.complete'] if request.url.scheme == 'https' else [])
+
+        def handler(request):
+            for name in events(request):
+                request.extensions['trace'](name, {})
+            return httpx.Response(200, json={'ok': True})
+
+        async def async_handler(request):
+            for name in events(request):
+                await request.extensions['trace'](name, {})
+            return httpx.Response(200, json={'ok': True})
+
+        transport = httpx.MockTransport(handler)
+        transport.async_transport = httpx.MockTransport(async_handler)
+        self.transports.append(transport)
+        return transport
+
+    def async_transport(self, **kwargs):
+        return self.transport(**kwargs).async_transport
+
+
+class HTTPPoolManagerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.connections = FakeConnections()
+        for patcher in (mock.patch('LLMChat.http_pool.httpx.HTTPTransport', self.connections.transport),
+                        mock.patch('LLMChat.http_pool.httpx.AsyncHTTPTransport', self.connections.async_transport)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.pools = HTTPPoolManager(http2=False, connect_timeout=5.0)
+
+    def test_clients_share_one_transport_per_origin(self):
+        first, second = self.pools.client(), self.pools.client()
+        first.get('https://api.test/a')
+        second.get('https://api.test:443/b')
+        second.get('http://api.test/c')
+        first.get('https://api.test:8443/d')
+        self.assertEqual(len(self.connections.transports), 3)
+
+    def test_reuse_ratio_counts_requests_on_kept_alive_connections(self):
+        client = self.pools.client()
+        for _ in range(4):
+            client.get('https://api.test/')
+        client.get('http://other.test/')
+
+        stats = self.pools.stats()
+        self.assertEqual({key: stats['api.test'][key] for key in ('requests', 'reused', 'connections', 'tls_handshakes')},
+                         {'requests': 4, 'reused': 3, 'connections': 1, 'tls_handshakes': 1})
+        self.assertEqual(stats['api.test']['reuse_ratio'], 0.75)
+        self.assertEqual((stats['other.test']['reuse_ratio'], stats['other.test']['tls_handshakes']), (0.0, 0))
+
+    def test_reuse_ratio_is_none_before_any_request(self):
+        self.assertIsNone(HostStats().snapshot()['reuse_ratio'])
+
+    def test_async_transports_are_kept_per_event_loop(self):
+        async def requests():
+            client = self.pools.async_client()
+            await client.get('https://api.test/')
+            await client.get('https://api.test/')
+            return self.pools.async_transport(httpx.URL('https://api.test/'))
+
+        first_loop = asyncio.run(requests())
+        second_loop = asyncio.run(requests())
+        self.assertIsNot(first_loop, second_loop)
+        # Each loop opened its own connection and then reused it
+        stats = self.pools.stats()['api.test']
+        self.assertEqual((stats['requests'], stats['connections'], stats['reused']), (4, 2, 2))
+
+    def test_connect_timeout_is_capped_and_caller_trace_still_called(self):
+        self.assertEqual(self.pools.timeouts({'connect': 30.0, 'read': 60.0}), {'connect': 5.0, 'read': 60.0})
+        self.assertEqual(self.pools.timeouts({'connect': 1.0}), {'connect': 1.0})
+        self.assertEqual(self.pools.timeouts(None), {'connect': 5.0})
+
+        seen = []
+        self.pools.client().get('https://api.test/', extensions={'trace': lambda name, info: seen.append(name)})
+        self.assertIn('connection.start_tls.complete', seen)
+
+
+class RecordingBackend(FakeBatchBackend):
+    """FakeBatchBackend without delays that records admitted prompts and can fail a decode step."""
+
+    def __init__(self, n_ctx=4096, step_seconds=0.0):
+        super().__init__(step_seconds, 0.0, 0.0, n_ctx=n_ctx)
+        self.encoded = []
+        self.released = []
+        self.restored = []
+        self.fail_steps = 0
+
+    def encode(self, messages):
+        self.encoded.append(messages[-1]['content'])
+        return super().encode(messages)
+
+    def step(self, generations):
+        if self.fail_steps:
+            self.fail_steps -= 1
+            raise RuntimeError("decode failed")
+        return super().step(generations)
+
+    def release(self, slot):
+        self.released.append(slot)
+        super().release(slot)
+
+    def restore(self, slot, state, tokens):
+        self.restored.append(tokens)
+        return super().restore(slot, state, tokens)
+
+
+def prompt(text):
+    return [{'role': 'user', 'content': text}]
+
+
+async def collect(generation):
+    return [piece async for piece in generation]
+
+
+async def settled(scheduler):
+    """Wait until the scheduler has no active or waiting requests."""
+    for _ in range(500):
+        stats = scheduler.stats()
+        if not stats['active'] and not stats['waiting']:
+            return stats
+        await asyncio.sleep(0.002)
+    raise AssertionError("scheduler did not settle")
+
+
+class BatchSchedulerTests(SimpleTestCase):
+
+    def scheduler(self, max_batch=2, states=None, **kwargs):
+        """A scheduler whose worker only starts once ``self.started`` is set, so requests queue up first."""
+        self.backend = RecordingBackend(**kwargs)
+        self.started = threading.Event()
+        return BatchScheduler(lambda: self.started.wait(5) and self.backend, max_batch, name='test', states=states)
+
+    async def test_requests_are_admitted_in_order_up_to_max_batch(self):
+        scheduler = self.scheduler(max_batch=2)
+        generations = [scheduler.submit(prompt(text), max_tokens=5) for text in ('one', 'two', 'three')]
+        self.started.set()
+        results = await asyncio.gather(*(collect(generation) for generation in generations))
+
+        self.assertEqual(self.backend.encoded, ['one', 'two', 'three'])
+        self.assertEqual([len(pieces) for pieces in results], [5, 5, 5])
+        self.assertLessEqual(scheduler.stats()['max_active'], 2)
+
+    async def test_max_tokens_limits_the_reply_and_usage_is_exact(self):
+        scheduler = self.scheduler()
+        generation = scheduler.submit(prompt('three word prompt'), max_tokens=4)
+        self.started.set()
+        self.assertEqual(len(await collect(generation)), 4)
+        self.assertEqual((generation.input_tokens, generation.output_tokens), (3, 4))
+
+    async def test_max_tokens_is_trimmed_to_the_context_size(self):
+        scheduler = self.scheduler(n_ctx=8)
+        generation = scheduler.submit(prompt('a five word long prompt'), max_tokens=100)
+        self.started.set()
+        self.assertEqual(len(await collect(generation)), 3)
+
+    async def test_prompt_longer_than_the_context_fails_the_request_only(self):
+        scheduler = self.scheduler(n_ctx=4)
+        too_long = scheduler.submit(prompt('this prompt has too many words'), max_tokens=2)
+        fits = scheduler.submit(prompt('short'), max_tokens=2)
+        self.started.set()
+        with self.assertRaisesMessage(ValueError, 'does not fit the context'):
+            await collect(too_long)
+        self.assertEqual(len(await collect(fits)), 2)
+
+    async def test_leaving_the_iteration_cancels_and_frees_the_slot(self):
+        scheduler = self.scheduler(max_batch=1, step_seconds=0.001)
+        pieces = scheduler.submit(prompt('long'), max_tokens=10000).__aiter__()
+        self.started.set()
+        await pieces.__anext__()
+        await pieces.aclose()
+
+        stats = await settled(scheduler)
+        self.assertLess(stats['generated_tokens'], 10000)
+        self.assertEqual(self.backend.released, [0])
+
+    async def test_request_cancelled_while_waiting_is_never_admitted(self):
+        scheduler = self.scheduler(max_batch=1, step_seconds=0.001)
+        running = scheduler.submit(prompt('first'), max_tokens=20)
+        scheduler.submit(prompt('cancelled'), max_tokens=20).cancelled.set()
+        after = scheduler.submit(prompt('third'), max_tokens=20)
+        self.started.set()
+        await asyncio.gather(collect(running), collect(after))
+        self.assertEqual(self.backend.encoded, ['first', 'third'])
+
+    async def test_decode_error_fails_the_whole_step_and_the_scheduler_recovers(self):
+        scheduler = self.scheduler(max_batch=2)
+        self.backend.fail_steps = 1
+        generations = [scheduler.submit(prompt(text), max_tokens=3) for text in ('one', 'two')]
+        self.started.set()
+        for generation in generations:
+            with self.assertRaisesMessage(RuntimeError, 'decode failed'):
+                await collect(generation)
+        await settled(scheduler)
+        self.assertEqual(len(await collect(scheduler.submit(prompt('again'), max_tokens=3))), 3)
+
+    async def test_next_turn_restores_the_saved_prompt_state(self):
+        states = PromptStateCache(2 ** 20)
+        scheduler = self.scheduler(states=states)
+        self.started.set()
+        await collect(scheduler.submit(prompt('a b c'), max_tokens=2, state_key=('model', 1)))
+
+        # The prompt and the first reply token fed back were evaluated (fake tokens are word lengths)
+        saved = states.get(('model', 1))
+        self.assertEqual(saved.tokens, (1, 1, 1, 4))
+        self.assertEqual(len(saved.data), 4)
+
+        generation = scheduler.submit(prompt('a b c dddddd ee'), max_tokens=2, state_key=('model', 1))
+        await collect(generation)
+        self.assertEqual(self.backend.restored, [3])
+        self.assertEqual((generation.input_tokens, generation.reused_tokens), (5, 3))
+        self.assertEqual(scheduler.stats()['reused_prompt_tokens'], 3)
+        self.assertEqual(states.get(('model', 1)).tokens, (1, 1, 1, 6, 2, 6))
+
+    async def test_state_is_not_restored_for_another_conversation(self):
+        states = PromptStateCache(2 ** 20)
+        scheduler = self.scheduler(states=states)
+        self.started.set()
+        await collect(scheduler.submit(prompt('a b c'), max_tokens=2, state_key=('model', 1)))
+        generation = scheduler.submit(prompt('a b c d'), max_tokens=2, state_key=('model', 2))
+        await collect(generation)
+        self.assertEqual((self.backend.restored, generation.reused_tokens), ([], 0))
+
+    async def test_no_state_is_saved_for_shared_or_failed_generations(self):
+        states = PromptStateCache(2 ** 20)
+        scheduler = self.scheduler(states=states)
+        self.started.set()
+        await collect(scheduler.submit(prompt('a b c'), max_tokens=2, state_key=('model', 1), keep_state=False))
+        self.backend.fail_steps = 1
+        with self.assertRaises(RuntimeError):
+            await collect(scheduler.submit(prompt('a b c'), max_tokens=2, state_key=('model', 2)))
+        self.assertIsNone(states.get(('model', 1)))
+        self.assertIsNone(states.get(('model', 2)))
+
+    def test_conversation_scope_marks_shared_generations(self):
+        self.assertFalse(shared_generation())
+        with conversation_scope(7, shared=True):
+            self.assertTrue(shared_generation())
+            with conversation_scope(8):
+                self.assertFalse(shared_generation())
+            self.assertTrue(shared_generation())
+        self.assertFalse(shared_generation())
+
+
+def prompt_state(count, size=100):
+    return PromptState(tuple(range(count)), bytes(size))
+
+
+class PromptStateCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def files(self):
+        return sorted(os.listdir(self.directory))
+
+    def test_state_round_trips_through_its_file_format(self):
+        state = prompt_state(3, 10)
+        self.assertEqual(PromptState.loads(state.dumps()), state)
+        with self.assertRaises(ValueError):
+            PromptState.loads(b'NOTKV' + state.dumps()[5:])
+
+    def test_without_a_directory_evicted_states_are_dropped(self):
+        cache = PromptStateCache(150)
+        cache.put(('m', 1), prompt_state(3))
+        cache.put(('m', 2), prompt_state(3))
+        self.assertIsNone(cache.get(('m', 1)))
+        self.assertEqual(cache.get(('m', 2)), prompt_state(3))
+        self.assertEqual({key: cache.stats()[key] for key in ('entries', 'bytes', 'hits', 'misses')},
+                         {'entries': 1, 'bytes': 112, 'hits': 1, 'misses': 1})
+
+    def test_evicted_state_is_spilled_and_read_back(self):
+        cache = PromptStateCache(150, self.directory, 2 ** 20)
+        cache.put(('m', 1), prompt_state(3))
+        cache.put(('m', 2), prompt_state(4))
+        cache.flush()
+        self.assertEqual(len(self.files()), 1)
+
+        # Reading it back brings it into memory again, spilling the other one
+        self.assertEqual(cache.get(('m', 1)), prompt_state(3))
+        cache.flush()
+        self.assertEqual(cache.get(('m', 2)), prompt_state(4))
+        self.assertEqual({key: cache.stats()[key] for key in ('disk_hits', 'spills')}, {'disk_hits': 2, 'spills': 3})
+
+    def test_newer_state_replaces_the_spilled_file(self):
+        cache = PromptStateCache(150, self.directory, 2 ** 20)
+        cache.put(('m', 1), prompt_state(3))
+        cache.put(('m', 2), prompt_state(3))
+        cache.flush()
+        cache.put(('m', 1), prompt_state(5))
+        cache.flush()
+        # The stale file of conversation 1 is gone; conversation 2 was spilled in its place
+        self.assertEqual(len(self.files()), 1)
+        self.assertEqual(cache.get(('m', 1)), prompt_state(5))
+
+    def test_directory_is_pruned_to_its_budget_by_last_use(self):
+        # Each file holds 121 bytes: room for two
+        cache = PromptStateCache(150, self.directory, 250)
+        for conversation in range(1, 5):
+            cache.put(('m', conversation), prompt_state(3))
+            cache.flush()
+            for name in self.files():
+                # Spilled in conversation order; make the order visible to the pruning
+                spilled = int(name.split('-')[0])
+                os.utime(os.path.join(self.directory, name), (1000 + spilled, 1000 + spilled))
+
+        self.assertEqual([name.split('-')[0] for name in self.files()], ['2', '3'])
+        self.assertIsNone(cache.get(('m', 1)))
+        self.assertEqual(cache.get(('m', 2)), prompt_state(3))
+
+    def test_discarded_conversation_is_removed_from_memory_and_disk(self):
+        cache = PromptStateCache(150, self.directory, 2 ** 20)
+        cache.put(('m', 1), prompt_state(3))
+        cache.put(('other', 2), prompt_state(3))
+        cache.put(('m', 2), prompt_state(3))
+        cache.discard_conversation(2)
+        cache.flush()
+        self.assertEqual([name.split('-')[0] for name in self.files()], ['1'])
+        self.assertIsNone(cache.get(('m', 2)))
+        self.assertIsNone(cache.get(('other', 2)))
+
+
+class FakeSummaryModel:
+    """Chat model stand-in that answers every call with ``reply`` (or raises it)."""
+
+    def __init__(self, reply='The user asked questions.'):
+        self.reply = reply
+        self.calls = []
+
+    async def ainvoke(self, messages):
+        self.calls.append(messages)
+        if isinstance(self.reply, BaseException):
+            raise self.reply
+        return AIMessage(content=self.reply)
+
+
+class SummarizerTests(TransactionTestCase):
+    """Summaries are saved from the database threads, so rows must be committed to be seen."""
+
+    def setUp(self):
+        self.provider = make_provider(extra_settings={'summary_keep_turns': 2, 'summary_batch_turns': 3})
+        self.conversation = Conversation.objects.create()
+        self.summarizer = ConversationSummarizer()
+        self.llm = FakeSummaryModel()
+
+    async def compact(self, turns, llm=None):
+        """Schedule a compaction of ``turns`` and wait for it; returns whether one was started."""
+        scheduled = self.summarizer.maybe_schedule(llm or self.llm, self.provider, self.conversation, turns)
+        await asyncio.gather(*self.summarizer._tasks)
+        await self.conversation.arefresh_from_db()
+        return scheduled
+
+    async def test_compacts_only_once_a_batch_of_old_turns_piled_up(self):
+        # Two turns are kept verbatim, so four turns leave only two to summarize
+        self.assertFalse(await self.compact(turns_of(4)))
+        self.assertTrue(await self.compact(turns_of(5)))
+        self.assertEqual((self.conversation.summary, self.conversation.summarized_turns),
+                         ('The user asked questions.', 3))
+        self.assertIn('question 2', self.llm.calls[0][1].content)
+        self.assertNotIn('question 3', self.llm.calls[0][1].content)
+
+        # The next compaction only sends the turns added since
+        self.assertFalse(await self.compact(turns_of(7)))
+        self.assertTrue(await self.compact(turns_of(8)))
+        self.assertEqual(self.conversation.summarized_turns, 6)
+        self.assertIn('Existing summary:\nThe user asked questions.', self.llm.calls[1][1].content)
+        self.assertNotIn('question 2', self.llm.calls[1][1].content)
+
+    async def test_disabled_without_keep_turns(self):
+        self.provider.extra_settings = {}
+        self.assertFalse(await self.compact(turns_of(50)))
+
+    async def test_one_compaction_per_conversation_at_a_time(self):
+        turns = turns_of(5)
+        self.assertTrue(self.summarizer.maybe_schedule(self.llm, self.provider, self.conversation, turns))
+        self.assertFalse(self.summarizer.maybe_schedule(self.llm, self.provider, self.conversation, turns))
+        await asyncio.gather(*self.summarizer._tasks)
+        self.assertEqual(len(self.llm.calls), 1)
+
+    async def test_summary_is_not_saved_if_another_compaction_got_there_first(self):
+        self.summarizer.maybe_schedule(self.llm, self.provider, self.conversation, turns_of(5))
+        await Conversation.objects.filter(id=self.conversation.id).aupdate(summary='other', summarized_turns=4)
+        await asyncio.gather(*self.summarizer._tasks)
+        await self.conversation.arefresh_from_db()
+        self.assertEqual((self.conversation.summary, self.conversation.summarized_turns), ('other', 4))
+
+    async def test_empty_summary_is_not_saved(self):
+        self.assertTrue(await self.compact(turns_of(5), FakeSummaryModel('  ')))
+        self.assertEqual((self.conversation.summary, self.conversation.summarized_turns), ('', 0))
+
+    async def test_open_circuit_skips_the_call(self):
+        breaker = mock.Mock(allow=mock.Mock(return_value=False))
+        with mock.patch.object(BREAKERS, 'get', return_value=breaker):
+            await self.compact(turns_of(5))
+        self.assertEqual(self.llm.calls, [])
+        self.assertEqual(self.conversation.summarized_turns, 0)
+
+    async def test_failed_call_is_recorded_by_the_breaker(self):
+        breaker = mock.Mock(allow=mock.Mock(return_value=True))
+        with mock.patch.object(BREAKERS, 'get', return_value=breaker), \
+                mock.patch('LLMChat.summarizer.logger'):
+            await self.compact(turns_of(5), FakeSummaryModel(ValueError('bad request')))
+        breaker.record_failure.assert_called_once()
+        breaker.release_probe.assert_called_once()
+        self.assertEqual(self.conversation.summarized_turns, 0)
+
+    async def test_runs_under_its_own_deadline_not_the_requests(self):
+        with deadline_scope(0.001):
+            await asyncio.sleep(0.01)
+            self.assertTrue(self.summarizer.maybe_schedule(self.llm, self.provider, self.conversation, turns_of(5)))
+        await asyncio.gather(*self.summarizer._tasks)
+        await self.conversation.arefresh_from_db()
+        self.assertEqual(self.conversation.summarized_turns, 3)
+
+
+class TTSGroupTests(SimpleTestCase):
+
+    def test_only_sessions_handed_out_name_a_group(self):
+        session = new_tts_session()
+        self.assertEqual(tts_group(session), f"tts_{session}")
+        for bad in (None, '', 'audio_group', session.upper(), session + '0', {'session': session}):
+            self.assertIsNone(tts_group(bad))
+
+    async def test_reply_is_spoken_only_by_the_clients_tts_socket(self):
+        consumer = ChatConsumer()
+        consumer.send = mock.AsyncMock()
+        layer = mock.Mock(group_send=mock.AsyncMock())
+        group = tts_group(new_tts_session())
+
+        async def chunks():
+            for chunk in ('Hello there.', ' More', ' text'):
+                yield chunk
+
+        with mock.patch('LLMChat.consumers.get_channel_layer', return_value=layer):
+            await consumer.stream_reply(chunks(), group)
+            await consumer.stream_reply(chunks(), None)
+
+        self.assertEqual([call.args[0] for call in layer.group_send.call_args_list], [group, group])
+        self.assertEqual([call.args[1]['text'] for call in layer.group_send.call_args_list],
+                         ['Hello there.', ' More text'])
+        self.assertEqual(consumer.send.await_count, 6)
+
+
+class ListExporter:
+
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+
+class TracingTests(SimpleTestCase):
+
+    def setUp(self):
+        self.exporter = ListExporter()
+        self.tracer = Tracer(self.exporter)
+
+    def test_spans_nest_under_the_current_span(self):
+        with self.tracer.span('request') as request:
+            with self.tracer.span('child') as child:
+                grandchild = self.tracer.span('grandchild')
+                grandchild.end()
+            self.assertIs(current_span(), request)
+        self.assertIsNone(current_span())
+
+        self.assertEqual(len({request.trace_id, child.trace_id, grandchild.trace_id}), 1)
+        self.assertEqual((request.parent_id, child.parent_id, grandchild.parent_id),
+                         (None, request.span_id, child.span_id))
+        self.assertEqual([span['name'] for span in self.exporter.spans], ['grandchild', 'child', 'request'])
+
+    def test_activate_parents_spans_without_ending(self):
+        span = self.tracer.span('stream')
+        with span.activate():
+            child = self.tracer.span('first_chunk')
+        self.assertEqual(child.parent_id, span.span_id)
+        self.assertIsNone(span.duration)
+
+    def test_given_trace_id_continues_a_trace_from_elsewhere(self):
+        with self.tracer.span('unrelated'):
+            span = self.tracer.span('tts.text', trace_id='a' * 32, parent_id='b' * 16)
+        self.assertEqual((span.trace_id, span.parent_id), ('a' * 32, 'b' * 16))
+
+    def test_error_is_recorded_and_span_ends_once(self):
+        with self.assertRaises(ValueError):
+            with self.tracer.span('call'):
+                raise ValueError("boom")
+        self.assertEqual((self.exporter.spans[0]['status'], self.exporter.spans[0]['attributes']['error']),
+                         ('error', 'ValueError: boom'))
+
+        span = self.tracer.span('once')
+        span.end()
+        span.end(ValueError("late"))
+        self.assertEqual([s['status'] for s in self.exporter.spans[1:]], ['ok'])
+
+    def test_server_timing_sums_collected_spans_by_name(self):
+        with self.tracer.span('http.request', collect=True) as request:
+            for duration in (0.010, 0.020):
+                with self.tracer.span('llm.invoke') as child:
+                    pass
+                child.duration = duration
+            with self.tracer.span('chat.history') as child:
+                pass
+            child.duration = 0.0055
+        request.duration = 0.05
+        self.assertEqual(server_timing(request), 'total;dur=50.0, llm.invoke;dur=30.0, chat.history;dur=5.5')
+
+    def test_spans_outside_a_collecting_trace_are_not_collected(self):
+        with self.tracer.span('ws.receive') as span:
+            self.tracer.span('child').end()
+        self.assertIsNone(span.collected)
+        self.assertEqual(server_timing(span).count(';dur='), 1)
+
+
+class TracingMiddlewareTests(SimpleTestCase):
+
+    def view(self, request):
+        self.request_span = current_span()
+        with TRACER.span('chat.prepare_messages'):
+            pass
+        return HttpResponse('ok')
+
+    def get(self, **headers):
+        return TracingMiddleware(self.view)(RequestFactory().get('/api/llm/chat/', headers=headers))
+
+    def test_traceparent_continues_the_callers_trace(self):
+        trace_id, parent_id = '4bf92f3577b34da6a3ce929d0e0e4736', '00f067aa0ba902b7'
+        response = self.get(traceparent=f"00-{trace_id}-{parent_id}-01")
+        self.assertEqual(response['X-Trace-Id'], trace_id)
+        self.assertEqual((self.request_span.trace_id, self.request_span.parent_id), (trace_id, parent_id))
+
+    def test_malformed_traceparent_starts_a_new_trace(self):
+        for header in ('00-XYZ-00f067aa0ba902b7-01', '00-4bf92f3577b34da6a3ce929d0e0e4736-01', 'garbage'):
+            response = self.get(traceparent=header)
+            self.assertRegex(response['X-Trace-Id'], r'^[0-9a-f]{32}$')
+            self.assertIsNone(self.request_span.parent_id)
+
+    def test_server_timing_reports_total_and_stages(self):
+        response = self.get()
+        self.assertRegex(response['Server-Timing'],
+                         r'^total;dur=\d+\.\d, chat\.prepare_messages;dur=\d+\.\d$')
+
+    async def test_async_requests_are_traced_too(self):
+        async def view(request):
+            with TRACER.span('llm.invoke'):
+                pass
+            return HttpResponse('ok')
+
+        middleware = TracingMiddleware(view)
+        response = await middleware(RequestFactory().get('/api/llm/chat/'))
+        self.assertIn('llm.invoke;dur=', response['Server-Timing'])
+
+
+def snapshot_of(**families):
+    return {'pid': 1, 'started': 1, 'families': families}
+
+
+def counter(value, **labels):
+    return {'type': 'counter', 'help': 'Calls.', 'aggregate': 'sum', 'samples': [[labels, value]]}
+
+
+class MergeSnapshotsTests(SimpleTestCase):
+
+    def test_counters_add_up_per_label_set(self):
+        merged = merge_snapshots([
+            snapshot_of(calls=counter(2, view='a')),
+            snapshot_of(calls=counter(3, view='a')),
+            snapshot_of(calls=counter(5, view='b')),
+        ])
+        self.assertEqual(merged['calls']['samples'], {(('view', 'a'),): 5, (('view', 'b'),): 5})
+
+    def test_histograms_add_up_bucket_by_bucket(self):
+        def histogram(buckets, total, count):
+            return {'type': 'histogram', 'help': 'Latency.', 'aggregate': 'sum',
+                    'samples': [[{}, {'buckets': buckets, 'sum': total, 'count': count}]]}
+
+        merged = merge_snapshots([
+            snapshot_of(latency=histogram([['0.1', 1], ['+Inf', 2]], 0.5, 2)),
+            snapshot_of(latency=histogram([['0.1', 3], ['+Inf', 3]], 0.2, 3)),
+        ])
+        self.assertEqual(merged['latency']['samples'][()],
+                         {'buckets': [['0.1', 4], ['+Inf', 5]], 'sum': 0.7, 'count': 5})
+
+    def test_gauges_use_their_aggregate(self):
+        def gauge(value, aggregate):
+            return {'type': 'gauge', 'help': 'Level.', 'aggregate': aggregate, 'samples': [[{}, value]]}
+
+        snapshots = [snapshot_of(high=gauge(value, 'max'), low=gauge(value, 'min'), open=gauge(value, 'sum'))
+                     for value in (0.5, 0.25, 0.75)]
+        merged = merge_snapshots(snapshots)
+        self.assertEqual([merged[name]['samples'][()] for name in ('high', 'low', 'open')], [0.75, 0.25, 1.5])
+
+
+class LoadSnapshotsTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        patcher = override_settings(LLMCHAT_METRICS_DIR=self.directory, LLMCHAT_METRICS_SNAPSHOT_TTL=60.0)
+        patcher.enable()
+        self.addCleanup(patcher.disable)
+
+    def write(self, pid, started, written_at=None, value=1):
+        path = os.path.join(self.directory, f'metrics-{pid}-{started}.json')
+        with open(path, 'w', encoding='utf-8') as handle:
+            json.dump({'pid': pid, 'started': started, 'written_at': written_at or time.time(),
+                       'families': {'other_calls': counter(value)}}, handle)
+        return os.path.basename(path)
+
+    def test_snapshots_of_gone_or_stale_processes_are_deleted(self):
+        parent = os.getppid()
+        live = self.write(parent, start_time(parent), value=2)
+        self.write(parent, start_time(parent) + 1)  # an earlier process that had the same pid
+        self.write(parent + 1, 1, written_at=time.time() - 120)  # not rewritten for longer than the TTL
+        self.write(parent + 2, 1)  # exited
+
+        def alive(pid, started=None):
+            return pid != parent + 2 and (pid != parent or started == start_time(parent))
+
+        with mock.patch('LLMChat.monitoring.process_alive', side_effect=alive):
+            snapshots = load_snapshots()
+
+        self.assertEqual(os.listdir(self.directory), [live])
+        self.assertEqual([snapshot['pid'] for snapshot in snapshots], [os.getpid(), parent])
+
+    def test_own_file_is_replaced_by_a_fresh_collection(self):
+        self.write(os.getpid(), process_started(), value=100)
+        snapshots = load_snapshots()
+        self.assertEqual(len(snapshots), 1)
+        self.assertNotIn('other_calls', snapshots[0]['families'])
+
+    def test_scrape_does_not_write_a_snapshot(self):
+        METRICS.inc('llmchat_test_scrapes_total')
+        self.assertIn('llmchat_test_scrapes_total 1', export())
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+class ScrapeAllowedTests(SimpleTestCase):
+
+    def request(self, address='10.0.0.5', **headers):
+        return RequestFactory().get('/metrics', REMOTE_ADDR=address, headers=headers)
+
+    @override_settings(LLMCHAT_METRICS_ALLOWED_IPS=['127.0.0.1', '10.1.0.0/16', 'not an address'],
+                       LLMCHAT_METRICS_TOKEN=None)
+    def test_client_address_must_be_allowed(self):
+        with mock.patch('LLMChat.monitoring.logger'):
+            self.assertTrue(scrape_allowed(self.request('127.0.0.1')))
+            self.assertTrue(scrape_allowed(self.request('10.1.200.3')))
+            self.assertFalse(scrape_allowed(self.request('10.2.0.1')))
+            self.assertFalse(scrape_allowed(self.request('unknown')))
+
+    @override_settings(LLMCHAT_METRICS_ALLOWED_IPS=[], LLMCHAT_METRICS_TOKEN='s3cret')
+    def test_bearer_token_allows_any_address(self):
+        self.assertTrue(scrape_allowed(self.request(Authorization='Bearer s3cret')))
+        self.assertTrue(scrape_allowed(self.request(Authorization='bearer s3cret')))
+        self.assertFalse(scrape_allowed(self.request(Authorization='Bearer wrong')))
+        self.assertFalse(scrape_allowed(self.request(Authorization='Basic s3cret')))
+        self.assertFalse(scrape_allowed(self.request()))
@@ -0,0 +1,262 @@
+"""Span-based tracing of chat requests across consumers, services and providers."""
+import atexit
+import json
+import logging
+import os
+import queue
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+_current_span: ContextVar[Optional['Span']] = ContextVar('llmchat_current_span', default=None)
+
+
+def new_trace_id() -> str:
+    return secrets.token_hex(16)
+
+
+class Span:
+    """One timed operation of a trace.
+
+    Use it as a context manager to make it the parent of the spans started
+    inside the block; ``activate()`` does the same without ending the span,
+    for spans that outlive a block (e.g. across the yields of a generator).
+    Finished spans go to the exporter and, if the trace collects spans
+    (see ``Tracer.span(collect=True)``), to ``collected`` for Server-Timing.
+    """
+
+    def __init__(self, tracer: 'Tracer', name: str, trace_id: str, parent_id: Optional[str] = None,
+                 collected: Optional[List['Span']] = None, attributes: Optional[Dict[str, Any]] = None):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.collected = collected
+        self.attributes = dict(attributes or {})
+        self.status = 'ok'
+        self.start_time = time.time()
+        self._started = time.perf_counter()
+        self.duration: Optional[float] = None
+        self._tokens = []
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._started if self.duration is None else self.duration
+
+    def end(self, error: Optional[BaseException] = None) -> None:
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self._started
+        if error is not None:
+            self.status = 'error'
+            self.attributes.setdefault('error', f"{type(error).__name__}: {error}")
+        if self.collected is not None:
+            self.collected.append(self)
+        self.tracer.export(self)
+
+    @contextmanager
+    def activate(self):
+        token = _current_span.set(self)
+        try:
+            yield self
+        finally:
+            _current_span.reset(token)
+
+    def context(self) -> Dict[str, str]:
+        """Ids to carry in a message so the receiver can continue the trace."""
+        return {'trace_id': self.trace_id, 'parent_span_id': self.span_id}
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start_time,
+            'duration_ms': round(self.duration * 1000, 3) if self.duration is not None else None,
+            'status': self.status,
+            'attributes': self.attributes,
+        }
+
+    def __enter__(self) -> 'Span':
+        self._tokens.append(_current_span.set(self))
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        _current_span.reset(self._tokens.pop())
+        self.end(exc if exc_type is not None and not issubclass(exc_type, GeneratorExit) else None)
+        return False
+
+
+class Tracer:
+    """Creates spans and hands finished ones to the exporter."""
+
+    def __init__(self, exporter):
+        self.exporter = exporter
+
+    def span(self, name: str, trace_id: Optional[str] = None, parent_id: Optional[str] = None,
+             collect: bool = False, **attributes) -> Span:
+        """Start a span under the current one, or a new trace if there is none.
+
+        Passing ``trace_id`` (and ``parent_id``) continues a trace started
+        elsewhere, e.g. in another consumer. ``collect`` makes this span keep
+        its finished descendants (used for Server-Timing headers).
+        """
+        parent = _current_span.get()
+        collected = [] if collect else None
+        if trace_id is None and parent is not None:
+            trace_id, parent_id = parent.trace_id, parent.span_id
+            if collected is None:
+                collected = parent.collected
+        return Span(self, name, trace_id or new_trace_id(), parent_id, collected, attributes)
+
+    def record(self, name: str, trace_id: str, parent_id: Optional[str], start_time: float,
+               duration: float, **attributes) -> None:
+        """Export a span that was timed by hand, e.g. on a thread without the trace context."""
+        span = Span(self, name, trace_id, parent_id, attributes=attributes)
+        span.start_time = start_time
+        span.duration = duration
+        self.export(span)
+
+    def export(self, span: Span) -> None:
+        try:
+            self.exporter.export(span.to_dict())
+        except Exception as e:
+            logger.error(f"Exporting span {span.name} failed: {str(e)}")
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+class NullExporter:
+    """Drops every span (tracing off)."""
+
+    def __init__(self, **kwargs):
+        pass
+
+    def export(self, span: Dict[str, Any]) -> None:
+        pass
+
+
+class LoggingExporter:
+    """Logs every span at debug level."""
+
+    def __init__(self, **kwargs):
+        pass
+
+    def export(self, span: Dict[str, Any]) -> None:
+        logger.debug(f"span {json.dumps(span, default=str)}")
+
+
+class JsonLinesExporter:
+    """Appends spans as JSON lines to a file, written from a background thread.
+
+    Once the file reaches ``max_bytes`` it is rotated like a log file
+    (``traces.jsonl.1`` ... ``.{backups}``, the oldest dropped), so the
+    spans kept on disk stay bounded.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 1.0, max_bytes: Optional[int] = 64 * 2 ** 20,
+                 backups: int = 3, **kwargs):
+        self.path = str(path)
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._thread = None
+        atexit.register(self.flush)
+
+    def export(self, span: Dict[str, Any]) -> None:
+        self._queue.put(span)
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='trace-exporter', daemon=True)
+                    self._thread.start()
+
+    def flush(self) -> None:
+        lines = []
+        while True:
+            try:
+                lines.append(json.dumps(self._queue.get_nowait(), default=str))
+            except queue.Empty:
+                break
+        if not lines:
+            return
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._rotate()
+            with open(self.path, 'a', encoding='utf-8') as handle:
+                handle.write('\n'.join(lines) + '\n')
+
+    def _rotate(self) -> None:
+        if not self.max_bytes:
+            return
+        try:
+            if os.path.getsize(self.path) < self.max_bytes:
+                return
+        except OSError:
+            return
+        if self.backups <= 0:
+            os.remove(self.path)
+            return
+        for index in range(self.backups - 1, 0, -1):
+            older = f"{self.path}.{index}"
+            if os.path.exists(older):
+                os.replace(older, f"{self.path}.{index + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Writing spans to {self.path} failed: {str(e)}")
+
+
+EXPORTERS = {
+    'jsonl': JsonLinesExporter,
+    'log': LoggingExporter,
+    'none': NullExporter,
+}
+
+
+def load_exporter():
+    """Build the exporter named by LLMCHAT_TRACE_EXPORTER (a key of EXPORTERS or a dotted path)."""
+    name = getattr(settings, 'LLMCHAT_TRACE_EXPORTER', 'none')
+    exporter_class = EXPORTERS.get(name) or import_string(name)
+    return exporter_class(
+        path=getattr(settings, 'LLMCHAT_TRACE_PATH', 'traces.jsonl'),
+        max_bytes=getattr(settings, 'LLMCHAT_TRACE_MAX_BYTES', 64 * 2 ** 20),
+        backups=getattr(settings, 'LLMCHAT_TRACE_BACKUPS', 3),
+    )
+
+
+def server_timing(span: Span) -> str:
+    """Server-Timing header value: total time plus the summed time per span name."""
+    totals: Dict[str, float] = {}
+    for child in span.collected or ():
+        if child is span:  # the span itself once it has ended
+            continue
+        totals[child.name] = totals.get(child.name, 0.0) + child.duration
+    entries = [f"total;dur={span.elapsed() * 1000:.1f}"]
+    entries += [f"{name};dur={duration * 1000:.1f}" for name, duration in totals.items()]
+    return ', '.join(entries)
+
+
+# Initialize the global tracer
+TRACER = Tracer(load_exporter())
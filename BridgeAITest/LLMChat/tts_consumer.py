@@ -4,10 +4,15 @@ import os
 import threading
 import queue
 import logging
+import time
+from collections import deque
 from typing import Optional
 import pyaudio
 from websockets.sync.client import connect
 from channels.generic.websocket import AsyncWebsocketConsumer
+from .consumers import new_tts_session, tts_group
+from .monitoring import ConsumerMetricsMixin
+from .tracing import TRACER
 from django.conf import settings
 
 # Configure logging
@@ -129,7 +134,7 @@ class Speaker:
                 break
         logger.info("Audio playback thread stopping")
 
-class TTSConsumer(AsyncWebsocketConsumer):
+class TTSConsumer(ConsumerMetricsMixin, AsyncWebsocketConsumer):
     """Consumer for handling text-to-speech streaming using Deepgram."""
     
     def __init__(self, *args, **kwargs):
@@ -138,12 +143,21 @@ class TTSConsumer(AsyncWebsocketConsumer):
         self._deepgram_ws = None
         self._exit = threading.Event()
         self._receiver_thread = None
+        # Chat sockets send this connection's replies to its own group
+        self._session = new_tts_session()
+        self._group = tts_group(self._session)
+        # Texts sent to Deepgram whose audio has not fully arrived yet, oldest
+        # first, with the trace they belong to
+        self._in_flight = deque()
 
     async def connect(self) -> None:
         try:
             logger.info("New WebSocket connection request received")
             await self.accept()
             logger.info("WebSocket connection accepted")
+            # Chat replies arrive as tts.text messages on this connection's group; the
+            # client passes the session from the ready message along with its chat messages
+            await self.channel_layer.group_add(self._group, self.channel_name)
             
             if not hasattr(settings, 'DEEPGRAM_API_KEY'):
                 raise ValueError("DEEPGRAM_API_KEY not found in settings")
@@ -163,7 +177,7 @@ class TTSConsumer(AsyncWebsocketConsumer):
             self._receiver_thread.start()
             logger.info("Deepgram connection thread started")
             
-            await self.send(json.dumps({'status': 'ready'}))
+            await self.send(json.dumps({'status': 'ready', 'tts_session': self._session}))
 
         except Exception as e:
             logger.error(f"Connection failed: {e}")
@@ -192,10 +206,13 @@ class TTSConsumer(AsyncWebsocketConsumer):
                         try:
                             data = json.loads(message)
                             logger.debug(f"Received text message from Deepgram: {data}")
+                            if data.get('type') == 'Flushed':
+                                self._trace_flushed()
                         except json.JSONDecodeError:
                             logger.warning(f"Received invalid JSON from Deepgram: {message[:100]}")
                     elif isinstance(message, bytes) and self._speaker:
                         logger.debug(f"Received {len(message)} bytes of audio data")
+                        self._trace_audio()
                         self._speaker.play(message)
                     else:
                         logger.warning(f"Received unexpected message type: {type(message)}")
@@ -208,8 +225,64 @@ class TTSConsumer(AsyncWebsocketConsumer):
         except Exception as e:
             logger.error(f"Deepgram connection error: {e}")
 
+    def _trace_audio(self) -> None:
+        """Record the Deepgram time to first audio of the oldest text in flight."""
+        if self._in_flight and not self._in_flight[0]['first_audio']:
+            pending = self._in_flight[0]
+            pending['first_audio'] = True
+            TRACER.record('tts.first_audio', pending['trace_id'], pending['parent_span_id'], pending['sent_at'],
+                          time.perf_counter() - pending['started'])
+
+    def _trace_flushed(self) -> None:
+        """Record the full Deepgram round trip of the oldest text in flight."""
+        if self._in_flight:
+            pending = self._in_flight.popleft()
+            TRACER.record('tts.deepgram', pending['trace_id'], pending['parent_span_id'], pending['sent_at'],
+                          time.perf_counter() - pending['started'], chars=pending['chars'])
+
+    def _speak(self, text: str) -> None:
+        """Send text to Deepgram and flush it, remembering the trace of the current span."""
+        span = TRACER.span('tts.speak', chars=len(text))
+        with span:
+            # Send the text
+            self._deepgram_ws.send(json.dumps({
+                "type": "Speak",
+                "text": text
+            }))
+            
+            # Send flush command
+            self._deepgram_ws.send(json.dumps({"type": "Flush"}))
+        self._in_flight.append({
+            **span.context(),
+            'chars': len(text),
+            'sent_at': time.time(),
+            'started': time.perf_counter(),
+            'first_audio': False,
+        })
+
+    async def tts_text(self, event) -> None:
+        """Speak a reply chunk sent by ChatConsumer, continuing its trace."""
+        text = event.get('text', '').strip()
+        if not text or not self._deepgram_ws:
+            return
+        with TRACER.span('tts.text', trace_id=event.get('trace_id'), parent_id=event.get('parent_span_id')):
+            try:
+                self._speak(text)
+                await self.send(json.dumps({
+                    'status': 'processing',
+                    'text': text
+                }))
+            except Exception as e:
+                logger.error(f"Failed to send text: {e}")
+                await self.send(json.dumps({'error': str(e)}))
+
+    async def tts_complete(self, event) -> None:
+        """The chat reply that was being spoken has ended."""
+        await self.send(json.dumps({'status': 'complete'}))
+
     async def disconnect(self, close_code: int) -> None:
         logger.info(f"WebSocket disconnecting with code: {close_code}")
+        await self.channel_layer.group_discard(self._group, self.channel_name)
         self._exit.set()
         
         if self._deepgram_ws:
@@ -255,14 +328,7 @@ class TTSConsumer(AsyncWebsocketConsumer):
                 
                 # Send to Deepgram exactly like the working implementation
                 try:
-                    # Send the text
-                    self._deepgram_ws.send(json.dumps({
-                        "type": "Speak",
-                        "text": text
-                    }))
-                    
-                    # Send flush command
-                    self._deepgram_ws.send(json.dumps({"type": "Flush"}))
+                    self._speak(text)
                     
                     await self.send(json.dumps({
                         'status': 'processing',
@@ -6,10 +6,14 @@ import logging
 from typing import Optional
 from asgiref.sync import async_to_sync
 from django.shortcuts import render
+from django.http import HttpResponse, HttpResponseForbidden
 
 from .serializers import ChatRequestSerializer, ConversationSerializer, ChatLogSerializer
 from .services import ChatService, get_active_provider
+from .deadlines import DeadlineExceeded, deadline_scope
 from .models import ModelProvider, Conversation, ChatLog
+from .registry import PROVIDER_REGISTRY
+from .monitoring import export, scrape_allowed
 from rest_framework.authentication import TokenAuthentication
 from rest_framework.permissions import IsAuthenticated
 
@@ -19,6 +23,12 @@ def chat_test_view(request):
     """Render the chat test interface."""
     return render(request, 'chat.html')
 
+def metrics_view(request):
+    """Prometheus scrape endpoint with the metrics of every worker process."""
+    if not scrape_allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(export(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 class ConversationAPIView(APIView):
     """API endpoint for managing conversations."""
     authentication_classes = []  # Disable authentication for testing
@@ -59,18 +69,22 @@ class ChatAPIView(APIView):
     def get_provider(self, provider_id: Optional[int] = None) -> ModelProvider:
         """Get the LLM provider based on ID or default active provider."""
         if provider_id:
-            try:
-                return ModelProvider.objects.get(id=provider_id, is_active=True)
-            except ModelProvider.DoesNotExist:
+            provider = PROVIDER_REGISTRY.get(provider_id)
+            if not provider:
                 raise ValidationError("Invalid or inactive provider_id")
+            return provider
         
-        provider = ModelProvider.objects.filter(is_active=True).order_by('-priority').first()
+        provider = PROVIDER_REGISTRY.primary()
         if not provider:
             raise ValidationError("No active LLM provider configured")
         return provider
 
     def post(self, request):
         """Handle non-streaming chat requests."""
+        with deadline_scope():
+            return self.reply(request)
+
+    def reply(self, request):
         try:
             # Validate request data
             serializer = ChatRequestSerializer(data=request.data)
@@ -91,8 +105,9 @@ class ChatAPIView(APIView):
                     status=status.HTTP_400_BAD_REQUEST
                 )
             
-            # Initialize chat service
-            chat_service = ChatService(provider)
+            # Initialize chat service; HTTP requests are not sticky to a worker, so
+            # history is read from the database rather than this process's cache
+            chat_service = ChatService(provider, cache_history=False)
             
             # Prepare chat parameters
             chat_params = {
@@ -105,17 +120,27 @@ class ChatAPIView(APIView):
             chat_method = async_to_sync(chat_service.chat)
             response = chat_method(**chat_params)
             
+            # The reply may come from a failover provider
+            served = response['provider']
             return Response({
                 'provider': {
-                    'id': provider.id,
-                    'name': provider.name,
-                    'model': provider.model_name
+                    'id': served.id,
+                    'name': served.name,
+                    'model': served.model_name
                 },
                 'conversation_id': response['conversation_id'],
                 'reply': response['reply'],
-                'usage': response['usage']
+                'usage': response['usage'],
+                'dropped_turns': response['dropped_turns'],
+                'cached': response['cached']
             })
                 
+        except DeadlineExceeded as e:
+            logger.warning(f"Chat request ran out of time: {str(e)}")
+            return Response(
+                {"error": "The request timed out"},
+                status=status.HTTP_504_GATEWAY_TIMEOUT
+            )
         except Exception as e:
             logger.error(f"Unexpected error in ChatAPIView: {str(e)}", exc_info=True)
             return Response(
@@ -0,0 +1,104 @@
+"""Write-behind persistence of ChatLog rows."""
+import atexit
+import logging
+import threading
+from typing import List
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .models import ChatLog
+
+logger = logging.getLogger(__name__)
+
+
+class ChatLogWriter:
+    """Collects ChatLog rows and saves them in batches on a background thread.
+
+    A batch is flushed with ``bulk_create`` once ``batch_size`` rows are queued
+    or ``flush_interval`` seconds have passed, and once more at interpreter
+    exit. With ``synchronous`` set, ``write`` saves the row immediately, which
+    is what tests running inside a transaction need.
+    """
+
+    def __init__(self, batch_size: int, flush_interval: float, synchronous: bool = False):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.synchronous = synchronous
+        self._pending: List[ChatLog] = []
+        self._lock = threading.Lock()
+        # Serializes flushes between the background thread and explicit calls
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        atexit.register(self.close)
+
+    def write(self, chat_log: ChatLog) -> None:
+        """Queue a row for saving (or save it right away in synchronous mode)."""
+        if self.synchronous:
+            chat_log.save()
+            return
+        with self._lock:
+            self._pending.append(chat_log)
+            full = len(self._pending) >= self.batch_size
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='chatlog-writer', daemon=True)
+                self._thread.start()
+        if full:
+            self._wakeup.set()
+
+    def pending_for(self, conversation_id: int) -> List[ChatLog]:
+        """Rows of a conversation that are queued but not saved yet, oldest first."""
+        with self._lock:
+            return [chat_log for chat_log in self._pending if chat_log.conversation_id == conversation_id]
+
+    def flush(self) -> int:
+        """Save everything queued so far; returns the number of rows written."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return 0
+            close_old_connections()
+            try:
+                ChatLog.objects.bulk_create(batch)
+                return len(batch)
+            except Exception as e:
+                # One bad row (e.g. its conversation was deleted) must not lose the others
+                logger.error(f"Bulk insert of {len(batch)} chat logs failed, saving one by one: {str(e)}")
+                written = 0
+                for chat_log in batch:
+                    try:
+                        chat_log.save()
+                        written += 1
+                    except Exception as e:
+                        logger.error(f"Dropping chat log of conversation {chat_log.conversation_id}: {str(e)}")
+                return written
+            finally:
+                close_old_connections()
+
+    def close(self) -> None:
+        """Stop the background thread and flush what is left."""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=max(5.0, self.flush_interval * 2))
+        self.flush()
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Chat log writer error: {str(e)}", exc_info=True)
+
+
+# Initialize the global chat log writer
+CHATLOG_WRITER = ChatLogWriter(
+    batch_size=getattr(settings, 'LLMCHAT_CHATLOG_BATCH_SIZE', 50),
+    flush_interval=getattr(settings, 'LLMCHAT_CHATLOG_FLUSH_INTERVAL', 1.0),
+    synchronous=getattr(settings, 'LLMCHAT_CHATLOG_SYNC_WRITES', False),
+)